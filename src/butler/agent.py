@@ -0,0 +1,187 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+AGENT_SOCKET = os.path.expanduser("~/.pw_butler/agent.sock")
+IDLE_TIMEOUT = 900  # Seconds without requests before the agent exits
+
+# Butler methods the agent is willing to run on behalf of clients
+AGENT_OPS = {
+    "retrieve_uname",
+    "retrieve_pword",
+    "retrieve_many",
+    "retrieve_all",
+    "search_sites",
+    "add",
+    "update",
+    "remove",
+}
+
+
+class AgentError(RuntimeError):
+    """An error reported by the agent"""
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Answer newline-delimited JSON requests on one connection"""
+
+    server: "AgentServer"
+
+    def handle(self):
+        if not self.server.peer_allowed(self.request):
+            logging.warning("Rejected agent connection from another user.")
+            return
+        for line in self.rfile:
+            response = self.server.dispatch(json.loads(line))
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serve requests for an unlocked Butler over a user-only Unix socket
+    :param app: an entered Butler instance
+    :param socket_path: where to listen
+    :param idle_timeout: seconds without requests before serve returns
+    """
+
+    daemon_threads = True
+    timeout = 1  # Granularity of the idle check in serve
+
+    def __init__(self, app, socket_path=AGENT_SOCKET, idle_timeout=IDLE_TIMEOUT):
+        if connect_agent(socket_path) is not None:
+            raise RuntimeError("An agent is already running!")
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)  # Left over by an agent that died
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, _Handler)
+        finally:
+            os.umask(old_umask)
+        os.chmod(socket_path, 0o600)
+        self.app = app
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()  # Butler is not thread safe
+        self._last_used = time.monotonic()
+        self._stopped = False
+
+    @staticmethod
+    def peer_allowed(conn: socket.socket) -> bool:
+        """Only talk to processes of the same user, where the OS can tell us"""
+        if not hasattr(socket, "SO_PEERCRED"):
+            return True  # Rely on the socket file permissions
+        creds = conn.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+        )
+        _, uid, _ = struct.unpack("3i", creds)
+        return uid == os.getuid()
+
+    def dispatch(self, request: dict) -> dict:
+        """Run one request against the Butler"""
+        self._last_used = time.monotonic()
+        op = request.get("op")
+        if op == "ping":
+            return {"result": True}
+        if op == "stop":
+            self._stopped = True
+            return {"result": True}
+        if op not in AGENT_OPS:
+            return {"error": f"Unknown operation {op}!", "type": "AgentError"}
+        try:
+            with self._lock:
+                result = getattr(self.app, op)(*request.get("args", []))
+        except (KeyError, ValueError) as e:
+            return {"error": str(e), "type": type(e).__name__}
+        except Exception as e:
+            logging.exception(f"Agent failed to run {op}.")
+            return {"error": f"{type(e).__name__} in agent", "type": "AgentError"}
+        if isinstance(result, dict):  # JSON has no tuple keys
+            result = [[*k, v] for k, v in result.items()]
+        return {"result": result}
+
+    def serve(self) -> None:
+        """Handle requests until stopped or idle for too long"""
+        try:
+            while not self._stopped:
+                if time.monotonic() - self._last_used > self.idle_timeout:
+                    logging.info("Agent idle, shutting down.")
+                    break
+                self.handle_request()
+        finally:
+            self.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+class AgentClient:
+    """Talk to a running agent. Mirrors the Butler retrieval / edit methods
+    :param socket_path: where the agent listens
+    """
+
+    def __init__(self, socket_path=AGENT_SOCKET):
+        self.socket_path = socket_path
+
+    def call(self, op: str, *args):
+        """Send one request and return its result"""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps({"op": op, "args": args}).encode() + b"\n")
+            with sock.makefile("rb") as f:
+                line = f.readline()
+        if not line:
+            raise AgentError("Agent closed the connection.")
+        response = json.loads(line)
+        if "error" in response:
+            raise _error_type(response["type"])(response["error"])
+        return response["result"]
+
+    def retrieve_uname(self, site_name: str) -> list:
+        return self.call("retrieve_uname", site_name)
+
+    def retrieve_pword(self, site_name: str, uname: str) -> str:
+        return self.call("retrieve_pword", site_name, uname)
+
+    def retrieve_many(self, pairs) -> dict:
+        return {(s, u): p for s, u, p in self.call("retrieve_many", list(pairs))}
+
+    def retrieve_all(self, sort=True) -> list:
+        return self.call("retrieve_all", sort)
+
+    def search_sites(self, query: str, limit: int = 20) -> list:
+        return self.call("search_sites", query, limit)
+
+    def add(self, site_name: str, username: str, password: str) -> None:
+        self.call("add", site_name, username, password)
+
+    def update(self, site_name: str, username: str, password: str) -> None:
+        self.call("update", site_name, username, password)
+
+    def remove(self, site_name: str, username: str) -> None:
+        self.call("remove", site_name, username)
+
+    def stop(self) -> None:
+        self.call("stop")
+
+
+def _error_type(name: str) -> type:
+    """Exception class for an error type reported by the agent"""
+    if name in ("EntryExistsError", "EntryNotFoundError"):
+        import butler.database  # Only on errors, as it is slow to import
+
+        return getattr(butler.database, name)
+    return {"ValueError": ValueError, "KeyError": KeyError}.get(name, AgentError)
+
+
+def connect_agent(socket_path=AGENT_SOCKET) -> AgentClient | None:
+    """Return a client if an agent is listening on the socket"""
+    client = AgentClient(socket_path)
+    try:
+        client.call("ping")
+    except (OSError, AgentError):
+        return None
+    return client
@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from butler import migrations
+from butler.app import encrypt_entry
+from butler.authentication import RootKey
+from butler.database import (
+    CONNECT_DEADLINE,
+    DB_CONF_PATH,
+    PW_KEY,
+    UNAME_KEY,
+    Database,
+    EntryExistsError,
+    EntryNotFoundError,
+    configure_sqlite,
+    read_db_url,
+)
+from butler.search import SEARCH_LIMIT, SiteIndex
+from butler.util import (
+    AEAD_KEY_VERSION,
+    HKDF_KEY_VERSION,
+    LEGACY_KEY_VERSION,
+    KeyCache,
+    blind_index,
+    decrypt_token,
+    derive_aead_key,
+    derive_index_key,
+    derive_key,
+    derive_row_key,
+    legacy_kdf,
+    stretch,
+    token_aad,
+)
+
+
+class AsyncDatabase(Database):
+    """Database on an asyncio engine. The queries of Database are reused through
+    AsyncSession.run_sync, so only connection handling differs. The embedded
+    backend requires aiosqlite
+    :param config_dir: location to store database config
+    """
+
+    Session: async_sessionmaker  # type: ignore[assignment]
+    PrimarySession: async_sessionmaker  # type: ignore[assignment]
+
+    def __init__(
+        self,
+        config_dir: str | os.PathLike = DB_CONF_PATH,
+        connect_deadline: float = CONNECT_DEADLINE,
+    ):
+        super().__init__(config_dir, connect_deadline)
+        url = read_db_url(config_dir)
+        if url.drivername == "sqlite":
+            url = url.set(drivername="sqlite+aiosqlite")
+        self.async_engine = create_async_engine(url)
+        if self.embedded:
+            event.listen(self.async_engine.sync_engine, "connect", configure_sqlite)
+        # Replicas are not routed to, every session reads from the primary
+        self.Session = self.PrimarySession = async_sessionmaker(self.async_engine)
+
+    async def close(self):  # type: ignore[override]
+        """Close connections"""
+        await self.async_engine.dispose()
+
+    async def prepare(self) -> int:  # type: ignore[override]
+        """Wait for the database and return its schema version"""
+        if self.embedded:
+            async with self.async_engine.begin() as conn:
+                await conn.run_sync(migrations.create_all)
+                return await conn.run_sync(migrations.get_version)
+        give_up = time.monotonic() + self.connect_deadline
+        delay = 0.05
+        while True:
+            try:
+                return await self._read_version()
+            except OperationalError:
+                remaining = give_up - time.monotonic()
+                if remaining <= 0:
+                    raise
+                logging.info("Database not ready yet. Retrying...")
+                await asyncio.sleep(min(delay, remaining))
+                delay = min(delay * 2, 1.0)
+
+    async def _read_version(self) -> int:  # type: ignore[override]
+        async with self.async_engine.connect() as conn:
+            return await conn.run_sync(migrations.get_version)
+
+    async def needs_upgrade(self) -> bool:  # type: ignore[override]
+        """Whether the database schema predates this Butler"""
+        return await self._read_version() < migrations.SCHEMA_VERSION
+
+    async def upgrade(self) -> None:  # type: ignore[override]
+        """Upgrade an older schema in place"""
+        current = await self._read_version()
+        async with self.async_engine.begin() as conn:
+            await conn.run_sync(migrations.upgrade, current)
+
+    async def run(self, query: Callable, *args):
+        """Run a Database query method in a new session"""
+        async with self.Session() as sess:
+            return await sess.run_sync(query, *args)
+
+
+class AsyncButler:
+    """Asynchronous counterpart of Butler. Stretching the root password and legacy
+    key derivation run in an executor so that they don't block the event loop.
+    Encryption is quick enough to run inline
+    :param password: root password
+    :param db_dir: testing or production type
+    :param key_cache_size: maximum number of derived keys kept in memory
+    :param executor: where crypto runs, defaults to a process pool owned by us
+    :param root_key: result of unlocking the auth file, saves stretching again
+    """
+
+    def __init__(
+        self,
+        password: bytes,
+        db_dir=DB_CONF_PATH,
+        key_cache_size=128,
+        executor: Executor | None = None,
+        root_key: RootKey | None = None,
+    ):
+        self._database = AsyncDatabase(db_dir)
+        self._root_pw = password
+        self._root_key = root_key
+        self._keys = KeyCache(key_cache_size)
+        self._own_executor = executor is None
+        self._executor = executor or ProcessPoolExecutor()
+        self._master_key: bytearray | None = None
+        self._index_key: bytearray | None = None
+        self._site_index: tuple | None = None  # (changes, SiteIndex), embedded
+        self._unlock = asyncio.Lock()
+
+    async def __aenter__(self):
+        if await self._database.prepare() < migrations.SCHEMA_VERSION:
+            await self._database.upgrade()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._keys.clear()
+        for key in (self._master_key, self._index_key):
+            if key is not None:
+                key[:] = bytes(len(key))
+        self._master_key = self._index_key = None
+        if self._own_executor:
+            self._executor.shutdown()
+        await self._database.close()
+
+    async def _run(self, fn: Callable, *args):
+        """Run a slow key derivation in the executor"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, fn, *args
+        )
+
+    async def _get_keys(self) -> tuple:
+        """Vault master key and blind index key, derived once per session"""
+        async with self._unlock:
+            if self._master_key is None:
+                root_key = self._root_key
+                default = root_key.kdf if root_key else legacy_kdf(os.urandom(16))
+                kdf = await self._database.run(self._database.get_kdf, default)
+                if root_key is not None and root_key.kdf == kdf:
+                    master = root_key.master_key
+                else:
+                    master = await self._run(stretch, kdf, self._root_pw)
+                self._master_key = bytearray(master)
+                self._index_key = bytearray(derive_index_key(master))
+        return bytes(self._master_key), bytes(self._index_key)  # type: ignore
+
+    async def _lookup(self, site_name: str, username: str) -> bytes:
+        _, index_key = await self._get_keys()
+        return blind_index(index_key, site_name, username)
+
+    async def _row_key(self, salt: bytes, version: int) -> bytes:
+        """Obtain the encryption key of a row"""
+        if version == LEGACY_KEY_VERSION:
+            key = self._keys.lookup(salt, self._root_pw)
+            if key is None:
+                key = await self._run(derive_key, salt, self._root_pw)
+                self._keys.store(salt, self._root_pw, key)
+            return key
+        if version == HKDF_KEY_VERSION:
+            master_key, _ = await self._get_keys()
+            return derive_row_key(master_key, salt)
+        if version == AEAD_KEY_VERSION:
+            master_key, _ = await self._get_keys()
+            return derive_aead_key(master_key, salt)
+        raise ValueError(f"Unknown key version {version}!")
+
+    async def _decrypt(
+        self, salt: bytes, version: int, token: bytes, site_name: str, column: str
+    ) -> str:
+        key = await self._row_key(salt, version)
+        aad = token_aad(site_name, column)
+        return decrypt_token(key, version, token, aad).decode()
+
+    async def retrieve_uname(self, site_name: str) -> list:
+        """Obtain usernames for a site / app"""
+        tokens = await self._database.run(self._database.get_uname, site_name)
+        return list(
+            await asyncio.gather(
+                *(
+                    self._decrypt(
+                        t.salt, t.key_version, t.username, site_name, UNAME_KEY
+                    )
+                    for t in tokens
+                )
+            )
+        )
+
+    async def _find_unindexed(self, site_name: str, uname: str) -> bytes | None:
+        """Find the username token of a row without blind index by decryption"""
+        if not self._database.unindexed:
+            return None
+        tokens = await self._database.run(self._database.get_uname, site_name, True)
+        unames = await asyncio.gather(
+            *(
+                self._decrypt(t.salt, t.key_version, t.username, site_name, UNAME_KEY)
+                for t in tokens
+            )
+        )
+        for token, name in zip(tokens, unames):
+            if name == uname:
+                return token.username
+        return None
+
+    async def retrieve_pword(self, site_name: str, uname: str) -> str:
+        """Obtain password for site and username"""
+        lookup = await self._lookup(site_name, uname)
+        result = await self._database.run(self._database.get_by_lookup, lookup)
+        if result is None:
+            uname_token = await self._find_unindexed(site_name, uname)
+            if uname_token is None:
+                return ""
+            result = await self._database.run(
+                self._database.get_pw, site_name, uname_token
+            )
+        return await self._decrypt(
+            result.salt, result.key_version, result.password, site_name, PW_KEY
+        )
+
+    async def retrieve_all(self, sort=True) -> list:
+        """Obtain all apps / sites"""
+        sites = await self._database.run(self._database.get_all_sites)
+        return sorted(sites, key=str.casefold) if sort else sites
+
+    async def search_sites(self, query: str, limit: int = SEARCH_LIMIT) -> list:
+        """Sites matching the query, see Butler.search_sites"""
+        db = self._database
+        if not db.embedded:
+            return await db.run(db.search_sites, query, limit)
+        changes = await db.run(db.get_changes)
+        if self._site_index is None or self._site_index[0] != changes:
+            sites = await db.run(db.get_all_sites)
+            index = await asyncio.to_thread(SiteIndex, sites)  # Too big to pickle
+            self._site_index = (changes, index)
+        return self._site_index[1].search(query, limit)
+
+    async def add(self, site_name: str, username: str, password: str) -> None:
+        """Add one entry"""
+        master_key, index_key = await self._get_keys()
+        entry = encrypt_entry(master_key, index_key, site_name, username, password)
+        # Rows of older versions have no blind index to conflict with
+        if await self._find_unindexed(site_name, username) is not None:
+            raise EntryExistsError("Entry already exists!")
+        await self._database.run(self._database.add, entry)
+        logging.info("Entry added.")
+
+    async def update(self, site_name: str, username: str, password: str) -> None:
+        """Replace the password of an entry"""
+        master_key, index_key = await self._get_keys()
+        entry = encrypt_entry(master_key, index_key, site_name, username, password)
+        try:
+            await self._database.run(self._database.update, entry)
+        except EntryNotFoundError:
+            uname_token = await self._find_unindexed(site_name, username)
+            if uname_token is None:
+                raise
+            await self._database.run(self._database.update, entry, uname_token)
+        logging.info("Entry updated.")
+
+    async def remove(self, site_name: str, username: str) -> None:
+        """Remove one entry"""
+        lookup = await self._lookup(site_name, username)
+        try:
+            await self._database.run(self._database.remove_by_lookup, lookup)
+        except EntryNotFoundError:
+            uname_token = await self._find_unindexed(site_name, username)
+            if uname_token is None:
+                logging.error(f"Username {username} not found!")
+                return
+            await self._database.run(self._database.remove, site_name, uname_token)
+        logging.info("Entry removed.")
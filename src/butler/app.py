@@ -1,100 +1,767 @@
+import base64
+import hmac
+import json
 import logging
+import os
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Iterable, Iterator
 
-from pandas import DataFrame
-
+from butler import snapshot, trace
+from butler.authentication import AUTH_PATH, RootKey, write_auth
+from butler.backup import read_backup, write_backup
+from butler.cache import CACHE_SIZE, ChangeListener, CredentialCache
 from butler.database import (
     DB_CONF_PATH,
+    LOOKUP_KEY,
+    MASTER_SALT_NAME,
     PW_KEY,
+    REKEY_NAME,
     SALT_KEY,
     SITE_KEY,
     UNAME_KEY,
+    UNINDEXED_NAME,
+    VERSION_KEY,
     DatabaseApplication,
+    EntryExistsError,
+    EntryNotFoundError,
+    read_config,
+)
+from butler.search import SEARCH_LIMIT, SiteIndex
+from butler.util import (
+    AEAD_KEY_VERSION,
+    CURRENT_KEY_VERSION,
+    HKDF_KEY_VERSION,
+    LEGACY_KEY_VERSION,
+    KeyCache,
+    blind_index,
+    calibrate_kdf,
+    decrypt_token,
+    derive_aead_key,
+    derive_index_key,
+    derive_key,
+    derive_row_key,
+    derive_verifier,
+    legacy_kdf,
+    seal,
+    stretch,
+    token_aad,
 )
-from butler.util import decrypt_with_salt, encrypt_with_salt, encrypt_wrapper
+
+
+def encrypt_entry(
+    master_key: bytes, index_key: bytes, site_name: str, username: str, password: str
+) -> dict:
+    """Encrypt one entry in the current key format, ready to be inserted"""
+    salt = os.urandom(16)
+    key = derive_aead_key(master_key, salt)
+    return {
+        SITE_KEY: site_name,
+        SALT_KEY: salt,
+        UNAME_KEY: seal(key, username.encode(), token_aad(site_name, UNAME_KEY)),
+        PW_KEY: seal(key, password.encode(), token_aad(site_name, PW_KEY)),
+        VERSION_KEY: AEAD_KEY_VERSION,
+        LOOKUP_KEY: blind_index(index_key, site_name, username),
+    }
+
+
+def _encrypt_batch(master_key: bytes, index_key: bytes, batch: list) -> list:
+    """Process pool worker encrypting a batch of (site, username, password)"""
+    return [encrypt_entry(master_key, index_key, *entry) for entry in batch]
+
+
+def _rekey_batch(
+    root_pw: bytes,
+    old_master_key: bytes,
+    new_master_key: bytes,
+    new_index_key: bytes,
+    batch: list,
+) -> dict:
+    """Process pool worker re-encrypting a batch of (id, site, salt, key version,
+    username token, password token) rows under a new master key
+    """
+    entries = {}
+    for row_id, site_name, salt, version, uname_token, pw_token in batch:
+        if version == LEGACY_KEY_VERSION:
+            key = derive_key(salt, root_pw)
+        elif version == HKDF_KEY_VERSION:
+            key = derive_row_key(old_master_key, salt)
+        elif version == AEAD_KEY_VERSION:
+            key = derive_aead_key(old_master_key, salt)
+        else:
+            raise ValueError(f"Unknown key version {version}!")
+        uname_aad = token_aad(site_name, UNAME_KEY)
+        pw_aad = token_aad(site_name, PW_KEY)
+        entry = encrypt_entry(
+            new_master_key,
+            new_index_key,
+            site_name,
+            decrypt_token(key, version, uname_token, uname_aad).decode(),
+            decrypt_token(key, version, pw_token, pw_aad).decode(),
+        )
+        del entry[SITE_KEY]
+        entries[row_id] = entry
+    return entries
 
 
 class Butler(DatabaseApplication):
     """Main application class
     :param password: root password
     :param db_dir: testing or production type
+    :param key_cache_size: maximum number of derived keys kept in memory
+    :param root_key: result of unlocking the auth file, saves stretching again
+    :param cache_ttl: seconds to keep decrypted usernames and passwords in memory,
+        not kept by default. Changes by other clients drop them, see butler.cache
+    :param cache_size: maximum number of cached lookups
     """
 
-    def __init__(self, password, db_dir=DB_CONF_PATH):
+    def __init__(
+        self,
+        password,
+        db_dir=DB_CONF_PATH,
+        key_cache_size=128,
+        root_key: RootKey | None = None,
+        cache_ttl: float | None = None,
+        cache_size: int = CACHE_SIZE,
+    ):
         super().__init__(db_dir)
         self._root_pw = password
+        self._root_key = root_key
+        self._kdf: dict | None = None
+        self._keys = KeyCache(key_cache_size)
+        self._master_key: bytearray | None = None
+        self._index_key: bytearray | None = None
+        self._site_index: tuple | None = None  # (changes, SiteIndex), embedded
+        self._rekeying = False
+        self._cache = CredentialCache(cache_ttl, cache_size) if cache_ttl else None
+        self._listener: ChangeListener | None = None
+        self._cache_changes: int | None = None  # Change counter, embedded only
+        self._db_dir = db_dir
+        self._snapshot_path = (
+            snapshot.snapshot_path(db_dir)
+            if snapshot.snapshot_enabled(read_config(db_dir))
+            else None
+        )
+
+    def __enter__(self):
+        super().__enter__()
+        if self._cache is not None and not self._database.embedded:
+            self._listener = ChangeListener(self._database.engine, self._cache)
+            self._listener.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        if self._cache is not None:
+            self._cache.clear()
+        self._keys.clear()
+        for key in (self._master_key, self._index_key):
+            if key is not None:
+                key[:] = bytes(len(key))
+        self._master_key = self._index_key = None
+        super().__exit__(exc_type, exc_val, exc_tb)
+
+    @trace.traced("master_key")
+    def _get_master_key(self) -> bytes:
+        """Stretch the root password into the vault master key, once per session"""
+        if self._master_key is None:
+            default = (
+                self._root_key.kdf if self._root_key else legacy_kdf(os.urandom(16))
+            )
+            with self.session_factory() as sess:
+                self._kdf = self._database.get_kdf(sess, default, self._rekeying)
+            if self._root_key is not None and self._root_key.kdf == self._kdf:
+                master_key = self._root_key.master_key  # Stretched when unlocking
+            else:
+                master_key = stretch(self._kdf, self._root_pw)
+            self._master_key = bytearray(master_key)
+        return bytes(self._master_key)
+
+    def vault_root_key(self) -> RootKey:
+        """Root key unlocking this vault directly, for authentication files"""
+        master_key = self._get_master_key()
+        return RootKey(self._root_pw, self._kdf, master_key)  # type: ignore[arg-type]
+
+    def _get_index_key(self) -> bytes:
+        if self._index_key is None:
+            self._index_key = bytearray(derive_index_key(self._get_master_key()))
+        return bytes(self._index_key)
+
+    def _lookup(self, site_name: str, username: str) -> bytes:
+        """Blind index of a (site, username) pair"""
+        return blind_index(self._get_index_key(), site_name, username)
 
+    def _row_key(self, salt: bytes, version: int) -> bytes:
+        """Obtain the encryption key of a row"""
+        if version == LEGACY_KEY_VERSION:
+            return self._keys.get(salt, self._root_pw)
+        if version == HKDF_KEY_VERSION:
+            return derive_row_key(self._get_master_key(), salt)
+        if version == AEAD_KEY_VERSION:
+            return derive_aead_key(self._get_master_key(), salt)
+        raise ValueError(f"Unknown key version {version}!")
+
+    def _decrypt(
+        self, salt: bytes, version: int, token: bytes, site_name: str, column: str
+    ) -> str:
+        """Decrypt the username or password token of a row
+        :param column: UNAME_KEY or PW_KEY, which the token was sealed to
+        """
+        key = self._row_key(salt, version)
+        return decrypt_token(key, version, token, token_aad(site_name, column)).decode()
+
+    def _decrypt_row(self, row) -> tuple[str, str]:
+        """Username and password of a credential row"""
+        key, version = self._row_key(row.salt, row.key_version), row.key_version
+        return (
+            decrypt_token(
+                key, version, row.username, token_aad(row.app_site, UNAME_KEY)
+            ).decode(),
+            decrypt_token(
+                key, version, row.password, token_aad(row.app_site, PW_KEY)
+            ).decode(),
+        )
+
+    def _cache_usable(self, cache: CredentialCache) -> bool:
+        """Whether cached entries are known to be current"""
+        if self._listener is not None:
+            return self._listener.listening.is_set()
+        # Embedded, without notifications: any change drops everything
+        with self.session_factory(primary=True) as sess:
+            changes = self._database.get_changes(sess)
+        if changes != self._cache_changes:
+            cache.clear()
+            self._cache_changes = changes
+        return True
+
+    def _cached(self, key: tuple, load: Callable[..., list]) -> list:
+        """Values of a (site, ...) key from the cache, loaded on a miss
+        :param load: reads the values, from the primary if called with primary=True
+        """
+        cache = self._cache
+        if cache is None or not self._cache_usable(cache):
+            return load()
+        values = cache.get(key)
+        if values is not None:
+            trace.count("cache.hits")
+            return values
+        generation = cache.generation
+        # A lagging replica could bring back what a notification just dropped
+        values = load(primary=True)
+        cache.put(key, values, generation)
+        return values
+
+    def _invalidate(self, site_name: str | None = None) -> None:
+        """Drop cached entries of a site we changed, or all of them"""
+        if self._cache is not None:
+            if site_name is None:
+                self._cache.clear()
+            else:
+                self._cache.invalidate(site_name)
+
+    @trace.traced("retrieve_uname")
     def retrieve_uname(self, site_name: str) -> list:
         """Obtain usernames for a site / app"""
-        with self.session_factory() as sess:
-            tokens: DataFrame = self._database.get_uname(sess, site_name)
-        unames = []
-        for i in tokens.index:
-            unames.append(
-                decrypt_with_salt(
-                    self._root_pw, tokens[SALT_KEY][i], tokens[UNAME_KEY][i]
-                ).decode()
+        return self._cached((site_name,), partial(self._load_uname, site_name))
+
+    def _load_uname(self, site_name: str, primary: bool = False) -> list:
+        with self.session_factory(primary=primary) as sess:
+            tokens = self._database.get_uname(sess, site_name)
+        trace.count("rows.scanned", len(tokens))
+        return [
+            self._decrypt(
+                token.salt, token.key_version, token.username, site_name, UNAME_KEY
             )
-        return unames
+            for token in tokens
+        ]
 
+    @trace.traced("retrieve_pword")
     def retrieve_pword(self, site_name: str, uname: str) -> str:
         """Obtain password for site and username"""
-        with self.session_factory() as sess:
-            uname_tokens: DataFrame = self._database.get_uname(sess, site_name)
-            for i in uname_tokens.index:
-                if (
-                    uname
-                    == decrypt_with_salt(
-                        self._root_pw,
-                        uname_tokens[SALT_KEY][i],
-                        uname_tokens[UNAME_KEY][i],
-                    ).decode()
-                ):
-                    result = self._database.get_pw(
-                        sess, site_name, uname_tokens[UNAME_KEY][i]
-                    )
-                    return decrypt_with_salt(
-                        self._root_pw,
-                        getattr(result, SALT_KEY),
-                        getattr(result, PW_KEY),
-                    ).decode()
-        return ""
+        key = (site_name, self._lookup(site_name, uname))  # No plaintext username
+        return self._cached(key, partial(self._load_pword, site_name, uname))[0]
+
+    def _load_pword(self, site_name: str, uname: str, primary: bool = False) -> list:
+        with self.session_factory(primary=primary) as sess:
+            result = self._database.get_by_lookup(sess, self._lookup(site_name, uname))
+            if result is None:
+                uname_token = self._find_unindexed(sess, site_name, uname)
+                if uname_token is None:
+                    return [""]
+                result = self._database.get_pw(sess, site_name, uname_token)
+        return [
+            self._decrypt(
+                result.salt, result.key_version, result.password, site_name, PW_KEY
+            )
+        ]
+
+    def _check_duplicates(self, sess) -> None:
+        """Refuse to index rows without blind index while one of them is stored
+        twice, as indexing them would fail on the second
+        """
+        pairs: dict[bytes, tuple] = {}
+        twice = []
+        for row in self._database.get_outdated(sess, CURRENT_KEY_VERSION):
+            if row.lookup is None:
+                uname = self._decrypt(
+                    row.salt, row.key_version, row.username, row.app_site, UNAME_KEY
+                )
+                lookup = self._lookup(row.app_site, uname)
+                if lookup in pairs:
+                    twice.append(pairs[lookup])
+                pairs[lookup] = (row.app_site, uname)
+        twice += [
+            pairs[lookup]
+            for lookup in self._database.existing_lookups(sess, list(pairs))
+        ]
+        if twice:
+            site_name, uname = twice[0]
+            raise EntryExistsError(
+                f"Username {uname} of {site_name} is stored twice, "
+                "remove one of them first!"
+            )
+
+    def _find_unindexed(self, sess, site_name: str, uname: str) -> bytes | None:
+        """Find the username token of a row without blind index by decryption"""
+        if not self._database.unindexed:
+            return None
+        tokens = self._database.get_uname(sess, site_name, unindexed=True)
+        trace.count("rows.scanned", len(tokens))
+        for token in tokens:
+            if uname == self._decrypt(
+                token.salt, token.key_version, token.username, site_name, UNAME_KEY
+            ):
+                return token.username
+        return None
 
+    @trace.traced("retrieve_many")
+    def retrieve_many(
+        self, pairs: Iterable[tuple], workers: int | None = None, session=None
+    ) -> dict:
+        """Obtain passwords for many (site, username) pairs at once
+        :param workers: threads used for decryption
+        :return: mapping from found (site, username) pairs to their passwords
+        """
+        lookups = {self._lookup(*pair): tuple(pair) for pair in pairs}
+        with self.session_factory(session) as sess:
+            found = {
+                lookups[lookup]: token
+                for lookup, token in self._database.get_by_lookups(
+                    sess, list(lookups)
+                ).items()
+            }
+            for pair in set(lookups.values()) - set(found):
+                uname_token = self._find_unindexed(sess, *pair)
+                if uname_token is not None:
+                    found[pair] = self._database.get_pw(sess, pair[0], uname_token)
+        # Derive each distinct key once, then decrypt in parallel
+        keys = {
+            (t.salt, t.key_version): self._row_key(t.salt, t.key_version)
+            for t in found.values()
+        }
+        with ThreadPoolExecutor(workers) as pool:
+            passwords = pool.map(
+                lambda pair, t: decrypt_token(
+                    keys[(t.salt, t.key_version)],
+                    t.key_version,
+                    t.password,
+                    token_aad(pair[0], PW_KEY),
+                ).decode(),
+                found.keys(),
+                found.values(),
+            )
+            return dict(zip(found, passwords))
+
+    @trace.traced("retrieve_all")
     def retrieve_all(self, sort=True) -> list:
         """Obtain all apps / sites"""
         with self.session_factory() as sess:
             sites = self._database.get_all_sites(sess)
         return sorted(sites, key=str.casefold) if sort else sites
 
+    @trace.traced("search_sites")
+    def search_sites(self, query: str, limit: int = SEARCH_LIMIT, session=None) -> list:
+        """Sites matching the query, exact and prefix matches first, then
+        substrings, then similar spellings
+        """
+        with self.session_factory(session) as sess:
+            if not self._database.embedded:
+                return self._database.search_sites(sess, query, limit)
+            # The embedded database is local, so search sites held in memory
+            changes = self._database.get_changes(sess)
+            if self._site_index is None or self._site_index[0] != changes:
+                sites = self._database.get_all_sites(sess)
+                self._site_index = (changes, SiteIndex(sites))
+        return self._site_index[1].search(query, limit)
+
+    @trace.traced("add")
     def add(self, site_name: str, username: str, password: str, session=None) -> None:
         """Add one entry"""
-        uname_token, salt = encrypt_wrapper(self._root_pw, username.encode())
-        pw_token = encrypt_with_salt(self._root_pw, salt, password.encode())
+        entry = encrypt_entry(
+            self._get_master_key(),
+            self._get_index_key(),
+            site_name,
+            username,
+            password,
+        )
         with self.session_factory(session) as sess:
-            self._database.add(
-                sess,
-                {
-                    SITE_KEY: site_name,
-                    SALT_KEY: salt,
-                    UNAME_KEY: uname_token.decode(),
-                    PW_KEY: pw_token.decode(),
-                },
-            )
+            # Rows of older versions have no blind index to conflict with
+            if self._find_unindexed(sess, site_name, username) is not None:
+                raise EntryExistsError("Entry already exists!")
+            self._database.add(sess, entry)
         logging.info("Entry added.")
+        self._invalidate(site_name)
+        self._refresh_snapshot(session)
+
+    @trace.traced("add_many")
+    def add_many(
+        self,
+        entries: Iterable[tuple],
+        workers: int | None = None,
+        batch_size: int = 1000,
+        progress: Callable[[int], None] | None = None,
+        checkpoint: str | os.PathLike | None = None,
+        session=None,
+    ) -> int:
+        """Add many (site, username, password) entries, skipping existing ones
+        :param workers: encryption processes, defaults to the CPU count
+        :param batch_size: entries per transaction
+        :param progress: called with the number of entries handled in each batch
+        :param checkpoint: file recording how many entries were already handled,
+            so that an interrupted import resumes where it stopped. Removed once
+            all entries are handled
+        :return: number of added entries
+        """
+        done = 0
+        if checkpoint is not None and os.path.isfile(checkpoint):
+            with open(checkpoint, "r") as f:
+                done = json.load(f)["done"]
+            logging.info(f"Resuming after {done} entries.")
+        batches = _batched(entries, batch_size, skip=done)
+        master_key, index_key = self._get_master_key(), self._get_index_key()
+        added = 0
+        workers = workers or os.cpu_count() or 1
+        checked_sites: set[str] = set()  # Whose unindexed rows are known
+        unindexed: set[bytes] = set()  # Blind indexes those rows would have
+        with ProcessPoolExecutor(workers) as pool, self.session_factory(
+            session
+        ) as sess:
+            encrypted = _bounded_map(
+                pool,
+                partial(_encrypt_batch, master_key, index_key),
+                batches,
+                window=2 * workers,
+            )
+            for batch in encrypted:
+                existing = self._database.existing_lookups(
+                    sess, [entry[LOOKUP_KEY] for entry in batch]
+                )
+                if self._database.unindexed:
+                    sites = {entry[SITE_KEY] for entry in batch} - checked_sites
+                    for row in self._database.get_unindexed(sess, list(sites)):
+                        uname = self._decrypt(
+                            row.salt,
+                            row.key_version,
+                            row.username,
+                            row.app_site,
+                            UNAME_KEY,
+                        )
+                        unindexed.add(self._lookup(row.app_site, uname))
+                    checked_sites |= sites
+                    existing |= unindexed
+                new: dict[bytes, dict] = {}
+                for entry in batch:
+                    if entry[LOOKUP_KEY] not in existing:
+                        new.setdefault(entry[LOOKUP_KEY], entry)
+                self._database.add_many(sess, list(new.values()))
+                added += len(new)
+                done += len(batch)
+                if checkpoint is not None:
+                    with open(checkpoint, "w") as f:
+                        json.dump({"done": done}, f)
+                if progress is not None:
+                    progress(len(batch))
+        if checkpoint is not None and os.path.isfile(checkpoint):
+            os.remove(checkpoint)  # Finished, a rerun should start over
+        logging.info(f"Added {added} entries, skipped {done - added} existing ones.")
+        self._invalidate()
+        self._refresh_snapshot(session)
+        return added
+
+    def export_iter(self, batch_size: int = 1000, session=None) -> Iterator[tuple]:
+        """Stream all entries as decrypted (site, username, password) tuples"""
+        with self.session_factory(session) as sess:
+            for row in self._database.iter_rows(sess, batch_size):
+                yield (row.app_site, *self._decrypt_row(row))
 
+    @trace.traced("export")
+    def export(self, path: str | os.PathLike, session=None) -> int:
+        """Write an encrypted backup of the whole vault to a new file
+        :return: number of exported entries
+        """
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with open(fd, "wb") as f:
+            count = write_backup(f, self._root_pw, self.export_iter(session=session))
+        logging.info(f"Exported {count} entries.")
+        return count
+
+    @trace.traced("restore")
+    def restore(
+        self,
+        path: str | os.PathLike,
+        password: bytes | None = None,
+        session=None,
+        **kwargs,
+    ) -> int:
+        """Add the entries of a backup that don't exist yet, see add_many
+        :param password: root password the backup was written under, the current
+            one by default
+        :return: number of added entries
+        """
+        with open(path, "rb") as f:
+            return self.add_many(
+                read_backup(f, password or self._root_pw), session=session, **kwargs
+            )
+
+    @trace.traced("update")
+    def update(
+        self, site_name: str, username: str, password: str, session=None
+    ) -> None:
+        """Replace the password of an entry"""
+        entry = encrypt_entry(
+            self._get_master_key(),
+            self._get_index_key(),
+            site_name,
+            username,
+            password,
+        )
+        with self.session_factory(session) as sess:
+            try:
+                self._database.update(sess, entry)
+            except EntryNotFoundError:
+                uname_token = self._find_unindexed(sess, site_name, username)
+                if uname_token is None:
+                    raise
+                self._database.update(sess, entry, uname_token)
+        logging.info("Entry updated.")
+        self._invalidate(site_name)
+        self._refresh_snapshot(session)
+
+    @trace.traced("remove")
     def remove(self, site_name: str, username: str, session=None) -> None:
         """Remove one entry"""
         with self.session_factory(session) as sess:
-            uname_tokens: DataFrame = self._database.get_uname(sess, site_name)
-            for i in uname_tokens.index:
-                if (
-                    username
-                    == decrypt_with_salt(
-                        self._root_pw,
-                        uname_tokens[SALT_KEY][i],
-                        uname_tokens[UNAME_KEY][i],
-                    ).decode()
-                ):
-                    self._database.remove(sess, site_name, uname_tokens[UNAME_KEY][i])
-                    logging.info("Entry removed.")
+            try:
+                self._database.remove_by_lookup(sess, self._lookup(site_name, username))
+            except EntryNotFoundError:
+                uname_token = self._find_unindexed(sess, site_name, username)
+                if uname_token is None:
+                    logging.error(f"Username {username} not found!")
                     return
-            logging.error(f"Username {username} not found!")
+                self._database.remove(sess, site_name, uname_token)
+            logging.info("Entry removed.")
+        self._invalidate(site_name)
+        self._refresh_snapshot(session)
+
+    @trace.traced("snapshot")
+    def write_snapshot(self, path: str | os.PathLike | None = None) -> int:
+        """Write an encrypted copy of the vault, answering reads while the
+        database is down, see butler.snapshot
+        :param path: defaults to the snapshot of the DB config
+        :return: number of copied entries
+        """
+        if path is None:
+            path = snapshot.snapshot_path(self._db_dir)
+        master_key = self._get_master_key()
+        with self.session_factory() as sess:
+            # Counted first, so that rows written meanwhile only make it look stale
+            changes = self._database.get_changes(sess)
+            rows = self._database.iter_rows(sess)
+            count = snapshot.write_snapshot(
+                path, master_key, self._kdf, changes, rows  # type: ignore[arg-type]
+            )
+        logging.info(f"Snapshot of {count} entries written.")
+        return count
+
+    def _refresh_snapshot(self, session=None) -> None:
+        """Bring an enabled snapshot up to date after a write. Writes in sessions
+        of the caller aren't committed yet, so those are left to the caller
+        """
+        if self._snapshot_path is None or session is not None:
+            return
+        try:
+            self.write_snapshot(self._snapshot_path)
+        except OSError as e:
+            logging.warning(f"Couldn't refresh the snapshot: {e}")
+
+    @trace.traced("migrate")
+    def migrate(self, session=None) -> int:
+        """Upgrade the schema and bring every row to the current key format
+        :return: number of rewritten rows
+        """
+        if self._database.needs_upgrade():
+            self._database.upgrade()
+        self._get_master_key()
+        with self.session_factory(session) as sess:
+            self._database.check_writable(sess)
+            self._check_duplicates(sess)
+            rows = self._database.get_outdated(sess, CURRENT_KEY_VERSION)
+            for row in rows:
+                entry = encrypt_entry(
+                    self._get_master_key(),
+                    self._get_index_key(),
+                    row.app_site,
+                    *self._decrypt_row(row),
+                )
+                del entry[SITE_KEY]
+                self._database.update_tokens(sess, row.id, entry)
+            self._database.delete_meta(sess, UNINDEXED_NAME)
+            sess.commit()
+            self._database.unindexed = False
+        logging.info(f"Migrated {len(rows)} entries.")
+        if rows:
+            self._invalidate()
+            self._refresh_snapshot(session)
+        return len(rows)
+
+    def count(self) -> int:
+        """Number of stored entries"""
+        with self.session_factory() as sess:
+            return self._database.count_entries(sess)
+
+    @trace.traced("rekey")
+    def rekey(
+        self,
+        new_password: bytes,
+        kdf: dict | None = None,
+        auth_file: str | os.PathLike = AUTH_PATH,
+        workers: int | None = None,
+        batch_size: int = 500,
+        progress: Callable[[int], None] | None = None,
+    ) -> int:
+        """Change the root password, re-encrypting every entry under the master key
+        it stretches into. Progress is kept in the vault, so an interrupted change
+        resumes when called again with the same new password. Until it's done, the
+        vault can't be used otherwise
+        :param kdf: how to stretch the new password, by default calibrated here
+            like the current one
+        :param auth_file: authentication file switched to the new password at the end
+        :param workers: encryption processes, defaults to the CPU count
+        :param batch_size: entries per transaction
+        :param progress: called with the number of entries re-encrypted in each batch
+        :return: number of re-encrypted entries
+        """
+        self._rekeying = True
+        old_key = self.vault_root_key()
+        with self.session_factory() as sess:
+            pending = self._database.get_meta(sess, REKEY_NAME)
+            state: dict
+            if pending is None:
+                self._check_duplicates(sess)  # Before the vault is locked for it
+                state = {"kdf": kdf or calibrate_kdf(old_key.kdf["name"]), "done": 0}
+            else:
+                state = json.loads(pending)
+            new_master_key = stretch(state["kdf"], new_password)
+            verifier = base64.b64encode(derive_verifier(new_master_key)).decode()
+            if pending is None:
+                state["verifier"] = verifier
+                self._database.set_meta(sess, REKEY_NAME, json.dumps(state).encode())
+                sess.commit()
+            elif not hmac.compare_digest(state["verifier"], verifier):
+                raise ValueError("A change to another root password is unfinished!")
+            elif state["done"]:
+                logging.info(f"Resuming after entry {state['done']}.")
+        new_index_key = derive_index_key(new_master_key)
+        rekeyed = 0
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(workers) as pool, self.session_factory() as sess:
+
+            def batches():
+                row_id = state["done"]
+                while rows := self._database.get_rows_after(sess, row_id, batch_size):
+                    row_id = rows[-1].id
+                    yield [
+                        (
+                            r.id,
+                            r.app_site,
+                            r.salt,
+                            r.key_version,
+                            r.username,
+                            r.password,
+                        )
+                        for r in rows
+                    ]
+
+            encrypted = _bounded_map(
+                pool,
+                partial(
+                    _rekey_batch,
+                    self._root_pw,
+                    old_key.master_key,
+                    new_master_key,
+                    new_index_key,
+                ),
+                batches(),
+                window=2 * workers,
+            )
+            for entries in encrypted:
+                self._database.update_tokens_many(sess, entries)
+                state["done"] = max(entries)
+                self._database.set_meta(sess, REKEY_NAME, json.dumps(state).encode())
+                sess.commit()
+                rekeyed += len(entries)
+                if progress is not None:
+                    progress(len(entries))
+        # The auth file goes first: after a crash here, the new password unlocks
+        # it and resumes the change with nothing left to re-encrypt
+        write_auth(auth_file, state["kdf"], new_master_key)
+        with self.session_factory() as sess:
+            self._database.set_kdf(sess, state["kdf"])
+            self._database.delete_meta(sess, MASTER_SALT_NAME)
+            self._database.delete_meta(sess, REKEY_NAME)
+            self._database.delete_meta(sess, UNINDEXED_NAME)
+            sess.commit()
+        self._database.unindexed = False
+        self._keys.clear()
+        for key in (self._master_key, self._index_key):
+            if key is not None:
+                key[:] = bytes(len(key))
+        self._root_pw = new_password
+        self._root_key = RootKey(new_password, state["kdf"], new_master_key)
+        self._kdf = state["kdf"]
+        self._master_key = bytearray(new_master_key)
+        self._index_key = bytearray(new_index_key)
+        self._site_index = None
+        self._invalidate()
+        self._rekeying = False
+        logging.info(f"Re-encrypted {rekeyed} entries under the new root password.")
+        self._refresh_snapshot()
+        return rekeyed
+
+
+def _batched(entries: Iterable, size: int, skip: int = 0):
+    """Yield lists of up to size entries, after skipping the first ones"""
+    batch: list = []
+    for i, entry in enumerate(entries):
+        if i < skip:
+            continue
+        batch.append(tuple(entry))
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _bounded_map(pool: Executor, fn: Callable, items: Iterable, window: int = 4):
+    """Like Executor.map, but only keeps a few items in flight at a time"""
+    pending: deque = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
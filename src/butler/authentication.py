@@ -1,25 +1,114 @@
+import base64
+import hmac
+import io
+import json
 import logging
 import os
 import pickle
+import tempfile
+from typing import NamedTuple
 
-from butler.util import derive_key, hash_pw
+from butler.util import SCRYPT_KDF, calibrate_kdf, derive_key, derive_verifier, stretch
 
-AUTH_PATH = os.path.expanduser("~/.pw_butler/auth.bin")
+AUTH_PATH = os.path.expanduser("~/.pw_butler/auth.json")
+LEGACY_AUTH_NAME = "auth.bin"  # Pickled, next to the auth file
+LEGACY_AUTH_PATH = os.path.join(os.path.dirname(AUTH_PATH), LEGACY_AUTH_NAME)
+AUTH_VERSION = 2
 
 
-def initialize(pw: bytes, auth_file=AUTH_PATH) -> None:
-    """Initialize the authentication file"""
-    salt, pw_hash = hash_pw(pw)
-    with open(auth_file, "wb") as f:
-        pickle.dump((salt, pw_hash), f)
+class RootKey(NamedTuple):
+    """Unlocked root password with the master key it stretches into"""
+
+    password: bytes
+    kdf: dict
+    master_key: bytes
+
+
+def initialize(pw: bytes, auth_file=AUTH_PATH, kdf: dict | None = None) -> RootKey:
+    """Initialize the authentication file
+    :param kdf: how to stretch the password, calibrated scrypt by default
+    """
+    if kdf is None:
+        kdf = calibrate_kdf(SCRYPT_KDF)
+    master_key = stretch(kdf, pw)
+    write_auth(auth_file, kdf, master_key)
     logging.info("Root password initialized.")
+    return RootKey(pw, kdf, master_key)
 
 
-def verify_password(pw: bytes, auth_file=AUTH_PATH) -> bool:
-    """Authenticate given password"""
+def write_auth(auth_file, kdf: dict, master_key: bytes) -> None:
+    """Write the authentication file for a stretched password"""
+    content = {
+        "version": AUTH_VERSION,
+        "kdf": kdf,
+        "verifier": base64.b64encode(derive_verifier(master_key)).decode(),
+    }
+    _dir = os.path.dirname(os.path.abspath(auth_file))
+    os.makedirs(_dir, exist_ok=True)
+    # Replaced in one step, so a crash leaves either the old or the new file
+    fd, tmp = tempfile.mkstemp(dir=_dir, prefix=".auth")  # Readable by us only
+    try:
+        with open(fd, "w") as f:
+            json.dump(content, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, auth_file)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def legacy_auth_path(auth_file) -> str:
+    """Where older versions kept the pickled auth file of an auth file"""
+    return os.path.join(os.path.dirname(os.path.abspath(auth_file)), LEGACY_AUTH_NAME)
+
+
+def unlock(pw: bytes, auth_file=AUTH_PATH, legacy_file=None) -> RootKey | None:
+    """Authenticate given password, stretching it once
+    :param legacy_file: pickled auth file of older versions, converted on success.
+        Defaults to the one next to the auth file
+    :return: the unlocked root key, None if the password is wrong
+    """
+    if legacy_file is None:
+        legacy_file = legacy_auth_path(auth_file)
     if not os.path.isfile(auth_file):
+        if os.path.isfile(legacy_file):
+            return _unlock_legacy(pw, legacy_file, auth_file)
         raise FileNotFoundError("Please initialize authentication first!")
-    with open(auth_file, "rb") as f:
-        salt, pw_hash = pickle.load(f)
+    with open(auth_file, "r") as f:
+        content = json.load(f)
+    if content.get("version") != AUTH_VERSION:
+        raise ValueError(f"Unsupported auth file version {content.get('version')}!")
+    master_key = stretch(content["kdf"], pw)
+    expected = base64.b64decode(content["verifier"])
+    if not hmac.compare_digest(derive_verifier(master_key), expected):
+        return None
+    return RootKey(pw, content["kdf"], master_key)
+
+
+def verify_password(pw: bytes, auth_file=AUTH_PATH) -> bool:
+    """Authenticate given password"""
+    return unlock(pw, auth_file, legacy_auth_path(auth_file)) is not None
+
+
+class _TupleUnpickler(pickle.Unpickler):
+    """Only rebuilds plain values, so old auth files can't run code"""
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError("Unexpected object in auth file!")
+
+
+def _unlock_legacy(pw: bytes, legacy_file, auth_file) -> RootKey | None:
+    """Verify against a pickled auth file and convert it to the current format"""
+    with open(legacy_file, "rb") as f:
+        salt, pw_hash = _TupleUnpickler(io.BytesIO(f.read())).load()
     new_hash = derive_key(salt, pw)
-    return new_hash == pw_hash
+    if not hmac.compare_digest(new_hash, pw_hash):
+        return None
+    # The old hash was stored in the clear, so it must not become the master key
+    kdf = calibrate_kdf(SCRYPT_KDF)
+    master_key = stretch(kdf, pw)
+    write_auth(auth_file, kdf, master_key)
+    os.unlink(legacy_file)
+    logging.info("Converted the authentication file to the current format.")
+    return RootKey(pw, kdf, master_key)
@@ -0,0 +1,80 @@
+# Backup layout: magic, salt, then length-prefixed Fernet tokens of JSON chunks.
+# The key comes from the root password and the salt, so a backup can be restored
+# into any vault with the same root password. Chunks are numbered and an empty
+# chunk marks the end, so reordered or truncated backups are detected.
+
+import json
+import os
+import struct
+from typing import BinaryIO, Iterable, Iterator
+
+from butler.util import decrypt_with_key, derive_key, encrypt_with_key
+
+MAGIC = b"PWBUTLER-BACKUP1"
+SALT_SIZE = 16
+CHUNK_SIZE = 500  # Entries per chunk
+_LENGTH = struct.Struct(">I")
+
+
+class BackupError(ValueError):
+    """A backup file is malformed or doesn't match the password"""
+
+
+def write_backup(
+    f: BinaryIO, root_pw: bytes, entries: Iterable[tuple], chunk_size=CHUNK_SIZE
+) -> int:
+    """Stream (site, username, password) entries into a backup file
+    :return: number of written entries
+    """
+    salt = os.urandom(SALT_SIZE)
+    key = derive_key(salt, root_pw)
+    f.write(MAGIC + salt)
+    seq = total = 0
+    chunk: list = []
+
+    def flush():
+        nonlocal seq
+        payload = json.dumps({"seq": seq, "entries": chunk}).encode()
+        token = encrypt_with_key(key, payload)
+        f.write(_LENGTH.pack(len(token)) + token)
+        seq += 1
+
+    for entry in entries:
+        chunk.append(list(entry))
+        total += 1
+        if len(chunk) == chunk_size:
+            flush()
+            chunk = []
+    if chunk:
+        flush()
+        chunk = []
+    flush()  # Empty end marker
+    return total
+
+
+def read_backup(f: BinaryIO, root_pw: bytes) -> Iterator[tuple]:
+    """Stream (site, username, password) entries back from a backup file"""
+    header = f.read(len(MAGIC) + SALT_SIZE)
+    if not header.startswith(MAGIC) or len(header) != len(MAGIC) + SALT_SIZE:
+        raise BackupError("Not a Butler backup file!")
+    key = derive_key(header[-SALT_SIZE:], root_pw)
+    seq = 0
+    while True:
+        raw_length = f.read(_LENGTH.size)
+        if len(raw_length) != _LENGTH.size:
+            raise BackupError("Backup file is truncated!")
+        (length,) = _LENGTH.unpack(raw_length)
+        token = f.read(length)
+        if len(token) != length:
+            raise BackupError("Backup file is truncated!")
+        try:
+            chunk = json.loads(decrypt_with_key(key, token))
+        except Exception as e:
+            raise BackupError("Wrong password or corrupted backup!") from e
+        if chunk["seq"] != seq:
+            raise BackupError("Backup chunks are out of order!")
+        if not chunk["entries"]:
+            return
+        for entry in chunk["entries"]:
+            yield tuple(entry)
+        seq += 1
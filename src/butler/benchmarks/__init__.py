@@ -0,0 +1,4 @@
+from butler.benchmarks.runner import Result, format_table, report
+from butler.benchmarks.suite import BACKENDS, run_suite
+
+__all__ = ["BACKENDS", "Result", "format_table", "report", "run_suite"]
@@ -0,0 +1,27 @@
+import subprocess
+import sys
+
+from butler.benchmarks.runner import Result, measure
+
+BACKEND = "cli"
+# Commands that start without touching the vault, timed in a fresh interpreter
+COMMANDS = {"cold_start_help": ["--help"], "cold_start_get_help": ["get", "--help"]}
+
+
+def run(quick: bool = False) -> list[Result]:
+    """Start up time of the command line interface"""
+    n = 2 if quick else 10
+    results = []
+    for name, args in COMMANDS.items():
+        cmd = [sys.executable, "-c", "from butler.ui import cli; cli()", *args]
+        results.append(
+            measure(
+                name,
+                BACKEND,
+                lambda _, cmd=cmd: subprocess.run(
+                    cmd, check=True, stdout=subprocess.DEVNULL
+                ),
+                n,
+            )
+        )
+    return results
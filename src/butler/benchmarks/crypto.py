@@ -0,0 +1,66 @@
+import os
+
+from butler.app import encrypt_entry
+from butler.benchmarks.runner import Result, measure
+from butler.util import (
+    AEAD_KEY_VERSION,
+    HKDF_KEY_VERSION,
+    calibrate_kdf,
+    decrypt_token,
+    decrypt_with_key,
+    derive_aead_key,
+    derive_index_key,
+    derive_key,
+    derive_row_key,
+    encrypt_with_key,
+    seal,
+    stretch,
+    token_aad,
+)
+
+BACKEND = "crypto"
+
+
+def run(quick: bool = False) -> list[Result]:
+    """Key derivation and per-entry encryption"""
+    n_kdf, n_op = (2, 200) if quick else (5, 2000)
+    pw, salt = b"benchmark password", os.urandom(16)
+    kdf = calibrate_kdf()
+    master_key = stretch(kdf, pw)
+    index_key = derive_index_key(master_key)
+    row_key = derive_row_key(master_key, salt)
+    token = encrypt_with_key(row_key, b"secret")
+    aad = token_aad("site", "password")
+    sealed = seal(derive_aead_key(master_key, salt), b"secret", aad)
+
+    def decrypt_row(derive, version: int, token: bytes) -> bytes:
+        """What a lookup does per row: derive the row key, then decrypt"""
+        return decrypt_token(derive(master_key, salt), version, token, aad)
+
+    return [
+        measure("kdf_pbkdf2_legacy", BACKEND, lambda _: derive_key(salt, pw), n_kdf),
+        measure(f"kdf_{kdf['name']}", BACKEND, lambda _: stretch(kdf, pw), n_kdf),
+        measure(
+            "row_key_hkdf", BACKEND, lambda _: derive_row_key(master_key, salt), n_op
+        ),
+        measure("encrypt", BACKEND, lambda _: encrypt_with_key(row_key, b"s"), n_op),
+        measure("decrypt", BACKEND, lambda _: decrypt_with_key(row_key, token), n_op),
+        measure(
+            "decrypt_row_fernet",
+            BACKEND,
+            lambda _: decrypt_row(derive_row_key, HKDF_KEY_VERSION, token),
+            n_op,
+        ),
+        measure(
+            "decrypt_row_aead",
+            BACKEND,
+            lambda _: decrypt_row(derive_aead_key, AEAD_KEY_VERSION, sealed),
+            n_op,
+        ),
+        measure(
+            "encrypt_entry",
+            BACKEND,
+            lambda i: encrypt_entry(master_key, index_key, "site", f"u{i}", "pw"),
+            n_op,
+        ),
+    ]
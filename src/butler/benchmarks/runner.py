@@ -0,0 +1,67 @@
+import math
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Callable, NamedTuple
+
+REPORT_VERSION = 1  # Bump when the JSON layout changes
+
+
+class Result(NamedTuple):
+    """Timings of one benchmark"""
+
+    name: str
+    backend: str
+    n: int
+    ops_per_sec: float
+    p50_ms: float
+    p99_ms: float
+
+
+def percentile(timings: list[float], q: float) -> float:
+    """Nearest-rank percentile of sorted timings"""
+    rank = max(1, math.ceil(q / 100 * len(timings)))
+    return timings[rank - 1]
+
+
+def measure(name: str, backend: str, fn: Callable, n: int) -> Result:
+    """Call fn n times and summarize its latency. fn gets the iteration number"""
+    timings = []
+    for i in range(n):
+        start = time.perf_counter()
+        fn(i)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return Result(
+        name,
+        backend,
+        n,
+        n / sum(timings) if sum(timings) else math.inf,
+        percentile(timings, 50) * 1000,
+        percentile(timings, 99) * 1000,
+    )
+
+
+def report(results: list[Result]) -> dict:
+    """Machine readable report, for tracking regressions across runs"""
+    return {
+        "version": REPORT_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "results": [r._asdict() for r in results],
+    }
+
+
+def format_table(results: list[Result]) -> str:
+    """Human readable summary of results"""
+    lines = [
+        f"{'benchmark':<28} {'backend':<9} {'n':>5} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9}"
+    ]
+    for r in results:
+        lines.append(
+            f"{r.name:<28} {r.backend:<9} {r.n:>5} {r.ops_per_sec:>10.1f} "
+            f"{r.p50_ms:>9.3f} {r.p99_ms:>9.3f}"
+        )
+    return "\n".join(lines)
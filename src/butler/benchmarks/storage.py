@@ -0,0 +1,109 @@
+import os
+import shutil
+from configparser import ConfigParser
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Iterator
+
+from sqlalchemy import text
+
+from butler import migrations
+from butler.app import Butler
+from butler.benchmarks.runner import Result, measure
+from butler.config import (
+    DB_CONF_PATH,
+    DB_PW_FILE,
+    INI_NAME,
+    INI_SECTION,
+    SCHEMA_KEY,
+    SQLITE_BACKEND,
+    SQLITE_MEMORY,
+    SQLITE_PATH_KEY,
+    config_db,
+)
+from butler.engines import dispose_engines, get_engine
+
+MEMORY_BACKEND = "memory"
+POSTGRES_BACKEND = "postgres"
+BENCH_PW = b"benchmark password"
+
+
+def _set_options(config_dir: str, **options) -> None:
+    config = ConfigParser()
+    path = Path(config_dir) / INI_NAME
+    config.read(path)
+    config[INI_SECTION].update(options)
+    with open(path, "w") as f:
+        config.write(f)
+
+
+@contextmanager
+def memory_config() -> Iterator[str]:
+    """Config of a throwaway in-memory SQLite database"""
+    with TemporaryDirectory() as _dir:
+        config_db(password="", config_dir=_dir, backend=SQLITE_BACKEND)
+        _set_options(_dir, **{SQLITE_PATH_KEY: SQLITE_MEMORY})
+        try:
+            yield _dir
+        finally:
+            dispose_engines()
+
+
+@contextmanager
+def postgres_config(config_dir=DB_CONF_PATH) -> Iterator[str]:
+    """Config of a scratch schema in the configured Postgres, dropped afterwards,
+    so that the vault itself is never touched
+    """
+    schema = f"butler_bench_{os.getpid()}"
+    with TemporaryDirectory() as _dir:
+        for name in (INI_NAME, DB_PW_FILE):
+            shutil.copy(Path(config_dir) / name, Path(_dir) / name)
+        _set_options(_dir, **{SCHEMA_KEY: schema})
+        with get_engine(config_dir).begin() as conn:
+            conn.execute(text(f"CREATE SCHEMA {schema}"))
+        try:
+            with get_engine(_dir).begin() as conn:
+                migrations.create_all(conn)
+            yield _dir
+        finally:
+            dispose_engines()  # Drops the pooled connections using the schema
+            with get_engine(config_dir).begin() as conn:
+                conn.execute(text(f"DROP SCHEMA {schema} CASCADE"))
+            dispose_engines()
+
+
+def run(config_dir: str, backend: str, quick: bool = False) -> list[Result]:
+    """Adding, looking up and listing entries, with several entries per site"""
+    sizes = (1, 100) if quick else (1, 100, 10_000)
+    n = 20 if quick else 200
+    results = []
+    with Butler(BENCH_PW, db_dir=config_dir) as app:
+        app.retrieve_all()  # Settle the connection and the master key first
+        app.add("warm up", "user", "pw")
+        results.append(
+            measure("add", backend, lambda i: app.add("add", f"user{i}", "pw"), n)
+        )
+        for size in sizes:
+            site = f"site_{size}"
+            app.add_many((site, f"user{i}", "pw") for i in range(size))
+            results.append(
+                measure(
+                    f"lookup_pword_{size}_per_site",
+                    backend,
+                    lambda i, site=site, size=size: app.retrieve_pword(
+                        site, f"user{i % size}"
+                    ),
+                    n,
+                )
+            )
+            results.append(
+                measure(
+                    f"list_unames_{size}_per_site",
+                    backend,
+                    lambda _, site=site: app.retrieve_uname(site),
+                    max(3, min(n, 2000 // size)),
+                )
+            )
+        results.append(measure("list_sites", backend, lambda _: app.retrieve_all(), n))
+    return results
@@ -0,0 +1,27 @@
+import logging
+
+from butler.benchmarks import cli, crypto, storage
+from butler.benchmarks.runner import Result
+from butler.config import DB_CONF_PATH
+
+BACKENDS = (storage.MEMORY_BACKEND, storage.POSTGRES_BACKEND)
+
+
+def run_suite(
+    backends=(storage.MEMORY_BACKEND,), quick: bool = False, config_dir=DB_CONF_PATH
+) -> list[Result]:
+    """Run every benchmark, the database ones against each of the backends
+    :param config_dir: DB config of the Postgres backend
+    """
+    results = crypto.run(quick)
+    for backend in backends:
+        logging.info(f"Benchmarking the {backend} backend.")
+        if backend == storage.MEMORY_BACKEND:
+            scratch = storage.memory_config()
+        elif backend == storage.POSTGRES_BACKEND:
+            scratch = storage.postgres_config(config_dir)
+        else:
+            raise ValueError(f"Unknown backend {backend}!")
+        with scratch as scratch_dir:
+            results += storage.run(scratch_dir, backend, quick)
+    return results + cli.run(quick)
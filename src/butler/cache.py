@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy.engine import Engine
+
+from butler.migrations import NOTIFY_CHANNEL
+
+# Decrypted credentials kept in memory by long running Butlers such as the agent.
+# Entries are keyed by site first, so that a change of a site drops all of its
+# entries. On Postgres, changes of every client are learned from notifications
+# (see butler.migrations.CHANGE_NOTIFY), and nothing is cached while they can't
+# be received.
+
+CACHE_TTL = 300.0  # Seconds a decrypted entry is kept
+CACHE_SIZE = 1024
+LISTEN_TIMEOUT = 1.0  # Seconds between checks whether to stop listening
+RECONNECT_DELAY = 5.0
+
+
+class CredentialCache:
+    """Decrypted values by (site, ...) key, dropped when expired, when their site
+    changes or when least recently used beyond the size. Values are held as
+    bytearrays and zeroed when dropped; the strings handed out are not
+    :param ttl: seconds an entry is kept
+    :param maxsize: maximum number of entries
+    """
+
+    def __init__(self, ttl: float = CACHE_TTL, maxsize: int = CACHE_SIZE):
+        if maxsize < 1:
+            raise ValueError("Cache size must be at least 1!")
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple, tuple[float, list[bytearray]]] = OrderedDict()
+        self._by_site: dict[str, set[tuple]] = {}
+        self._generation = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def generation(self) -> int:
+        """Increases whenever entries are invalidated, see put"""
+        return self._generation
+
+    def _drop(self, key: tuple) -> None:
+        _, values = self._entries.pop(key)
+        for value in values:
+            value[:] = bytes(len(value))
+        keys = self._by_site[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._by_site[key[0]]
+
+    def get(self, key: tuple) -> list[str] | None:
+        """Cached values, None if missing or expired"""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return [value.decode() for value in item[1]]
+
+    def put(self, key: tuple, values: list[str], generation: int) -> None:
+        """Cache values read from the database
+        :param generation: the generation before reading, values read while
+            something was invalidated might be stale and aren't cached
+        """
+        with self._lock:
+            if generation != self._generation:
+                return
+            if key in self._entries:
+                self._drop(key)
+            expires = time.monotonic() + self.ttl
+            self._entries[key] = (expires, [bytearray(v.encode()) for v in values])
+            self._by_site.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, site: str) -> None:
+        """Drop the entries of a site"""
+        with self._lock:
+            self._generation += 1
+            for key in list(self._by_site.get(site, ())):
+                self._drop(key)
+
+    def clear(self) -> None:
+        """Drop all entries"""
+        with self._lock:
+            self._generation += 1
+            for key in list(self._entries):
+                self._drop(key)
+
+
+class ChangeListener(threading.Thread):
+    """Invalidates cached sites as Postgres notifies of their changes, over a
+    connection of its own
+    :param engine: engine of the primary database
+    :param cache: cache to invalidate
+    """
+
+    def __init__(self, engine: Engine, cache: CredentialCache):
+        super().__init__(name="butler-change-listener", daemon=True)
+        self._engine = engine
+        self._cache = cache
+        self._stopping = threading.Event()
+        self.listening = threading.Event()  # Whether changes are being noticed
+
+    def run(self) -> None:
+        dialect = self._engine.dialect
+        dbapi = dialect.loaded_dbapi
+        cargs, cparams = dialect.create_connect_args(self._engine.url)
+        while not self._stopping.is_set():
+            try:
+                with dbapi.connect(*cargs, **cparams, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                    self._cache.clear()  # Changes until now went unnoticed
+                    self.listening.set()
+                    while not self._stopping.is_set():
+                        for notify in conn.notifies(timeout=LISTEN_TIMEOUT):
+                            if notify.payload:
+                                self._cache.invalidate(notify.payload)
+                            else:  # Site too long to be named
+                                self._cache.clear()
+            except dbapi.Error as e:
+                logging.warning(f"Not caching, change notifications failed: {e}")
+            finally:
+                self.listening.clear()
+                self._cache.clear()
+            self._stopping.wait(RECONNECT_DELAY)
+
+    def stop(self) -> None:
+        """Stop listening and wait for the thread to end"""
+        self._stopping.set()
+        self.join(2 * LISTEN_TIMEOUT)
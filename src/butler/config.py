@@ -0,0 +1,97 @@
+import os
+from configparser import ConfigParser, SectionProxy
+from pathlib import Path
+from typing import Sequence
+
+# Kept free of heavy imports, so that the CLI can read the config cheaply
+
+DB_CONF_PATH = Path(os.path.expanduser("~/.pw_butler/db"))
+
+BACKEND_KEY = "backend"
+HOST_KEY = "host"
+DB_NAME_KEY = "db_name"
+DB_USER_KEY = "user"
+DB_PW_FILE = "password"
+DB_PORT_KEY = "port"
+SQLITE_PATH_KEY = "path"
+SCHEMA_KEY = "schema"  # Optional Postgres schema, public by default
+POOL_SIZE_KEY = "pool_size"  # Optional connection pool settings
+POOL_RECYCLE_KEY = "pool_recycle"
+POOL_PRE_PING_KEY = "pool_pre_ping"
+AUTO_UP_KEY = "auto_up"  # Optional, start the service when a command needs it
+SNAPSHOT_KEY = "snapshot"  # Optional, keep an encrypted copy for offline reads
+REPLICAS_KEY = "replicas"  # Optional, comma separated read replica endpoints
+
+POSTGRES_BACKEND = "postgres"
+SQLITE_BACKEND = "sqlite"
+BACKENDS = (POSTGRES_BACKEND, SQLITE_BACKEND)
+SQLITE_FILE = "butler.db"
+SQLITE_MEMORY = ":memory:"
+
+INI_NAME = ".ini"
+INI_SECTION = "DEFAULT"
+
+
+def config_db(
+    password: str,
+    db_name: str = "postgres",
+    user: str = "postgres",
+    host: str = "localhost",
+    port: int = 5432,
+    config_dir: str | os.PathLike = DB_CONF_PATH,
+    backend: str = POSTGRES_BACKEND,
+    replicas: Sequence[str] = (),
+) -> bool:
+    """Initialize the DB config file
+    :param backend: postgres (served by docker) or sqlite (embedded, no service)
+    :param replicas: read replicas of the database, as host[:port] for postgres
+        (same database and credentials) or as paths of copies for sqlite
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}!")
+    os.makedirs(config_dir, mode=0o700, exist_ok=True)
+    os.chmod(config_dir, 0o700)  # Holds the embedded database too
+    _dir = Path(config_dir)
+    config = ConfigParser()
+    if backend == SQLITE_BACKEND:
+        config[INI_SECTION] = {
+            BACKEND_KEY: backend,
+            SQLITE_PATH_KEY: str(_dir / SQLITE_FILE),
+        }
+    else:
+        config[INI_SECTION] = {
+            BACKEND_KEY: backend,
+            HOST_KEY: host,
+            DB_PORT_KEY: str(port),
+            DB_NAME_KEY: db_name,
+            DB_USER_KEY: user,
+        }
+    if replicas:
+        config[INI_SECTION][REPLICAS_KEY] = ", ".join(replicas)
+    with open(_dir / INI_NAME, "w") as f:
+        config.write(f)
+    os.chmod(_dir / INI_NAME, 0o640)
+    with open(_dir / DB_PW_FILE, "w") as f:
+        f.write(password)
+    os.chmod(_dir / DB_PW_FILE, 0o640)
+    return True
+
+
+def read_config(config_dir: str | os.PathLike = DB_CONF_PATH) -> SectionProxy:
+    """Read the DB config file written by config_db"""
+    if not os.path.isdir(config_dir):
+        raise NotADirectoryError("Initialize DB config first!")
+    parser = ConfigParser()
+    parser.read(Path(config_dir) / INI_NAME)
+    return parser[INI_SECTION]
+
+
+def get_backend(config_dir: str | os.PathLike = DB_CONF_PATH) -> str:
+    """Storage backend of the DB config, postgres for configs predating backends"""
+    return read_config(config_dir).get(BACKEND_KEY, POSTGRES_BACKEND)
+
+
+def get_replicas(config_dir: str | os.PathLike = DB_CONF_PATH) -> list[str]:
+    """Read replica endpoints of the DB config"""
+    replicas = read_config(config_dir).get(REPLICAS_KEY, "")
+    return [endpoint.strip() for endpoint in replicas.split(",") if endpoint.strip()]
@@ -1,61 +1,131 @@
+import json
+import logging
 import os
 import time
 from abc import ABC
-from configparser import ConfigParser
 from contextlib import contextmanager
-from pathlib import Path
-from typing import Any, Union
+from typing import Any, Callable, NamedTuple, TypeVar, Union
 
-import pandas as pd
-import sqlalchemy as sa
-from sqlalchemy import Connection, MetaData, delete, insert, select
-from sqlalchemy.engine import URL, Row
+from sqlalchemy import (
+    Connection,
+    MetaData,
+    bindparam,
+    case,
+    column,
+    delete,
+    func,
+    literal,
+    or_,
+    select,
+    true,
+    update,
+    values,
+)
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session, sessionmaker
 
-DB_CONF_PATH = Path(os.path.expanduser("~/.pw_butler/db"))
-CRED_TABLE = "credential"
+from butler import migrations, schema, trace
+from butler.config import (  # noqa: F401
+    BACKEND_KEY,
+    DB_CONF_PATH,
+    DB_NAME_KEY,
+    DB_PORT_KEY,
+    DB_PW_FILE,
+    DB_USER_KEY,
+    HOST_KEY,
+    INI_NAME,
+    INI_SECTION,
+    POSTGRES_BACKEND,
+    SQLITE_BACKEND,
+    SQLITE_PATH_KEY,
+    config_db,
+    get_replicas,
+    read_config,
+)
+from butler.engines import (  # noqa: F401
+    configure_sqlite,
+    dispose_engines,
+    get_engine,
+    pool_metrics,
+    protect_sqlite,
+    read_db_url,
+)
+from butler.routing import READ_OWN_WRITES, ReplicaPool, RoutingSession
+from butler.search import EXACT, FUZZY, PREFIX, SEARCH_LIMIT, SUBSTRING, escape_like
+from butler.util import legacy_kdf
 
-HOST_KEY = "host"
-DB_NAME_KEY = "db_name"
-DB_USER_KEY = "user"
-DB_PW_FILE = "password"
-DB_PORT_KEY = "port"
+CRED_TABLE = "credential"
+VAULT_TABLE = "vault"
 
 SITE_KEY = "app_site"
 SALT_KEY = "salt"
 UNAME_KEY = "username"
 PW_KEY = "password"
+VERSION_KEY = "key_version"
+LOOKUP_KEY = "lookup"
+
+MASTER_SALT_NAME = "master_salt"  # Of vaults predating KDF choice
+KDF_NAME = "kdf"  # JSON description of how the master key is stretched
+REKEY_NAME = "rekey"  # JSON state of an unfinished root password change
+UNINDEXED_NAME = "unindexed"  # Set while rows without blind index may be stored
+REKEY_PENDING = "A root password change is unfinished, run butler rekey!"
+
+CONNECT_DEADLINE = 10.0  # Seconds to wait for a starting database service
+T = TypeVar("T")
+
+
+class EntryExistsError(ValueError):
+    """An entry for the site and username is already stored"""
+
+
+class EntryNotFoundError(ValueError):
+    """No entry matches the site and username"""
+
+
+class UsernameToken(NamedTuple):
+    """Encrypted username of a credential row"""
+
+    username: bytes
+    salt: bytes
+    key_version: int
 
-INI_NAME = ".ini"
-INI_SECTION = "DEFAULT"
-
-
-def config_db(
-    password: str,
-    db_name: str = "postgres",
-    user: str = "postgres",
-    host: str = "localhost",
-    port: int = 5432,
-    config_dir: str | os.PathLike = DB_CONF_PATH,
-) -> bool:
-    """Initialize the DB config file"""
-    os.makedirs(config_dir, exist_ok=True)
-    config = ConfigParser()
-    config[INI_SECTION] = {
-        HOST_KEY: host,
-        DB_PORT_KEY: str(port),
-        DB_NAME_KEY: db_name,
-        DB_USER_KEY: user,
-    }
-    _dir = Path(config_dir)
-    with open(_dir / INI_NAME, "w") as f:
-        config.write(f)
-    os.chmod(_dir / INI_NAME, 0o640)
-    with open(_dir / DB_PW_FILE, "w") as f:
-        f.write(password)
-    os.chmod(_dir / DB_PW_FILE, 0o640)
-    return True
+
+class PasswordToken(NamedTuple):
+    """Encrypted password of a credential row"""
+
+    password: bytes
+    salt: bytes
+    key_version: int
+
+
+def to_dataframe(rows: list):
+    """Export rows returned by Database as a pandas DataFrame (requires pandas)"""
+    try:
+        import pandas as pd
+    except ImportError as e:
+        raise ImportError(
+            "DataFrame export requires pandas: pip install pw-butler[pandas]"
+        ) from e
+    return pd.DataFrame([row._asdict() for row in rows])
+
+
+def retry_connect(probe: Callable[[], T], deadline: float) -> T:
+    """Run a probe until the database accepts connections, backing off
+    exponentially until the deadline in seconds has passed
+    """
+    give_up = time.monotonic() + deadline
+    delay = 0.05
+    while True:
+        try:
+            return probe()
+        except OperationalError:
+            remaining = give_up - time.monotonic()
+            if remaining <= 0:
+                raise
+            logging.info("Database not ready yet. Retrying...")
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1.0)
 
 
 class DatabaseApplication(ABC):
@@ -63,20 +133,31 @@ class DatabaseApplication(ABC):
 
     def __init__(self, config_dir=DB_CONF_PATH):
         self._database = Database(config_dir)
+        self._wrote_at = -READ_OWN_WRITES  # Monotonic time of our last write
 
     def __enter__(self):
-        self._database.reflect()
+        if self._database.prepare() < migrations.SCHEMA_VERSION:
+            self._database.upgrade()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._database.close()
 
     @contextmanager
-    def session_factory(self, session=None):
-        """Return either externally provided or newly created session"""
+    def session_factory(self, session=None, primary: bool = False):
+        """Return either externally provided or newly created session
+        :param primary: whether a new session reads from the primary even when
+            read replicas are configured. It does anyway for a while after we
+            wrote, as replicas may lag behind
+        """
         created = False
+        if time.monotonic() - self._wrote_at < READ_OWN_WRITES:
+            primary = True
         if session is None:
-            session = self._database.Session()
+            factory = (
+                self._database.PrimarySession if primary else self._database.Session
+            )
+            session = factory()
             created = True
         try:
             yield session
@@ -84,6 +165,8 @@ class DatabaseApplication(ABC):
             session.rollback()
             raise e
         finally:
+            if getattr(session, "wrote", False):
+                self._wrote_at = time.monotonic()
             if created:
                 session.close()
 
@@ -91,55 +174,195 @@ class DatabaseApplication(ABC):
 class Database:
     """Database class
     :param config_dir: location to store database config
+    :param connect_deadline: seconds to wait for the database service to come up
     """
 
-    max_retry = 5
-
-    def __init__(self, config_dir: str | os.PathLike = DB_CONF_PATH):
-        if not os.path.isdir(config_dir):
-            raise NotADirectoryError("Initialize DB config first!")
-        parser = ConfigParser()
-        _dir = Path(config_dir)
-        parser.read(_dir / INI_NAME)
-        with open(_dir / DB_PW_FILE, "r") as f:
-            db_pw = f.read()
-        url = URL.create(
-            drivername="postgresql+psycopg",
-            host=parser.get(INI_SECTION, HOST_KEY),
-            port=parser.getint(INI_SECTION, DB_PORT_KEY),
-            database=parser.get(INI_SECTION, DB_NAME_KEY),
-            username=parser.get(INI_SECTION, DB_USER_KEY),
-            password=db_pw,
-        )
-        self.engine = sa.create_engine(url)  # An engine for connection
-        self.Session = sessionmaker(
-            self.engine
-        )  # A convenience session factory for production (NOT for testing)
-        self._cred_table: Any = None  # Placeholder for our credential table
+    def __init__(
+        self,
+        config_dir: str | os.PathLike = DB_CONF_PATH,
+        connect_deadline: float = CONNECT_DEADLINE,
+    ):
+        self.engine = get_engine(config_dir)  # Shared within the process
+        self.replicas = ReplicaPool(
+            [get_engine(config_dir, endpoint) for endpoint in get_replicas(config_dir)]
+        )
+        self.PrimarySession = sessionmaker(self.engine)
+        self.Session: sessionmaker
+        if self.replicas:  # Sessions read from replicas until they write
+            self.Session = sessionmaker(
+                self.engine, class_=RoutingSession, replicas=self.replicas
+            )
+        else:
+            # A convenience session factory for production (NOT for testing)
+            self.Session = self.PrimarySession
+        self.connect_deadline = connect_deadline
+        # Declared in butler.schema; the schema version guards against drift
+        self._cred_table: Any = schema.credential
+        self._vault_table: Any = schema.vault
+        self._trigram: bool | None = None  # Whether pg_trgm is usable
+        self.kdf: dict | None = None  # Of the key written entries are under
+        self._kdf_value: bytes | None = None  # As stored, for comparing in writes
+        self.unindexed = True  # Whether rows without blind index may be stored
 
     def close(self):
-        """Close connections"""
-        self.engine.dispose()
+        """Release the database. Its engine stays pooled for reuse in this process,
+        see dispose_engines
+        """
+
+    def pool_metrics(self) -> dict:
+        """Checkout counters of the shared connection pool"""
+        return pool_metrics(self.engine)
+
+    @property
+    def embedded(self) -> bool:
+        """Whether the database is an embedded file rather than a service"""
+        return self.engine.dialect.name == "sqlite"
 
-    def __del__(self):
-        """Destructor"""
-        if hasattr(self, "engine"):
-            self.close()
+    @trace.traced("db.prepare")
+    def prepare(self) -> int:
+        """Wait for the database and return its schema version. Creates the schema
+        of a new embedded database
+        """
+        if self.embedded:
+            with self.engine.begin() as conn:
+                migrations.create_all(conn)
+                return migrations.get_version(conn)
+        return retry_connect(self._read_version, self.connect_deadline)
 
-    def reflect(self) -> None:
-        """Reflect tables from our database"""
+    def _read_version(self) -> int:
+        with self.engine.connect() as conn:
+            return migrations.get_version(conn)
+
+    def reflect(self) -> MetaData:
+        """Reflect the live schema, for diagnostics"""
         meta = MetaData()
-        for k in range(self.max_retry):
-            try:
-                meta.reflect(bind=self.engine)
-            except OperationalError as e:
-                if k == self.max_retry - 1:
-                    raise e
-                print("Reflecting failed. Database may not be ready yet. Retrying...")
-                time.sleep(1)
-        if CRED_TABLE not in meta.tables:
-            raise KeyError(f"Didn't find {CRED_TABLE} in database!")
-        self._cred_table = meta.tables[CRED_TABLE]
+        meta.reflect(bind=self.engine)
+        return meta
+
+    def _insert(self, table):
+        """Dialect specific INSERT, supporting ON CONFLICT"""
+        if self.embedded:
+            return sqlite.insert(table)
+        return postgresql.insert(table)
+
+    def needs_upgrade(self) -> bool:
+        """Whether the database schema predates this Butler"""
+        return self._read_version() < migrations.SCHEMA_VERSION
+
+    @trace.traced("db.upgrade")
+    def upgrade(self) -> None:
+        """Upgrade an older schema in place"""
+        current = self._read_version()
+        with self.engine.begin() as conn:
+            migrations.upgrade(conn, current)
+
+    def init_meta(self, conn: Union[Session, Connection], name: str, value: bytes):
+        """Store a vault metadata value unless already set, and return the stored one"""
+        stmt = (
+            self._insert(self._vault_table)
+            .values(name=name, value=value)
+            .on_conflict_do_nothing()
+        )
+        conn.execute(stmt)
+        conn.commit()
+        query = select(self._vault_table.c.value).where(
+            self._vault_table.c.name == name
+        )
+        return conn.execute(query).scalar_one()
+
+    def get_meta(self, conn: Union[Session, Connection], name: str) -> bytes | None:
+        """Vault metadata value, None if not set"""
+        query = select(self._vault_table.c.value).where(
+            self._vault_table.c.name == name
+        )
+        return conn.execute(query).scalar_one_or_none()
+
+    def set_meta(self, conn: Union[Session, Connection], name: str, value: bytes):
+        """Store a vault metadata value, replacing any old one, without committing"""
+        stmt = self._insert(self._vault_table).values(name=name, value=value)
+        conn.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[self._vault_table.c.name], set_={"value": value}
+            )
+        )
+
+    def delete_meta(self, conn: Union[Session, Connection], name: str):
+        """Drop a vault metadata value, without committing"""
+        conn.execute(delete(self._vault_table).where(self._vault_table.c.name == name))
+
+    def _read_meta(
+        self, conn: Union[Session, Connection], names: list[str], lock: bool = False
+    ) -> dict:
+        """Vault metadata values by name
+        :param lock: keep them from changing until the transaction ends, which
+            also reads them from the primary
+        """
+        query = select(self._vault_table.c.name, self._vault_table.c.value).where(
+            self._vault_table.c.name.in_(names)
+        )
+        if lock:
+            query = query.with_for_update(read=True)
+        return dict(conn.execute(query).all())
+
+    def get_kdf(
+        self, conn: Union[Session, Connection], default: dict, rekeying: bool = False
+    ) -> dict:
+        """KDF of the vault master key. Older vaults keep the KDF of their master
+        salt, new ones adopt the default. Also remembered as the key writes have
+        to be under, see _writable, and whether rows without blind index are to
+        be looked for
+        :param rekeying: whether the caller is the one changing the root password
+        """
+        names = [KDF_NAME, MASTER_SALT_NAME, REKEY_NAME, UNINDEXED_NAME]
+        meta = self._read_meta(conn, names)
+        if REKEY_NAME in meta and not rekeying:
+            raise RuntimeError(REKEY_PENDING)
+        self.unindexed = UNINDEXED_NAME in meta
+        if KDF_NAME in meta:
+            self._kdf_value = meta[KDF_NAME]
+        else:
+            if MASTER_SALT_NAME in meta:
+                default = legacy_kdf(meta[MASTER_SALT_NAME])
+            value = json.dumps(default).encode()
+            self._kdf_value = self.init_meta(conn, KDF_NAME, value)
+        self.kdf = json.loads(self._kdf_value)  # type: ignore[arg-type]
+        return self.kdf
+
+    def set_kdf(self, conn: Union[Session, Connection], kdf: dict):
+        """Store the KDF of a new master key, without committing. Writes of this
+        Database go under it from now on
+        """
+        self._kdf_value = json.dumps(kdf).encode()
+        self.set_meta(conn, KDF_NAME, self._kdf_value)
+        self.kdf = kdf
+
+    def _writable(self):
+        """Condition refusing writes while the root password is being changed, and
+        writes under the master key of an earlier root password. Part of the
+        statement of the write, see check_writable for why one did nothing
+        """
+        if self.kdf is None:  # No keys derived, nothing to encrypt under
+            return true()
+        vault = self._vault_table
+        current = (
+            select(vault.c.name)
+            .where((vault.c.name == KDF_NAME) & (vault.c.value == self._kdf_value))
+            .with_for_update(read=True)
+        )
+        rekey = select(vault.c.name).where(vault.c.name == REKEY_NAME)
+        return current.exists() & ~rekey.exists()
+
+    def check_writable(self, conn: Union[Session, Connection]) -> None:
+        """Raise the error of writes refused by _writable, e.g. to tell why one did
+        nothing. Call in the transaction of the write
+        """
+        if self.kdf is None:
+            return
+        meta = self._read_meta(conn, [KDF_NAME, REKEY_NAME], lock=True)
+        if REKEY_NAME in meta:
+            raise RuntimeError(REKEY_PENDING)
+        if meta.get(KDF_NAME) != self._kdf_value:
+            raise RuntimeError("The root password was changed, please start again!")
 
     def get_salt(self, conn: Union[Session, Connection], site: str) -> bytes:
         """Get the salt for a specific site token"""
@@ -153,55 +376,269 @@ class Database:
         return rows[0][0]
 
     def get_all_sites(self, conn: Union[Session, Connection]) -> list:
-        """Obtain all site tokens in database"""
-        stmt = select(self._cred_table.c.app_site)
+        """Obtain all distinct sites in database"""
+        stmt = (
+            select(self._cred_table.c.app_site)
+            .distinct()
+            .order_by(self._cred_table.c.app_site)
+        )
         return list(conn.scalars(stmt).all())
 
-    def get_uname(self, sess: Session, site: str) -> pd.DataFrame:
-        """Obtain username for site"""
-        query = select(self._cred_table.c.username, self._cred_table.c.salt).where(
-            site == self._cred_table.c.app_site
+    def search_sites(
+        self, conn: Union[Session, Connection], query: str, limit: int = SEARCH_LIMIT
+    ) -> list:
+        """Sites best matching the query, ranked by Postgres like butler.search
+        ranks them. Similar spellings only match where pg_trgm is installed
+        """
+        if self._trigram is None:
+            self._trigram = conn.execute(
+                select(func.to_regproc("similarity").is_not(None))
+            ).scalar()
+        site = self._cred_table.c.app_site
+        pattern = escape_like(query)
+        match = site.ilike(f"%{pattern}%", escape="\\")
+        if self._trigram:
+            match = or_(match, site.op("%")(query))  # Both use the trigram index
+        found = select(site).where(match).distinct().subquery().c.app_site
+        rank = case(
+            (func.lower(found) == func.lower(query), EXACT),
+            (found.ilike(f"{pattern}%", escape="\\"), PREFIX),
+            (found.ilike(f"%{pattern}%", escape="\\"), SUBSTRING),
+            else_=FUZZY,
+        )
+        order: list[Any] = [rank]
+        if self._trigram:
+            order.append(case((rank == FUZZY, func.similarity(found, query))).desc())
+        order += [func.length(found), func.lower(found), found]
+        return list(conn.scalars(select(found).order_by(*order).limit(limit)).all())
+
+    def get_changes(self, conn: Union[Session, Connection]) -> int:
+        """Number of writes to the credential table so far"""
+        stmt = select(schema.change_counter.c.changes)
+        return conn.execute(stmt).scalar_one()
+
+    def count_entries(self, conn: Union[Session, Connection]) -> int:
+        """Number of stored entries"""
+        return conn.execute(
+            select(func.count()).select_from(self._cred_table)
+        ).scalar_one()
+
+    def get_uname(
+        self, sess: Session, site: str, unindexed: bool = False
+    ) -> list[UsernameToken]:
+        """Obtain username for site
+        :param unindexed: only return rows without a blind index
+        """
+        query = select(
+            self._cred_table.c.username,
+            self._cred_table.c.salt,
+            self._cred_table.c.key_version,
+        ).where(site == self._cred_table.c.app_site)
+        if unindexed:
+            query = query.where(self._cred_table.c.lookup.is_(None))
+        return [UsernameToken(*row) for row in sess.execute(query)]
+
+    def get_unindexed(self, conn: Union[Session, Connection], sites: list[str]) -> list:
+        """Obtain the rows without blind index of the given sites"""
+        if not sites:
+            return []
+        query = select(self._cred_table).where(
+            self._cred_table.c.lookup.is_(None) & self._cred_table.c.app_site.in_(sites)
         )
-        return pd.read_sql(query, sess.get_bind())
+        return list(conn.execute(query).all())
+
+    def get_by_lookup(
+        self, conn: Union[Session, Connection], lookup: bytes
+    ) -> PasswordToken | None:
+        """Obtain password for the row matching a blind index, if any"""
+        query = select(
+            self._cred_table.c.password,
+            self._cred_table.c.salt,
+            self._cred_table.c.key_version,
+        ).where(lookup == self._cred_table.c.lookup)
+        row = conn.execute(query).one_or_none()
+        return None if row is None else PasswordToken(*row)
+
+    def get_by_lookups(
+        self, conn: Union[Session, Connection], lookups: list[bytes]
+    ) -> dict[bytes, PasswordToken]:
+        """Obtain passwords for all rows matching any of the blind indexes"""
+        if not lookups:
+            return {}
+        query = select(
+            self._cred_table.c.lookup,
+            self._cred_table.c.password,
+            self._cred_table.c.salt,
+            self._cred_table.c.key_version,
+        ).where(self._cred_table.c.lookup.in_(lookups))
+        return {row[0]: PasswordToken(*row[1:]) for row in conn.execute(query)}
 
     def get_pw(
-        self, sess: Union[Session, Connection], site: str, uname_token: str
-    ) -> Row:
+        self, sess: Union[Session, Connection], site: str, uname_token: bytes
+    ) -> PasswordToken:
         """Obtain password for site and username"""
         query = (
-            select(self._cred_table.c.password, self._cred_table.c.salt)
+            select(
+                self._cred_table.c.password,
+                self._cred_table.c.salt,
+                self._cred_table.c.key_version,
+            )
             .where(site == self._cred_table.c.app_site)
             .where(uname_token == self._cred_table.c.username)
         )
-        return sess.execute(query).one()
+        return PasswordToken(*sess.execute(query).one())
 
     def add(self, conn: Union[Session, Connection], entry: dict):
-        """Add one entry"""
+        """Add one entry, atomically refusing duplicates"""
+        columns = self._cred_table.c
+        values = select(
+            *(literal(value, columns[name].type) for name, value in entry.items())
+        ).where(self._writable())
+        stmt = (
+            self._insert(self._cred_table)
+            .from_select(list(entry), values)
+            .on_conflict_do_nothing()
+            .returning(columns.id)
+        )
+        if conn.execute(stmt).first() is None:
+            self.check_writable(conn)
+            raise EntryExistsError("Entry already exists!")
+        conn.commit()
+
+    def existing_lookups(
+        self, conn: Union[Session, Connection], lookups: list[bytes]
+    ) -> set[bytes]:
+        """Return which of the given blind indexes are already stored"""
+        if not lookups:
+            return set()
+        query = select(self._cred_table.c.lookup).where(
+            self._cred_table.c.lookup.in_(lookups)
+        )
+        return set(conn.scalars(query).all())
+
+    def add_many(self, conn: Union[Session, Connection], entries: list[dict]):
+        """Insert many entries in one transaction, skipping existing ones"""
+        if entries:
+            names, columns = list(entries[0]), self._cred_table.c
+            if self.embedded:  # SQLite counts the rows of all statements
+                new = select(
+                    *(bindparam(name, type_=columns[name].type) for name in names)
+                ).where(self._writable())
+                stmt = self._insert(self._cred_table).from_select(names, new)
+                result: Any = conn.execute(stmt.on_conflict_do_nothing(), entries)
+                inserted = result.rowcount
+            else:  # Postgres doesn't, so insert from one list of values instead
+                rows = values(
+                    *(column(name, columns[name].type) for name in names), name="new"
+                ).data([tuple(entry[name] for name in names) for entry in entries])
+                new = select(rows).where(self._writable())
+                stmt = self._insert(self._cred_table).from_select(names, new)
+                inserted = len(
+                    conn.execute(
+                        stmt.on_conflict_do_nothing().returning(columns.id)
+                    ).all()
+                )
+            if inserted < len(entries):
+                self.check_writable(conn)  # Rather than skipped as existing
+        conn.commit()
+
+    def remove(self, conn: Session | Connection, site: str, uname: bytes):
+        """Remove one entry by its username token"""
+        self._delete(
+            conn,
+            (self._cred_table.c.app_site == site)
+            & (self._cred_table.c.username == uname),
+        )
+
+    def remove_by_lookup(self, conn: Union[Session, Connection], lookup: bytes):
+        """Remove the entry matching a blind index"""
+        self._delete(conn, self._cred_table.c.lookup == lookup)
+
+    def _delete(self, conn: Union[Session, Connection], match) -> None:
+        stmt = (
+            delete(self._cred_table)
+            .where(match & self._writable())
+            .returning(self._cred_table.c.id)
+        )
+        if conn.execute(stmt).first() is None:
+            self.check_writable(conn)
+            raise EntryNotFoundError("Entry doesn't exist!")
+        conn.commit()
+
+    def update(
+        self,
+        conn: Union[Session, Connection],
+        entry: dict,
+        uname_token: bytes | None = None,
+    ):
+        """Replace a row with a newly encrypted entry. The row is found by the
+        entry's blind index or, for rows without one, by its username token
+        """
+        if uname_token is None:
+            match = self._cred_table.c.lookup == entry[LOOKUP_KEY]
+        else:
+            match = (self._cred_table.c.app_site == entry[SITE_KEY]) & (
+                self._cred_table.c.username == uname_token
+            )
+        stmt = (
+            update(self._cred_table)
+            .where(match & self._writable())
+            .values(**entry)
+            .returning(self._cred_table.c.id)
+        )
+        if conn.execute(stmt).first() is None:
+            self.check_writable(conn)
+            raise EntryNotFoundError("Entry doesn't exist!")
+        conn.commit()
+
+    def get_outdated(self, conn: Union[Session, Connection], version: int) -> list:
+        """Obtain all rows not encrypted under a given key version or not indexed"""
+        query = select(self._cred_table).where(
+            (self._cred_table.c.key_version != version)
+            | self._cred_table.c.lookup.is_(None)
+        )
+        return list(conn.execute(query).all())
+
+    def iter_rows(self, conn: Union[Session, Connection], batch_size: int = 1000):
+        """Stream all credential rows through a server side cursor"""
         query = (
             select(self._cred_table)
-            .where(entry[SITE_KEY] == self._cred_table.c.app_site)
-            .where(entry[UNAME_KEY] == self._cred_table.c.username)
+            .order_by(self._cred_table.c.id)
+            .execution_options(yield_per=batch_size)
         )
-        if len(conn.execute(query).all()):
-            raise ValueError("Entry already exists!")
-        stmt = insert(self._cred_table).values(**entry)
-        conn.execute(stmt)
-        conn.commit()
+        yield from conn.execute(query)
 
-    def remove(self, conn: Session | Connection, site: str, uname: str):
-        """Remove one entry"""
+    def get_rows_after(
+        self, conn: Union[Session, Connection], row_id: int, limit: int
+    ) -> list:
+        """Obtain the next rows in id order, for walking the table in batches"""
         query = (
             select(self._cred_table)
-            .where(site == self._cred_table.c.app_site)
-            .where(uname == self._cred_table.c.username)
+            .where(self._cred_table.c.id > row_id)
+            .order_by(self._cred_table.c.id)
+            .limit(limit)
         )
-        if len(conn.execute(query).all()):
-            stmt = (
-                delete(self._cred_table)
-                .where(site == self._cred_table.c.app_site)
-                .where(uname == self._cred_table.c.username)
+        return list(conn.execute(query).all())
+
+    def update_tokens_many(
+        self, conn: Union[Session, Connection], entries: dict[int, dict]
+    ):
+        """Replace the encrypted fields of rows by id in one statement, without
+        committing
+        """
+        if entries:
+            stmt = update(self._cred_table).where(
+                self._cred_table.c.id == bindparam("row_id")
             )
-            conn.execute(stmt)
-            conn.commit()
-        else:
-            raise ValueError("Entry doesn't exist!")
+            conn.execute(
+                stmt, [{"row_id": row_id, **entry} for row_id, entry in entries.items()]
+            )
+
+    def update_tokens(self, conn: Union[Session, Connection], row_id: int, entry: dict):
+        """Replace the encrypted fields of one row, without committing"""
+        stmt = (
+            update(self._cred_table)
+            .where(self._cred_table.c.id == row_id)
+            .values(**entry)
+        )
+        conn.execute(stmt)
@@ -0,0 +1,215 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+import sqlalchemy as sa
+from sqlalchemy.engine import URL, Engine
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from butler import trace
+from butler.config import (
+    BACKEND_KEY,
+    DB_CONF_PATH,
+    DB_NAME_KEY,
+    DB_PORT_KEY,
+    DB_PW_FILE,
+    DB_USER_KEY,
+    HOST_KEY,
+    POOL_PRE_PING_KEY,
+    POOL_RECYCLE_KEY,
+    POOL_SIZE_KEY,
+    POSTGRES_BACKEND,
+    SCHEMA_KEY,
+    SQLITE_BACKEND,
+    SQLITE_MEMORY,
+    SQLITE_PATH_KEY,
+    read_config,
+)
+
+POOL_SIZE = 5
+POOL_RECYCLE = 1800  # Seconds before a pooled connection is replaced
+POOL_PRE_PING = True  # Checked only when reused, so new connections cost nothing
+REPLICA_CONNECT_TIMEOUT = 2  # Seconds, a replica that is down is skipped instead
+
+_engines: dict[str, Engine] = {}  # Shared engines by config directory and replica
+_engines_lock = threading.Lock()
+
+
+class PoolMetrics:
+    """Counters of one connection pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.connects = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_checkout(self, wait: float) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def record_connect(self) -> None:
+        with self._lock:
+            self.connects += 1
+
+    def snapshot(self) -> dict:
+        """Current counters, with wait times in seconds"""
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "connects": self.connects,
+                "wait_total": self.wait_total,
+                "wait_max": self.wait_max,
+            }
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool recording checkouts and how long they wait for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+        sa.event.listen(self, "connect", lambda *_: self.metrics.record_connect())
+
+    def _do_get(self):
+        start = time.perf_counter()
+        conn = super()._do_get()
+        self.metrics.record_checkout(time.perf_counter() - start)
+        return conn
+
+
+def read_db_url(
+    config_dir: str | os.PathLike = DB_CONF_PATH, endpoint: str | None = None
+) -> URL:
+    """Build the database URL from the config written by config_db
+    :param endpoint: a read replica of the config instead of the primary
+    """
+    config = read_config(config_dir)
+    if config.get(BACKEND_KEY, POSTGRES_BACKEND) == SQLITE_BACKEND:
+        return URL.create(
+            drivername="sqlite", database=endpoint or config[SQLITE_PATH_KEY]
+        )
+    host, port = config[HOST_KEY], config.getint(DB_PORT_KEY)
+    if endpoint is not None:
+        host, _, replica_port = endpoint.partition(":")
+        port = int(replica_port) if replica_port else port
+    with open(Path(config_dir) / DB_PW_FILE, "r") as f:
+        db_pw = f.read()
+    query = {}
+    if config.get(SCHEMA_KEY):
+        query["options"] = f"-csearch_path={config[SCHEMA_KEY]}"
+    return URL.create(
+        drivername="postgresql+psycopg",
+        host=host,
+        port=port,
+        database=config[DB_NAME_KEY],
+        username=config[DB_USER_KEY],
+        password=db_pw,
+        query=query,
+    )
+
+
+def protect_sqlite(path: str | None) -> None:
+    """Keep the embedded database file readable by us only. SQLite gives its
+    -wal and -shm files the permissions of the database file
+    """
+    if path is None or path == SQLITE_MEMORY:
+        return
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o600)  # Empty is a database
+    except FileNotFoundError:  # No directory, connecting will fail anyway
+        return
+    os.close(fd)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.chmod(path + suffix, 0o600)
+
+
+def configure_sqlite(dbapi_conn, _):
+    """Let readers and a writer work concurrently on the embedded database"""
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def _trace_queries(engine: Engine) -> None:
+    """Count and time the statements of an engine for profiles"""
+
+    @sa.event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        context.query_start = time.perf_counter()
+
+    @sa.event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        trace.record("db.query", time.perf_counter() - context.query_start)
+        trace.count("db.queries")
+
+
+def create_engine(
+    config_dir: str | os.PathLike = DB_CONF_PATH, endpoint: str | None = None
+) -> Engine:
+    """Create an engine with the pool settings of the DB config
+    :param endpoint: a read replica of the config instead of the primary
+    """
+    config = read_config(config_dir)
+    url = read_db_url(config_dir, endpoint)
+    if url.database == SQLITE_MEMORY:
+        # One connection, or every checkout would see a new empty database
+        engine = sa.create_engine(
+            url, poolclass=StaticPool, connect_args={"check_same_thread": False}
+        )
+        sa.event.listen(engine, "connect", configure_sqlite)
+        _trace_queries(engine)
+        return engine
+    connect_args = {}
+    if endpoint is not None and url.get_backend_name() == "postgresql":
+        connect_args["connect_timeout"] = REPLICA_CONNECT_TIMEOUT
+    engine = sa.create_engine(
+        url,
+        poolclass=MeteredQueuePool,
+        pool_size=config.getint(POOL_SIZE_KEY, POOL_SIZE),
+        pool_recycle=config.getint(POOL_RECYCLE_KEY, POOL_RECYCLE),
+        pool_pre_ping=config.getboolean(POOL_PRE_PING_KEY, POOL_PRE_PING),
+        connect_args=connect_args,
+    )
+    if engine.dialect.name == "sqlite":
+        protect_sqlite(url.database)
+        sa.event.listen(engine, "connect", configure_sqlite)
+    _trace_queries(engine)
+    return engine
+
+
+def get_engine(
+    config_dir: str | os.PathLike = DB_CONF_PATH, endpoint: str | None = None
+) -> Engine:
+    """Engine shared by everything in this process using the config directory
+    :param endpoint: a read replica of the config instead of the primary
+    """
+    key = os.path.realpath(config_dir)
+    if endpoint is not None:
+        key = f"{key}#{endpoint}"
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = create_engine(config_dir, endpoint)
+        return _engines[key]
+
+
+def dispose_engines() -> None:
+    """Close the pooled connections of all shared engines and forget them"""
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+def pool_metrics(engine: Engine) -> dict:
+    """Checkout counters of an engine created here"""
+    pool = engine.pool
+    if not isinstance(pool, MeteredQueuePool):
+        raise ValueError("Engine has no pool metrics!")
+    return pool.metrics.snapshot() | {"size": pool.size(), "idle": pool.checkedin()}
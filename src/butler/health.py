@@ -0,0 +1,73 @@
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+from configparser import SectionProxy
+
+from butler.config import DB_PORT_KEY, HOST_KEY
+
+# Whether the database service answers, remembered for a short while so that
+# commands in quick succession skip even the TCP probe. Standard library only,
+# as every command checks this before doing anything else.
+
+HEALTH_PATH = os.path.expanduser("~/.pw_butler/health.json")
+HEALTH_TTL = 30.0  # Seconds a healthy probe is trusted
+PROBE_TIMEOUT = 0.5
+
+
+def probe(host: str, port: int, timeout: float = PROBE_TIMEOUT) -> bool:
+    """Whether something accepts TCP connections at host and port"""
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def service_healthy(
+    config: SectionProxy, state_file=HEALTH_PATH, ttl: float = HEALTH_TTL
+) -> bool:
+    """Whether the database service of the config answers, probing it only when
+    no recent healthy result is cached
+    """
+    host, port = config[HOST_KEY], int(config[DB_PORT_KEY])
+    target = f"{host}:{port}"
+    try:
+        with open(state_file, "r") as f:
+            state = json.load(f)
+        if state["target"] == target and time.time() - state["healthy_at"] < ttl:
+            return True
+    except (OSError, ValueError, KeyError):
+        pass  # No usable cache
+    if not probe(host, port):
+        forget(state_file)
+        return False
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(state_file)), exist_ok=True)
+        with open(state_file, "w") as f:
+            json.dump({"target": target, "healthy_at": time.time()}, f)
+    except OSError:
+        logging.debug("Couldn't cache the service health.")
+    return True
+
+
+def forget(state_file=HEALTH_PATH) -> None:
+    """Drop the cached result, e.g. when the service is taken down"""
+    try:
+        os.unlink(state_file)
+    except FileNotFoundError:
+        pass
+
+
+def start_in_background() -> None:
+    """Start the service without waiting for it"""
+    subprocess.Popen(
+        [sys.executable, "-c", "from butler.ui import cli; cli(['up'])"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
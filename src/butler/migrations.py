@@ -0,0 +1,217 @@
+import logging
+from typing import NamedTuple
+
+import sqlalchemy as sa
+from sqlalchemy import Connection, delete, insert, select, text
+from sqlalchemy.exc import ProgrammingError
+
+from butler.schema import credential, metadata, vault
+
+SCHEMA_VERSION_NAME = "schema_version"  # Key of the version in the vault table
+
+
+class Migration(NamedTuple):
+    """Statements bringing the schema from the previous version to this one"""
+
+    version: int
+    description: str
+    statements: list[str]
+    dialect: str | None = None  # Only run on this backend
+
+
+# Search still works without pg_trgm, which may be missing or need privileges the
+# user lacks, only without the index and without matching similar spellings
+TRIGRAM_INDEX = """DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS credential_site_trgm_idx
+        ON credential USING gin (app_site gin_trgm_ops);
+EXCEPTION WHEN feature_not_supported OR undefined_file OR undefined_object
+    OR insufficient_privilege THEN
+    RAISE NOTICE 'pg_trgm is not available, site search scans the table';
+END $$"""
+
+_COUNTER_TABLE = [
+    "CREATE TABLE IF NOT EXISTS change_counter "
+    "(id smallint PRIMARY KEY, changes bigint NOT NULL)",
+    "INSERT INTO change_counter (id, changes) VALUES (1, 0) ON CONFLICT DO NOTHING",
+]
+# Counts writes to credential, so that copies like snapshots can tell whether
+# they are current. Triggers catch writes of every client, in the same statement
+CHANGE_COUNTER = {
+    "postgresql": _COUNTER_TABLE
+    + [
+        "CREATE OR REPLACE FUNCTION count_credential_changes() RETURNS trigger "
+        "LANGUAGE plpgsql AS $$ BEGIN "
+        "UPDATE change_counter SET changes = changes + 1; RETURN NULL; END $$",
+        "DROP TRIGGER IF EXISTS credential_changes ON credential",
+        "CREATE TRIGGER credential_changes "
+        "AFTER INSERT OR UPDATE OR DELETE ON credential "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_credential_changes()",
+    ],
+    "sqlite": _COUNTER_TABLE
+    + [
+        f"CREATE TRIGGER IF NOT EXISTS credential_{op.lower()} AFTER {op} "
+        "ON credential BEGIN UPDATE change_counter SET changes = changes + 1; END"
+        for op in ("INSERT", "UPDATE", "DELETE")
+    ],
+}
+
+
+NOTIFY_CHANNEL = "credential_changes"
+# Tells listening clients which sites changed, so that they drop what they cached
+# of them. Sent on commit, once per distinct site; an empty payload stands for
+# sites too long for a notification
+CHANGE_NOTIFY = [
+    "CREATE OR REPLACE FUNCTION notify_credential_change() RETURNS trigger "
+    "LANGUAGE plpgsql AS $$ BEGIN "
+    "IF TG_OP <> 'INSERT' THEN PERFORM pg_notify('credential_changes', "
+    "CASE WHEN octet_length(OLD.app_site) < 4000 THEN OLD.app_site ELSE '' END); "
+    "END IF; "
+    "IF TG_OP <> 'DELETE' THEN PERFORM pg_notify('credential_changes', "
+    "CASE WHEN octet_length(NEW.app_site) < 4000 THEN NEW.app_site ELSE '' END); "
+    "END IF; "
+    "RETURN NULL; END $$",
+    "DROP TRIGGER IF EXISTS credential_notify ON credential",
+    "CREATE TRIGGER credential_notify "
+    "AFTER INSERT OR UPDATE OR DELETE ON credential "
+    "FOR EACH ROW EXECUTE FUNCTION notify_credential_change()",
+]
+
+# Version 1 is the original pw.sql. Databases are created at the latest version
+# (pw.sql for Postgres, butler.schema for SQLite), so statements only need to
+# work on the backends that existed at the time of their version. Migrations
+# limited to a dialect may come in one per dialect for the same version.
+MIGRATIONS = [
+    Migration(
+        2,
+        "Key version of rows and vault metadata table",
+        [
+            "ALTER TABLE credential ADD COLUMN IF NOT EXISTS "
+            "key_version smallint NOT NULL DEFAULT 1",
+            "CREATE TABLE IF NOT EXISTS vault "
+            "(name text PRIMARY KEY, value bytea NOT NULL)",
+        ],
+    ),
+    Migration(
+        3,
+        "Blind index column",
+        [
+            "ALTER TABLE credential ADD COLUMN IF NOT EXISTS lookup bytea",
+            "CREATE UNIQUE INDEX IF NOT EXISTS credential_lookup_idx "
+            "ON credential (lookup)",
+        ],
+    ),
+    Migration(
+        4,
+        "Index on site and username",
+        [
+            "CREATE UNIQUE INDEX IF NOT EXISTS credential_site_username_idx "
+            "ON credential (app_site, username)",
+        ],
+    ),
+    Migration(5, "Trigram index for site search", [TRIGRAM_INDEX], "postgresql"),
+    Migration(6, "Change counter", CHANGE_COUNTER["postgresql"], "postgresql"),
+    Migration(6, "Change counter", CHANGE_COUNTER["sqlite"], "sqlite"),
+    Migration(7, "Change notifications", CHANGE_NOTIFY, "postgresql"),
+    # Fernet tokens stay readable as their ASCII bytes, see butler.util.TOKEN_FORMAT
+    Migration(
+        8,
+        "Binary tokens",
+        [
+            "ALTER TABLE credential "
+            "ALTER COLUMN username TYPE bytea USING convert_to(username, 'UTF8'), "
+            "ALTER COLUMN password TYPE bytea USING convert_to(password, 'UTF8')"
+        ],
+        "postgresql",
+    ),
+    Migration(
+        8,
+        "Binary tokens",
+        [
+            "UPDATE credential SET username = CAST(username AS BLOB), "
+            "password = CAST(password AS BLOB)"
+        ],
+        "sqlite",
+    ),
+    # Butlers only look for rows without blind index while the flag is set,
+    # migrating the rows clears it, see butler.database.UNINDEXED_NAME
+    Migration(
+        9,
+        "Flag rows without blind index",
+        [
+            "INSERT INTO vault (name, value) SELECT 'unindexed', "
+            "convert_to('1', 'UTF8') FROM credential WHERE lookup IS NULL LIMIT 1"
+        ],
+        "postgresql",
+    ),
+    Migration(
+        9,
+        "Flag rows without blind index",
+        [
+            "INSERT INTO vault (name, value) SELECT 'unindexed', "
+            "CAST('1' AS BLOB) FROM credential WHERE lookup IS NULL LIMIT 1"
+        ],
+        "sqlite",
+    ),
+]
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+def get_version(conn: Connection) -> int:
+    """Schema version of the database"""
+    try:
+        value = conn.execute(
+            select(vault.c.value).where(vault.c.name == SCHEMA_VERSION_NAME)
+        ).scalar()
+    except ProgrammingError:  # No vault table yet
+        conn.rollback()
+        return 1
+    if value is not None:
+        return int(value)
+    # Databases from before the version was recorded
+    columns = {c["name"] for c in sa.inspect(conn).get_columns("credential")}
+    return 3 if "lookup" in columns else 2
+
+
+def set_version(conn: Connection, version: int) -> None:
+    """Record the schema version"""
+    conn.execute(delete(vault).where(vault.c.name == SCHEMA_VERSION_NAME))
+    conn.execute(
+        insert(vault).values(name=SCHEMA_VERSION_NAME, value=str(version).encode())
+    )
+
+
+def create_all(conn: Connection) -> None:
+    """Create missing tables, recording the version of a new database"""
+    fresh = not sa.inspect(conn).has_table(credential.name)
+    metadata.create_all(conn)
+    if fresh:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text(TRIGRAM_INDEX))
+            for stmt in CHANGE_NOTIFY:
+                conn.execute(text(stmt))
+        for stmt in CHANGE_COUNTER[conn.dialect.name]:
+            conn.execute(text(stmt))
+        set_version(conn, SCHEMA_VERSION)
+
+
+def upgrade(conn: Connection, current: int) -> list[Migration]:
+    """Apply pending migrations, without committing
+    :param current: version reported by get_version
+    :return: applied migrations
+    """
+    if current > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database schema version {current} is newer than this Butler supports!"
+        )
+    pending = [m for m in MIGRATIONS if m.version > current]
+    for migration in pending:
+        if migration.dialect not in (None, conn.dialect.name):
+            continue
+        logging.info(f"Migrating schema to version {migration.version}.")
+        for stmt in migration.statements:
+            conn.execute(text(stmt))
+    if pending or current < SCHEMA_VERSION:
+        set_version(conn, SCHEMA_VERSION)
+    return pending
@@ -2,6 +2,63 @@ CREATE TABLE credential (
     id serial PRIMARY KEY,
     app_site text NOT NULL,
     salt bytea NOT NULL,
-    username text,
-    password text NOT NULL
+    username bytea,
+    password bytea NOT NULL,
+    key_version smallint NOT NULL DEFAULT 1,
+    lookup bytea
 );
+
+CREATE UNIQUE INDEX credential_lookup_idx ON credential (lookup);
+CREATE UNIQUE INDEX credential_site_username_idx ON credential (app_site, username);
+
+-- Site search, see butler.migrations.TRIGRAM_INDEX
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS credential_site_trgm_idx
+        ON credential USING gin (app_site gin_trgm_ops);
+EXCEPTION WHEN feature_not_supported OR undefined_file OR undefined_object
+    OR insufficient_privilege THEN
+    RAISE NOTICE 'pg_trgm is not available, site search scans the table';
+END $$;
+
+CREATE TABLE vault (
+    name text PRIMARY KEY,
+    value bytea NOT NULL
+);
+
+-- Counts writes to credential, see butler.migrations.CHANGE_COUNTER
+CREATE TABLE change_counter (
+    id smallint PRIMARY KEY,
+    changes bigint NOT NULL
+);
+INSERT INTO change_counter (id, changes) VALUES (1, 0);
+
+CREATE FUNCTION count_credential_changes() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE change_counter SET changes = changes + 1;
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER credential_changes AFTER INSERT OR UPDATE OR DELETE ON credential
+    FOR EACH STATEMENT EXECUTE FUNCTION count_credential_changes();
+
+-- Tells listening clients which sites changed, see butler.migrations.CHANGE_NOTIFY
+CREATE FUNCTION notify_credential_change() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM pg_notify('credential_changes',
+            CASE WHEN octet_length(OLD.app_site) < 4000 THEN OLD.app_site ELSE '' END);
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        PERFORM pg_notify('credential_changes',
+            CASE WHEN octet_length(NEW.app_site) < 4000 THEN NEW.app_site ELSE '' END);
+    END IF;
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER credential_notify AFTER INSERT OR UPDATE OR DELETE ON credential
+    FOR EACH ROW EXECUTE FUNCTION notify_credential_change();
+
+-- Keep in step with butler.migrations.SCHEMA_VERSION
+INSERT INTO vault (name, value) VALUES ('schema_version', '9');
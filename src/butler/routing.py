@@ -0,0 +1,117 @@
+import threading
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+
+from butler import trace
+
+# Routing of a session's statements between the primary and read replicas. Plain
+# queries go to a replica, taking turns between the healthy ones; anything else,
+# and every query after it in the same session, goes to the primary, so that a
+# session always reads its own writes. Later sessions of the same client read
+# from the primary for a while too, see DatabaseApplication.session_factory.
+
+HEALTH_CHECK_INTERVAL = 5.0  # Seconds a replica is trusted after a good check
+RETRY_AFTER = 30.0  # Seconds a failed replica is left alone
+READ_OWN_WRITES = 10.0  # Seconds a client reads from the primary after writing
+
+
+class ReplicaPool:
+    """Read replicas handed out in turn, skipping those that failed recently
+    :param engines: engines of the replicas
+    :param check_interval: seconds between health checks of a replica
+    :param retry_after: seconds before a failed replica is tried again
+    """
+
+    def __init__(
+        self,
+        engines: list[Engine],
+        check_interval: float = HEALTH_CHECK_INTERVAL,
+        retry_after: float = RETRY_AFTER,
+    ):
+        self.engines = engines
+        self.check_interval = check_interval
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._turn = 0
+        self._checked_at: dict[Engine, float] = {}
+        self._down_until: dict[Engine, float] = {}
+        for engine in engines:
+            sa.event.listen(engine, "handle_error", self._on_error)
+
+    def __len__(self) -> int:
+        return len(self.engines)
+
+    def _on_error(self, context) -> None:
+        if context.is_disconnect and context.engine is not None:
+            self.mark_down(context.engine)
+
+    def mark_down(self, engine: Engine) -> None:
+        """Leave a replica alone for a while"""
+        with self._lock:
+            self._down_until[engine] = time.monotonic() + self.retry_after
+            self._checked_at.pop(engine, None)
+        trace.count("db.replica_failures")
+
+    def _healthy(self, engine: Engine) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if self._down_until.get(engine, 0.0) > now:
+                return False
+            if now - self._checked_at.get(engine, -self.check_interval) < (
+                self.check_interval
+            ):
+                return True
+        try:
+            with engine.connect() as conn:
+                conn.exec_driver_sql("SELECT 1")
+        except DBAPIError:
+            self.mark_down(engine)
+            return False
+        with self._lock:
+            self._checked_at[engine] = now
+        return True
+
+    def pick(self) -> Engine | None:
+        """Next healthy replica, None if all are down"""
+        for _ in range(len(self.engines)):
+            with self._lock:
+                engine = self.engines[self._turn % len(self.engines)]
+                self._turn += 1
+            if self._healthy(engine):
+                return engine
+        return None
+
+
+class RoutingSession(Session):
+    """Session reading from a replica until it writes, then from the primary.
+    Each session sticks to one replica, so its reads see one state of the data
+    :param replicas: replicas to read from
+    """
+
+    def __init__(self, *args, replicas: ReplicaPool, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._replicas = replicas
+        self._replica: Engine | None = None
+        self._wrote = False
+
+    @property
+    def wrote(self) -> bool:
+        """Whether the session sent anything but plain queries"""
+        return self._wrote
+
+    def get_bind(self, mapper=None, *, clause=None, **kwargs):
+        if clause is not None and not self._wrote:
+            if isinstance(clause, Select) and clause._for_update_arg is None:
+                if self._replica is None:
+                    self._replica = self._replicas.pick()
+                if self._replica is not None:
+                    trace.count("db.replica_queries")
+                    return self._replica
+            else:
+                self._wrote = True  # Read our own writes from now on
+        return super().get_bind(mapper, clause=clause, **kwargs)
@@ -0,0 +1,48 @@
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Index,
+    Integer,
+    LargeBinary,
+    MetaData,
+    SmallInteger,
+    Table,
+    Text,
+)
+
+# Mirrors pw.sql, which sets up the Postgres service. Queries of both backends
+# use these tables directly instead of reflecting the database, and they create
+# the schema of the embedded backend, so keep the two in sync. The trigram index
+# of sites is Postgres only, see butler.migrations.TRIGRAM_INDEX.
+
+metadata = MetaData()
+
+credential = Table(
+    "credential",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("app_site", Text, nullable=False),
+    Column("salt", LargeBinary, nullable=False),
+    Column("username", LargeBinary),
+    Column("password", LargeBinary, nullable=False),
+    Column("key_version", SmallInteger, nullable=False, server_default="1"),
+    Column("lookup", LargeBinary),
+    Index("credential_lookup_idx", "lookup", unique=True),
+    Index("credential_site_username_idx", "app_site", "username", unique=True),
+)
+
+vault = Table(
+    "vault",
+    metadata,
+    Column("name", Text, primary_key=True),
+    Column("value", LargeBinary, nullable=False),
+)
+
+# One row, bumped by triggers on every write to credential, see
+# butler.migrations.CHANGE_COUNTER
+change_counter = Table(
+    "change_counter",
+    metadata,
+    Column("id", SmallInteger, primary_key=True),
+    Column("changes", BigInteger, nullable=False),
+)
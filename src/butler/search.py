@@ -0,0 +1,131 @@
+import heapq
+import math
+import re
+from bisect import bisect_left
+from collections import Counter
+from typing import Iterable, Iterator
+
+# Ranking of site search, shared by the Postgres query and the in-memory index of
+# the embedded backend: exact matches first, then prefixes, then substrings, each
+# shortest first, then similar spellings by trigram similarity as pg_trgm has it.
+
+SEARCH_LIMIT = 20
+SIMILARITY_THRESHOLD = 0.3  # Default of pg_trgm's % operator
+EXACT, PREFIX, SUBSTRING, FUZZY = range(4)
+
+
+def trigrams(text: str) -> set[str]:
+    """Trigrams of the words of a text, padded like pg_trgm pads them"""
+    grams: set[str] = set()
+    for word in re.findall(r"[^\W_]+", text.casefold()):
+        padded = f"  {word} "
+        grams.update(map("".join, zip(padded, padded[1:], padded[2:])))
+    return grams
+
+
+def similarity(a: str, b: str) -> float:
+    """Shared trigrams over all trigrams of two texts, like pg_trgm's similarity"""
+    grams_a, grams_b = trigrams(a), trigrams(b)
+    if not grams_a or not grams_b:
+        return 0.0
+    return len(grams_a & grams_b) / len(grams_a | grams_b)
+
+
+def escape_like(text: str) -> str:
+    """Match text literally in a LIKE pattern escaped by backslash"""
+    return re.sub(r"([\\%_])", r"\\\1", text)
+
+
+class SiteIndex:
+    """Sites held in memory, for searching the embedded backend without scanning
+    every site per query
+    :param sites: distinct site names
+    """
+
+    def __init__(self, sites: Iterable[str]):
+        pairs = sorted((site.casefold(), site) for site in set(sites))
+        self._folded = [folded for folded, _ in pairs]
+        self._sites = [site for _, site in pairs]
+        # Sites of each length joined into one string, so that str.find looks for
+        # substrings, shortest sites first
+        by_length: dict[int, list[int]] = {}
+        for i, folded in enumerate(self._folded):
+            by_length.setdefault(len(folded), []).append(i)
+        self._buckets = [
+            (length, "\n".join(self._folded[i] for i in ids), ids)
+            for length, ids in sorted(by_length.items())
+        ]
+        self._postings: dict[str, list[int]] | None = None  # Built when needed
+        self._sizes: list[int] = []
+
+    def __len__(self) -> int:
+        return len(self._sites)
+
+    def _containing(self, folded: str) -> Iterator[int]:
+        """Sites containing the folded query, shortest first"""
+        for length, text, ids in self._buckets:
+            if length < len(folded):
+                continue
+            pos = text.find(folded)
+            while pos >= 0:
+                j = pos // (length + 1)
+                yield ids[j]
+                pos = text.find(folded, (j + 1) * (length + 1))
+
+    def _build_postings(self) -> dict[str, list[int]]:
+        """Sites by trigram. Most searches end before needing them"""
+        if self._postings is None:
+            self._postings = {}
+            for i, site in enumerate(self._sites):
+                grams = trigrams(site)
+                self._sizes.append(len(grams))
+                for gram in grams:
+                    self._postings.setdefault(gram, []).append(i)
+        return self._postings
+
+    def _similar(self, query: str) -> dict[int, float]:
+        """Sites similar to the query, with their similarity"""
+        postings = self._build_postings()
+        query_grams = trigrams(query)
+        shared: Counter = Counter()
+        for gram in query_grams:
+            shared.update(postings.get(gram, ()))
+        # Similar sites share at least this many trigrams with the query
+        needed = math.ceil(SIMILARITY_THRESHOLD * len(query_grams) - 1e-9)
+        found = {}
+        for i, n in shared.items():
+            if n >= needed:
+                score = n / (len(query_grams) + self._sizes[i] - n)
+                if score >= SIMILARITY_THRESHOLD:
+                    found[i] = score
+        return found
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT) -> list[str]:
+        """Sites best matching the query"""
+        folded = query.casefold()
+        if "\n" in folded or limit <= 0:
+            return []
+        # Exact and prefix matches are a range of the sorted sites
+        lo = bisect_left(self._folded, folded)
+        hi = bisect_left(self._folded, folded + chr(0x10FFFF), lo)
+        best = heapq.nsmallest(
+            limit,
+            range(lo, hi),
+            key=lambda i: (self._folded[i] != folded, len(self._folded[i]), i),
+        )
+        seen = set(range(lo, hi))
+        if len(best) < limit:
+            for i in self._containing(folded):
+                if i not in seen:
+                    seen.add(i)
+                    best.append(i)
+                    if len(best) == limit:
+                        break
+            else:
+                similar = self._similar(query)
+                best += heapq.nsmallest(
+                    limit - len(best),
+                    (i for i in similar if i not in seen),
+                    key=lambda i: (-similar[i], len(self._folded[i]), i),
+                )
+        return [self._sites[i] for i in best]
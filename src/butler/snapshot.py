@@ -0,0 +1,351 @@
+import base64
+import hmac
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+from configparser import SectionProxy
+from contextlib import closing
+from pathlib import Path
+from typing import Iterable
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from butler.authentication import RootKey
+from butler.config import (
+    BACKEND_KEY,
+    DB_CONF_PATH,
+    DB_NAME_KEY,
+    DB_PORT_KEY,
+    DB_PW_FILE,
+    DB_USER_KEY,
+    HOST_KEY,
+    POSTGRES_BACKEND,
+    SCHEMA_KEY,
+    SNAPSHOT_KEY,
+    SQLITE_PATH_KEY,
+    read_config,
+)
+from butler.search import SEARCH_LIMIT, SiteIndex
+from butler.util import (
+    AEAD_KEY_VERSION,
+    HKDF_KEY_VERSION,
+    LEGACY_KEY_VERSION,
+    KeyCache,
+    decrypt_token,
+    derive_aead_key,
+    derive_row_key,
+    stretch,
+    token_aad,
+)
+
+# Encrypted copy of the credential table, so that reads work without the database
+# service, laid out to be memory mapped:
+#
+#   magic | header length | header | MAC | count | index records | blobs
+#
+# The JSON header holds the vault KDF and the change counter of the copied table,
+# so freshness is checked before unlocking. Index records are (site digest,
+# offset, length), sorted by a keyed digest of the site, each pointing to an
+# AES-GCM blob with the rows of that site. The MAC covers everything but the
+# blobs, which are authenticated by AES-GCM with their digest. Kept free of
+# SQLAlchemy, as reading a snapshot is meant to skip loading it.
+
+SNAPSHOT_NAME = "snapshot.bin"
+MAGIC = b"BTLRSNP2"  # Bumped with the layout of rows, older snapshots are rewritten
+SNAPSHOT_INFO = b"pw_butler snapshot"
+DIGEST_SIZE = 16
+LENGTH = struct.Struct(">I")
+RECORD = struct.Struct(f">{DIGEST_SIZE}sQI")  # Site digest, blob offset and length
+MAC_SIZE = 32
+NONCE_SIZE = 12
+SITES_AAD = b"sites"
+UNAME_COLUMN, PW_COLUMN = "username", "password"  # Tokens are sealed to these
+CHANGES_QUERY = "SELECT changes FROM change_counter"
+CONNECT_TIMEOUT = 2  # Seconds, the health check already found the service
+
+
+def snapshot_path(config_dir: str | os.PathLike = DB_CONF_PATH) -> Path:
+    """Location of the snapshot of a DB config"""
+    return Path(config_dir) / SNAPSHOT_NAME
+
+
+def snapshot_enabled(config: SectionProxy) -> bool:
+    """Whether the DB config opts in to snapshots"""
+    return config.getboolean(SNAPSHOT_KEY, fallback=False)
+
+
+def _derive_keys(master_key: bytes) -> tuple[bytes, bytes, bytes]:
+    """Encryption, MAC and site digest keys of snapshots"""
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=96, salt=None, info=SNAPSHOT_INFO)
+    okm = hkdf.derive(master_key)
+    return okm[:32], okm[32:64], okm[64:]
+
+
+def _site_digest(digest_key: bytes, site: str) -> bytes:
+    return hmac.digest(digest_key, site.encode(), "sha256")[:DIGEST_SIZE]
+
+
+def _seal(aead: AESGCM, data: bytes, aad: bytes) -> bytes:
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + aead.encrypt(nonce, data, aad)
+
+
+def write_snapshot(
+    path: str | os.PathLike, master_key: bytes, kdf: dict, changes: int, rows: Iterable
+) -> int:
+    """Replace the snapshot file with a copy of credential rows
+    :param kdf: how the master key is stretched from the root password
+    :param changes: change counter of the database, read before the rows
+    :param rows: rows with app_site, salt, key_version, username and password
+    :return: number of copied rows
+    """
+    enc_key, mac_key, digest_key = _derive_keys(master_key)
+    aead = AESGCM(enc_key)
+    by_site: dict[str, list] = {}
+    count = 0
+    for row in rows:
+        salt, uname, pw = (
+            base64.b64encode(value).decode()
+            for value in (row.salt, row.username, row.password)
+        )
+        entry = [salt, row.key_version, uname, pw]
+        by_site.setdefault(row.app_site, []).append(entry)
+        count += 1
+    sites = _seal(aead, json.dumps(sorted(by_site)).encode(), SITES_AAD)
+    blobs = []
+    for site, entries in by_site.items():
+        digest = _site_digest(digest_key, site)
+        blobs.append((digest, _seal(aead, json.dumps(entries).encode(), digest)))
+    blobs.sort()
+    header = json.dumps(
+        {"kdf": kdf, "changes": changes, "written_at": time.time(), "sites": len(sites)}
+    ).encode()
+    records, offset = [], len(sites)  # Offsets count from the end of the index
+    for digest, blob in blobs:
+        records.append(RECORD.pack(digest, offset, len(blob)))
+        offset += len(blob)
+    index = LENGTH.pack(len(records)) + b"".join(records)
+    head = MAGIC + LENGTH.pack(len(header)) + header
+    mac = hmac.digest(mac_key, head + index, "sha256")
+    _dir = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=_dir, prefix=".snapshot")  # Readable by us only
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(head + mac + index + sites)
+            for _, blob in blobs:
+                f.write(blob)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return count
+
+
+class Snapshot:
+    """Memory mapped snapshot file. The header can be read right away, rows only
+    once unlocked with the master key
+    :param path: snapshot file
+    """
+
+    def __init__(self, path: str | os.PathLike):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self._map[: len(MAGIC)] != MAGIC:
+                raise ValueError
+            (header_len,) = LENGTH.unpack_from(self._map, len(MAGIC))
+            header_at = len(MAGIC) + LENGTH.size
+            self._mac_at = mac_at = header_at + header_len
+            header = json.loads(self._map[header_at:mac_at])
+            self._index_at = self._mac_at + MAC_SIZE
+            (self._count,) = LENGTH.unpack_from(self._map, self._index_at)
+            self._blobs_at = self._index_at + LENGTH.size + self._count * RECORD.size
+            if self._blobs_at > len(self._map):
+                raise ValueError
+            self.kdf: dict = header["kdf"]
+            self.changes: int = header["changes"]
+            self.written_at: float = header["written_at"]
+            self._sites_len: int = header["sites"]
+        except (ValueError, KeyError, struct.error):
+            self._map.close()
+            raise ValueError(f"{path} is not a snapshot!")
+        self._aead: AESGCM | None = None
+        self._digest_key = b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        self._map.close()
+
+    def unlock(self, master_key: bytes) -> None:
+        """Check the snapshot against the master key of its vault"""
+        enc_key, mac_key, digest_key = _derive_keys(master_key)
+        mac_at, index_at, blobs_at = self._mac_at, self._index_at, self._blobs_at
+        signed = self._map[:mac_at] + self._map[index_at:blobs_at]
+        mac = self._map[mac_at:index_at]
+        if not hmac.compare_digest(hmac.digest(mac_key, signed, "sha256"), mac):
+            raise ValueError("Snapshot is corrupt or of another vault!")
+        self._aead = AESGCM(enc_key)
+        self._digest_key = digest_key
+
+    def _check_unlocked(self) -> AESGCM:
+        if self._aead is None:
+            raise RuntimeError("Unlock the snapshot first!")
+        return self._aead
+
+    def _open(self, offset: int, length: int, aad: bytes) -> list:
+        aead = self._check_unlocked()
+        start = self._blobs_at + offset
+        end = start + length
+        blob = self._map[start:end]
+        return json.loads(aead.decrypt(blob[:NONCE_SIZE], blob[NONCE_SIZE:], aad))
+
+    def sites(self) -> list[str]:
+        """All sites, sorted"""
+        return self._open(0, self._sites_len, SITES_AAD)
+
+    def rows(self, site: str) -> list[tuple]:
+        """(salt, key_version, username token, password token) rows of a site"""
+        self._check_unlocked()
+        digest = _site_digest(self._digest_key, site)
+        lo, hi = 0, self._count
+        while lo < hi:  # Binary search of the mapped index
+            mid = (lo + hi) // 2
+            at = self._index_at + LENGTH.size + mid * RECORD.size
+            found, offset, length = RECORD.unpack_from(self._map, at)
+            if found == digest:
+                entries = self._open(offset, length, digest)
+                return [
+                    (base64.b64decode(s), v, base64.b64decode(u), base64.b64decode(p))
+                    for s, v, u, p in entries
+                ]
+            if found < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return []
+
+
+class SnapshotButler:
+    """Answers the read methods of Butler from a snapshot, without the database
+    :param snapshot: an open snapshot
+    :param root_key: unlocked root key
+    :param key_cache_size: maximum number of derived keys kept in memory
+    """
+
+    def __init__(self, snapshot: Snapshot, root_key: RootKey, key_cache_size=128):
+        if root_key.kdf == snapshot.kdf:
+            master_key = root_key.master_key  # Stretched when unlocking
+        else:
+            master_key = stretch(snapshot.kdf, root_key.password)
+        snapshot.unlock(master_key)
+        self._snapshot = snapshot
+        self._root_pw = root_key.password
+        self._master_key = bytearray(master_key)
+        self._keys = KeyCache(key_cache_size)
+        self._site_index: SiteIndex | None = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._keys.clear()
+        self._master_key[:] = bytes(len(self._master_key))
+
+    def _decrypt(
+        self, salt: bytes, version: int, token: bytes, site_name: str, column: str
+    ) -> str:
+        if version == LEGACY_KEY_VERSION:
+            key = self._keys.get(salt, self._root_pw)
+        elif version == HKDF_KEY_VERSION:
+            key = derive_row_key(bytes(self._master_key), salt)
+        elif version == AEAD_KEY_VERSION:
+            key = derive_aead_key(bytes(self._master_key), salt)
+        else:
+            raise ValueError(f"Unknown key version {version}!")
+        return decrypt_token(key, version, token, token_aad(site_name, column)).decode()
+
+    def retrieve_uname(self, site_name: str) -> list:
+        """Obtain usernames for a site / app"""
+        return [
+            self._decrypt(salt, version, uname, site_name, UNAME_COLUMN)
+            for salt, version, uname, _ in self._snapshot.rows(site_name)
+        ]
+
+    def retrieve_pword(self, site_name: str, uname: str) -> str:
+        """Obtain the password for a site and username, empty if not found"""
+        for salt, version, uname_token, pw_token in self._snapshot.rows(site_name):
+            if self._decrypt(salt, version, uname_token, site_name, UNAME_COLUMN) == (
+                uname
+            ):
+                return self._decrypt(salt, version, pw_token, site_name, PW_COLUMN)
+        return ""
+
+    def retrieve_many(self, pairs: Iterable[tuple]) -> dict:
+        """Passwords of (site, username) pairs, leaving out those not found"""
+        found = {}
+        for site_name, uname in pairs:
+            pw = self.retrieve_pword(site_name, uname)
+            if pw:
+                found[(site_name, uname)] = pw
+        return found
+
+    def retrieve_all(self, sort=True) -> list:
+        """Obtain all apps / sites"""
+        sites = self._snapshot.sites()
+        return sorted(sites, key=str.casefold) if sort else sites
+
+    def search_sites(self, query: str, limit: int = SEARCH_LIMIT) -> list:
+        """Sites matching the query, see Butler.search_sites"""
+        if self._site_index is None:
+            self._site_index = SiteIndex(self._snapshot.sites())
+        return self._site_index.search(query, limit)
+
+
+def database_changes(config_dir: str | os.PathLike = DB_CONF_PATH) -> int | None:
+    """Change counter of the database, None if it can't be reached. Talks to the
+    database directly, as a current snapshot spares loading SQLAlchemy
+    """
+    config = read_config(config_dir)
+    if config.get(BACKEND_KEY, POSTGRES_BACKEND) != POSTGRES_BACKEND:
+        import sqlite3
+
+        uri = f"{Path(config[SQLITE_PATH_KEY]).absolute().as_uri()}?mode=ro"
+        try:
+            with closing(sqlite3.connect(uri, uri=True)) as conn:
+                row = conn.execute(CHANGES_QUERY).fetchone()
+        except sqlite3.Error:
+            return None
+        return None if row is None else row[0]
+    from butler.health import service_healthy
+
+    if not service_healthy(config):
+        return None
+    import psycopg
+
+    with open(Path(config_dir) / DB_PW_FILE, "r") as f:
+        db_pw = f.read()
+    options = f"-csearch_path={config[SCHEMA_KEY]}" if config.get(SCHEMA_KEY) else None
+    try:
+        with psycopg.connect(
+            host=config[HOST_KEY],
+            port=config.getint(DB_PORT_KEY),
+            dbname=config[DB_NAME_KEY],
+            user=config[DB_USER_KEY],
+            password=db_pw,
+            options=options,
+            connect_timeout=CONNECT_TIMEOUT,
+        ) as conn:
+            pg_row = conn.execute(CHANGES_QUERY).fetchone()
+    except psycopg.Error:
+        return None
+    return None if pg_row is None else pg_row[0]
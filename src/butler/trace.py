@@ -0,0 +1,157 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Timings and counters of the stages of a command, shown by `butler --profile`.
+# Only static names and numbers are recorded, never arguments, so nothing secret
+# can end up in a profile or an exported span. Kept to the standard library, as
+# the CLI imports it before anything else.
+
+_enabled = False
+_tracer = None  # OpenTelemetry tracer, when exporting
+_provider = None  # OpenTelemetry provider we set up, flushed by shutdown
+_lock = threading.Lock()
+_local = threading.local()
+_spans: dict[tuple, list] = {}  # Path of span names -> [calls, seconds]
+_counters: dict[str, int] = {}
+
+
+def enable(otel: bool = False) -> None:
+    """Start recording
+    :param otel: also emit OpenTelemetry spans, needs the otel extra
+    """
+    global _enabled, _tracer
+    _enabled = True
+    if otel:
+        _tracer = _otel_tracer()
+
+
+def _otel_tracer():
+    global _provider
+    from opentelemetry import trace
+
+    try:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+            OTLPSpanExporter,
+        )
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:  # Only the API, use whatever provider is configured
+        return trace.get_tracer("pw_butler")
+    # Endpoint and headers come from the standard OTEL_EXPORTER_OTLP_* variables
+    _provider = TracerProvider()
+    _provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(_provider)
+    return trace.get_tracer("pw_butler")
+
+
+def shutdown() -> None:
+    """Flush exported spans"""
+    if _provider is not None:
+        _provider.shutdown()
+
+
+def reset() -> None:
+    """Stop recording and forget what was recorded"""
+    global _enabled, _tracer
+    _enabled = False
+    _tracer = None
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+def _stack() -> list:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def span(name: str):
+    """Time a stage, nested under the enclosing span of this thread"""
+    if not _enabled:
+        yield
+        return
+    stack = _stack()
+    stack.append(name)
+    path = tuple(stack)
+    with _lock:
+        entry = _spans.setdefault(path, [0, 0.0])  # Listed in order of first start
+    start = time.perf_counter()
+    try:
+        if _tracer is not None:
+            with _tracer.start_as_current_span(name):
+                yield
+        else:
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        with _lock:
+            entry[0] += 1
+            entry[1] += elapsed
+
+
+def traced(name: str):
+    """Decorator running a function in a span"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record(name: str, seconds: float) -> None:
+    """Add an externally timed stage, e.g. from a callback pair"""
+    if _enabled:
+        path = (*_stack(), name)
+        with _lock:
+            entry = _spans.setdefault(path, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+
+def count(name: str, n: int = 1) -> None:
+    """Increase an operation counter"""
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def snapshot() -> dict:
+    """Recorded spans as {"a > b": {"calls", "ms"}} and counters"""
+    with _lock:
+        spans = {
+            " > ".join(path): {"calls": calls, "ms": seconds * 1000}
+            for path, (calls, seconds) in _spans.items()
+        }
+        return {"spans": spans, "counters": dict(_counters)}
+
+
+def format_report() -> str:
+    """Breakdown of the recorded spans and counters"""
+    with _lock:
+        spans = list(_spans.items())
+        counters = sorted(_counters.items())
+    first_seen = {path: i for i, (path, _) in enumerate(spans)}
+    # Children right after their parents, otherwise in order of first start
+    spans.sort(
+        key=lambda item: [
+            first_seen.get(item[0][:k], -1) for k in range(1, len(item[0]) + 1)
+        ]
+    )
+    lines = [f"{'stage':<36} {'calls':>6} {'ms':>10}"]
+    for path, (calls, seconds) in spans:
+        label = "  " * (len(path) - 1) + path[-1]
+        lines.append(f"{label:<36} {calls:>6} {seconds * 1000:>10.1f}")
+    if counters:
+        lines.append("")
+        lines += [f"{name:<36} {n:>6}" for name, n in counters]
+    return "\n".join(lines)
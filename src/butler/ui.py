@@ -7,13 +7,11 @@ from getpass import getpass
 from importlib import resources
 
 import click
-import pyperclip  # type: ignore
-from python_on_whales import DockerClient, docker
-from python_on_whales.exceptions import NoSuchContainer, NoSuchVolume
 
-from butler.app import Butler
-from butler.authentication import AUTH_PATH, initialize, verify_password
-from butler.database import config_db
+from butler import trace
+
+# Heavy dependencies (python_on_whales, pyperclip, SQLAlchemy, cryptography) are
+# imported inside the commands that need them, so that e.g. --help starts fast.
 
 DB_CONTAINER = "butler-db-1"
 
@@ -23,10 +21,14 @@ def authenticate(func):
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
+        from butler.authentication import unlock
+
         password = getpass("Please enter root password: ").encode()
-        if verify_password(password):
+        with trace.span("authenticate"):
+            root = unlock(password)
+        if root is not None:
             logging.info("Authenticated")
-            func(password, *args, **kwargs)
+            func(root, *args, **kwargs)
         else:
             logging.error("Wrong password :(")
 
@@ -34,35 +36,223 @@ def authenticate(func):
 
 
 def get_docker():
+    from python_on_whales import DockerClient
+
     return DockerClient(compose_files=[resources.files() / "docker-compose.yml"])
 
 
+def uses_service() -> bool:
+    """Whether the configured backend is the docker service, rather than embedded"""
+    from butler.config import POSTGRES_BACKEND, get_backend
+
+    try:
+        return get_backend() == POSTGRES_BACKEND
+    except NotADirectoryError:
+        return True
+
+
+def container_running() -> bool:
+    """Ask Docker whether the database container exists"""
+    from python_on_whales import docker
+    from python_on_whales.exceptions import NoSuchContainer
+
+    try:
+        docker.container.inspect(DB_CONTAINER)
+        return True
+    except NoSuchContainer:
+        return False
+
+
 def check_status(func):
-    """A decorator to check the status of docker service"""
+    """A decorator to check the status of the database service. A recent healthy
+    probe is trusted, and Docker is only asked when the service doesn't answer
+    """
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
+        from butler import health
+        from butler.config import (
+            AUTO_UP_KEY,
+            BACKEND_KEY,
+            POSTGRES_BACKEND,
+            read_config,
+        )
+
         try:
-            docker.container.inspect(DB_CONTAINER)
-            logging.info("Service running.")
-            func(*args, **kwargs)
-        except NoSuchContainer:
+            config = read_config()
+        except NotADirectoryError:
+            config = None
+        if config is not None and config.get(BACKEND_KEY, POSTGRES_BACKEND) != (
+            POSTGRES_BACKEND
+        ):
+            return func(*args, **kwargs)
+        with trace.span("service.check"):
+            running = config is not None and health.service_healthy(config)
+            if not running:
+                running = container_running()
+            if not running and config is not None and config.getboolean(AUTO_UP_KEY):
+                logging.info("Starting background service.")
+                health.start_in_background()
+                running = True  # Connecting waits for it to come up
+        if not running:
             logging.error(
                 "Background service not running. See help page for more info."
             )
+            return
+        logging.info("Service running.")
+        func(*args, **kwargs)
+
+    return wrapper
+
+
+def local_butler(func, refresh_snapshot=False, unlocked=False):
+    """Run the command with a Butler of this process
+    :param refresh_snapshot: write the snapshot once the command is done
+    :param unlocked: the caller passes the unlocked root key instead of a prompt
+    """
+
+    def local(root, *args, **kwargs):
+        from butler.app import Butler
+
+        with Butler(root.password, root_key=root) as app:
+            func(app, *args, **kwargs)
+            if refresh_snapshot:
+                app.write_snapshot()
+
+    return check_status(local if unlocked else authenticate(local))
+
+
+def with_butler(func):
+    """A decorator to hand the command a Butler, served by the agent if running"""
+    local = local_butler(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        from butler.agent import connect_agent
+
+        with trace.span("agent.connect"):
+            agent = connect_agent()
+        if agent is not None:
+            logging.info("Using running agent.")
+            func(agent, *args, **kwargs)
+        else:
+            local(*args, **kwargs)
+
+    return wrapper
+
+
+def with_reader(func):
+    """Like with_butler, for commands that only read. With snapshots on, a current
+    snapshot answers without loading the database stack, and any snapshot answers
+    while the service is down
+    """
+    local = local_butler(func)
+    refreshing = local_butler(func, refresh_snapshot=True)
+    refresh_unlocked = local_butler(func, refresh_snapshot=True, unlocked=True)
+
+    @authenticate
+    def from_snapshot(root, snap, *args, **kwargs):
+        from butler.snapshot import SnapshotButler
+
+        try:
+            app = SnapshotButler(snap, root)
+        except ValueError as e:
+            logging.warning(f"{e} Refreshing it.")
+            return refresh_unlocked(root, *args, **kwargs)
+        with app:
+            func(app, *args, **kwargs)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        import time
+
+        from butler.agent import connect_agent
+        from butler.config import read_config
+        from butler.snapshot import (
+            Snapshot,
+            database_changes,
+            snapshot_enabled,
+            snapshot_path,
+        )
+
+        with trace.span("agent.connect"):
+            agent = connect_agent()
+        if agent is not None:
+            logging.info("Using running agent.")
+            return func(agent, *args, **kwargs)
+        try:
+            if not snapshot_enabled(read_config()):
+                return local(*args, **kwargs)
+        except NotADirectoryError:
+            return local(*args, **kwargs)
+        try:
+            snap = Snapshot(snapshot_path())
+        except (FileNotFoundError, ValueError):
+            return refreshing(*args, **kwargs)
+        with snap:
+            with trace.span("snapshot.check"):
+                changes = database_changes()
+            if changes is None:
+                written = time.strftime(
+                    "%Y-%m-%d %H:%M", time.localtime(snap.written_at)
+                )
+                logging.warning(
+                    f"Database unreachable, using the snapshot of {written}."
+                )
+                return from_snapshot(snap, *args, **kwargs)
+            if changes == snap.changes:
+                logging.info("Using current snapshot.")
+                return from_snapshot(snap, *args, **kwargs)
+        logging.info("Snapshot out of date.")
+        refreshing(*args, **kwargs)
 
     return wrapper
 
 
 @click.group()
-def cli():
+@click.option("--profile", is_flag=True, help="Print where the time went")
+@click.option(
+    "--otel", is_flag=True, help="Export spans over OTLP, needs the otel extra"
+)
+@click.pass_context
+def cli(ctx, profile, otel):
     logging.basicConfig(level=logging.INFO)
+    if profile or otel:
+        trace.enable(otel=otel)
+        ctx.call_on_close(functools.partial(finish_trace, profile))
+
+
+def finish_trace(profile: bool) -> None:
+    """Print the profile of the command and flush exported spans"""
+    trace.shutdown()
+    if profile:
+        click.echo(trace.format_report(), err=True)
 
 
 @click.command()
-def init():
+@click.option(
+    "--backend",
+    type=click.Choice(["postgres", "sqlite"]),
+    default="postgres",
+    show_default=True,
+    help="Postgres in docker, or an embedded SQLite file that needs no service",
+)
+@click.option(
+    "--kdf",
+    type=click.Choice(["scrypt", "argon2id", "pbkdf2-sha256"]),
+    default="scrypt",
+    show_default=True,
+    help="How the root password is stretched, tuned to this machine",
+)
+def init(backend, kdf):
     """Initialize a root password for authentication / encryption and initialize database"""
-    if os.path.isfile(AUTH_PATH):
+    from butler import health
+    from butler.authentication import AUTH_PATH, LEGACY_AUTH_PATH, initialize
+    from butler.config import DB_CONF_PATH, SQLITE_BACKEND, SQLITE_FILE, config_db
+    from butler.snapshot import snapshot_path
+    from butler.util import calibrate_kdf
+
+    if os.path.isfile(AUTH_PATH) or os.path.isfile(LEGACY_AUTH_PATH):
         logging.warning("Authentication file already exists.")
         go = input("Overwrite? (this would erase any old password data) (y/n): ")
         if go.lower() != "y":
@@ -73,19 +263,35 @@ def init():
     if password != pw2:
         logging.error("Passwords don't match!")
         return
-    initialize(password)
-    # Drop any existing db volume
-    try:
-        db_vol = docker.volume.inspect("butler_db")
-        logging.info("Erasing old data.")
-        db_vol.remove()
-    except NoSuchVolume:
-        pass
+    initialize(password, kdf=calibrate_kdf(kdf))
+    if os.path.isfile(LEGACY_AUTH_PATH):
+        os.unlink(LEGACY_AUTH_PATH)
+    # The snapshot and health probe of the old vault must not answer for the new one
+    snapshot_path().unlink(missing_ok=True)
+    health.forget()
+    if backend == SQLITE_BACKEND:
+        # Drop any existing db file, with its write-ahead log
+        for suffix in ("", "-wal", "-shm"):
+            db_file = DB_CONF_PATH / (SQLITE_FILE + suffix)
+            if db_file.exists():
+                logging.info("Erasing old data.")
+                db_file.unlink()
+    else:
+        from python_on_whales import docker
+        from python_on_whales.exceptions import NoSuchVolume
+
+        # Drop any existing db volume
+        try:
+            db_vol = docker.volume.inspect("butler_db")
+            logging.info("Erasing old data.")
+            db_vol.remove()
+        except NoSuchVolume:
+            pass
     # Config new db
     db_pw = "".join(
         secrets.choice(string.ascii_letters + string.digits) for _ in range(10)
     )
-    if config_db(password=db_pw):
+    if config_db(password=db_pw, backend=backend):
         logging.info("Database configured")
     else:
         logging.error("Failed to configure database")
@@ -94,10 +300,12 @@ def init():
 @click.command
 def up():
     """Start up backend services for CLI"""
-    try:
-        docker.container.inspect(DB_CONTAINER)
+    if not uses_service():
+        logging.info("Embedded database, no service needed.")
+        return
+    if container_running():
         logging.info("Service already running.")
-    except NoSuchContainer:
+    else:
         my_docker = get_docker()
         my_docker.compose.up(detach=True)
 
@@ -106,26 +314,38 @@ def up():
 @check_status
 def down():
     """Stop backend services"""
+    if not uses_service():
+        return
+    from butler.health import forget
+
     my_docker = get_docker()
     my_docker.compose.down()
+    forget()
 
 
 @click.command()
-@check_status
-@authenticate
-def ls(password):
+@with_reader
+def ls(app):
     """List all apps / sites"""
-    with Butler(password) as app:
-        all_sites = app.retrieve_all()
-        print("All entries:")
-        for site in all_sites:
-            print(site)
+    all_sites = app.retrieve_all()
+    print("All entries:")
+    for site in all_sites:
+        print(site)
 
 
 @click.command()
-@check_status
-@authenticate
-def add(password):
+@click.argument("query")
+@click.option("--limit", default=20, show_default=True, help="Most sites to show")
+@with_reader
+def search(app, query, limit):
+    """Find sites by name, prefix, substring or similar spelling"""
+    for site in app.search_sites(query, limit):
+        print(site)
+
+
+@click.command()
+@with_butler
+def add(app):
     """Add a new credential"""
     site_name = input("App / site name: ")
     username = input("Username: ")
@@ -134,19 +354,220 @@ def add(password):
     if pw2 != user_pw:
         logging.error("Passwords don't match!")
         return
-    with Butler(password) as app:
+    try:
         app.add(site_name, username, user_pw)
+    except ValueError as e:
+        logging.error(e)
+
+
+@click.command()
+@with_butler
+def update(app):
+    """Change the password of a credential"""
+    site_name = input("App / site name: ")
+    username = input("Username: ")
+    user_pw = getpass("New password: ")
+    pw2 = getpass("Please type in the password again: ")
+    if pw2 != user_pw:
+        logging.error("Passwords don't match!")
+        return
+    try:
+        app.update(site_name, username, user_pw)
+    except ValueError as e:
+        logging.error(e)
 
 
 @click.command
-@check_status
-@authenticate
-def remove(password):
+@with_butler
+def remove(app):
     """Remove an entry in database"""
     site_name = input("App / site name: ")
     username = input("Username: ")
-    with Butler(password) as app:
-        app.remove(site_name, username)
+    app.remove(site_name, username)
+
+
+IMPORT_FIELDS = ("site", "username", "password")
+
+
+def read_entries(path: str, fmt: str) -> list:
+    """Read (site, username, password) entries from a CSV or JSON file"""
+    import csv
+    import json
+
+    with open(path, "r", newline="") as f:
+        if fmt == "json":
+            records = json.load(f)
+        else:
+            records = list(csv.DictReader(f))
+    return [tuple(record[k] for k in IMPORT_FIELDS) for record in records]
+
+
+@cli.command("import")
+@click.argument("file", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["csv", "json"]),
+    default=None,
+    help="Input format, guessed from the file extension by default",
+)
+@click.option("--workers", type=int, default=None, help="Encryption processes")
+@click.option(
+    "--checkpoint",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Progress file for resuming, defaults to FILE.progress",
+)
+@check_status
+@authenticate
+def import_(root, file, fmt, workers, checkpoint):
+    """Import credentials from a CSV or JSON file with site, username and password"""
+    from butler.app import Butler
+
+    if fmt is None:
+        fmt = "json" if file.lower().endswith(".json") else "csv"
+    entries = read_entries(file, fmt)
+    with Butler(root.password, root_key=root) as app, click.progressbar(
+        length=len(entries), label="Importing"
+    ) as bar:
+        app.add_many(
+            entries,
+            workers=workers,
+            progress=bar.update,
+            checkpoint=checkpoint or file + ".progress",
+        )
+
+
+@cli.command
+@click.argument("file", type=click.Path(dir_okay=False))
+@check_status
+@authenticate
+def export(root, file):
+    """Write an encrypted backup of all credentials, protected by the root password"""
+    from butler.app import Butler
+
+    with Butler(root.password, root_key=root) as app:
+        try:
+            app.export(file)
+        except FileExistsError:
+            logging.error(f"{file} already exists!")
+
+
+@cli.command
+@click.argument("file", type=click.Path(exists=True, dir_okay=False))
+@check_status
+@authenticate
+def restore(root, file):
+    """Restore credentials from a backup written by export"""
+    from butler.app import Butler
+    from butler.backup import BackupError
+
+    password = getpass("Root password of the backup (empty for the current one): ")
+    with Butler(root.password, root_key=root) as app:
+        try:
+            app.restore(file, password.encode() or None)
+        except BackupError as e:
+            logging.error(e)
+
+
+@cli.command
+@check_status
+@authenticate
+def migrate(root):
+    """Upgrade the database and re-encrypt entries in the current key format"""
+    from butler.app import Butler
+    from butler.authentication import AUTH_PATH, write_auth
+
+    with Butler(root.password, root_key=root) as app:
+        try:
+            app.migrate()
+        except ValueError as e:
+            logging.error(e)
+            return
+        vault_key = app.vault_root_key()
+    if vault_key.kdf != root.kdf:  # Older vault, let unlocking yield its key
+        write_auth(AUTH_PATH, vault_key.kdf, vault_key.master_key)
+
+
+@cli.command
+@click.option(
+    "--kdf",
+    type=click.Choice(["scrypt", "argon2id", "pbkdf2-sha256"]),
+    default=None,
+    help="How the new root password is stretched, the current KDF by default",
+)
+@click.option("--workers", type=int, default=None, help="Encryption processes")
+@check_status
+@authenticate
+def rekey(root, kdf, workers):
+    """Change the root password, re-encrypting every entry. Rerun it to resume"""
+    from butler.agent import connect_agent
+    from butler.app import Butler
+    from butler.util import calibrate_kdf
+
+    client = connect_agent()
+    if client is not None:
+        client.stop()  # It holds the old keys
+        logging.info("Agent stopped.")
+    password = getpass("Please enter the new root password: ").encode()
+    if password != getpass("Please type it again: ").encode():
+        logging.error("Passwords don't match!")
+        return
+    with Butler(root.password, root_key=root) as app, click.progressbar(
+        length=app.count(), label="Re-encrypting"
+    ) as bar:
+        try:
+            app.rekey(
+                password,
+                kdf=calibrate_kdf(kdf) if kdf else None,
+                workers=workers,
+                progress=bar.update,
+            )
+        except ValueError as e:
+            logging.error(e)
+
+
+@cli.command
+@check_status
+@authenticate
+def snapshot(root):
+    """Write the encrypted snapshot that answers reads without the database"""
+    from butler.app import Butler
+
+    with Butler(root.password, root_key=root) as app:
+        app.write_snapshot()
+
+
+@cli.command
+@click.option(
+    "--backend",
+    "backends",
+    multiple=True,
+    type=click.Choice(["memory", "postgres"]),
+    default=["memory"],
+    show_default=True,
+    help="Database to run against, repeatable. postgres uses a scratch schema",
+)
+@click.option(
+    "--json",
+    "json_file",
+    type=click.File("w"),
+    default=None,
+    help="Also write the results as JSON, - for stdout only",
+)
+@click.option("--quick", is_flag=True, help="Fewer iterations, no 10k entry site")
+def bench(backends, json_file, quick):
+    """Measure key derivation, encryption and database operations"""
+    import json
+
+    from butler.benchmarks import format_table, report, run_suite
+
+    logging.getLogger().setLevel(logging.WARNING)  # Each benchmarked add logs
+    results = run_suite(backends, quick)
+    if json_file is None or json_file.name != "<stdout>":
+        print(format_table(results))
+    if json_file is not None:
+        json.dump(report(results), json_file, indent=2)
 
 
 @cli.command
@@ -164,12 +585,10 @@ def get():
 
 @get.command()
 @click.argument("site")
-@check_status
-@authenticate
-def uname(password, site):
+@with_reader
+def uname(app, site):
     """Retrieve username"""
-    with Butler(password) as app:
-        unames = app.retrieve_uname(site)
+    unames = app.retrieve_uname(site)
     if not unames:
         logging.error(f"No entry found for {site}")
     else:
@@ -181,12 +600,12 @@ def uname(password, site):
 @get.command()
 @click.argument("site")
 @click.argument("username")
-@check_status
-@authenticate
-def pword(password, site, username):
+@with_reader
+def pword(app, site, username):
     """Retrieve password for a site and username"""
-    with Butler(password) as app:
-        site_pword = app.retrieve_pword(site, username)
+    import pyperclip  # type: ignore
+
+    site_pword = app.retrieve_pword(site, username)
     if not site_pword:
         logging.error(f"No entry found for site {site} and username {username}.")
     else:
@@ -194,9 +613,106 @@ def pword(password, site, username):
         logging.info("Password copied to clip board!")
 
 
+@cli.group()
+def agent():
+    """Keep the vault unlocked in a background agent, like ssh-agent"""
+    pass
+
+
+@agent.command()
+@click.option(
+    "--idle-timeout",
+    default=900,
+    show_default=True,
+    help="Seconds without requests before the agent exits",
+)
+@click.option("--foreground", is_flag=True, help="Don't detach from the terminal")
+@check_status
+@authenticate
+def start(root, idle_timeout, foreground):
+    """Start the agent"""
+    from butler.agent import AgentServer, connect_agent
+    from butler.app import Butler
+    from butler.cache import CACHE_TTL
+
+    if connect_agent() is not None:
+        logging.error("Agent already running.")
+        return
+    if not foreground:
+        if os.fork():
+            logging.info("Agent started.")
+            return
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+    with Butler(root.password, root_key=root, cache_ttl=CACHE_TTL) as app:
+        AgentServer(app, idle_timeout=idle_timeout).serve()
+
+
+@agent.command()
+def stop():
+    """Stop the agent and forget the unlocked vault"""
+    from butler.agent import connect_agent
+
+    client = connect_agent()
+    if client is None:
+        logging.error("Agent not running.")
+    else:
+        client.stop()
+        logging.info("Agent stopped.")
+
+
+def env_name(site: str, username: str) -> str:
+    """Environment variable name for a credential"""
+    raw = f"{site}_{username}".upper()
+    return "BUTLER_" + "".join(c if c.isalnum() else "_" for c in raw)
+
+
+@get.command()
+@click.option(
+    "-e",
+    "--entry",
+    "entries",
+    type=(str, str),
+    multiple=True,
+    required=True,
+    metavar="SITE USERNAME",
+    help="A credential to retrieve, may be repeated",
+)
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["json", "env"]),
+    default="json",
+    show_default=True,
+    help="JSON object of sites to usernames to passwords, or NAME=value lines",
+)
+@with_reader
+def many(app, entries, fmt):
+    """Print passwords for many sites and usernames at once"""
+    import json
+    import shlex
+
+    found = app.retrieve_many(entries)
+    for site, username in entries:
+        if (site, username) not in found:
+            logging.error(f"No entry found for site {site} and username {username}.")
+    if fmt == "json":
+        nested: dict = {}
+        for (site, username), site_pword in found.items():
+            nested.setdefault(site, {})[username] = site_pword
+        print(json.dumps(nested, indent=2))
+    else:
+        for (site, username), site_pword in found.items():
+            print(f"{env_name(site, username)}={shlex.quote(site_pword)}")
+
+
 cli.add_command(add)
 cli.add_command(init)
 cli.add_command(ls)
 cli.add_command(up)
 cli.add_command(down)
 cli.add_command(remove)
+cli.add_command(search)
+cli.add_command(update)
@@ -1,39 +1,273 @@
 # Ref: https://cryptography.io/en/latest/fernet/#using-passwords-with-fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.fernet import Fernet
 import base64
+import hmac
 import os
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 
+from butler import trace
 
+LEGACY_KEY_VERSION = 1  # Per-row PBKDF2 of the root password
+HKDF_KEY_VERSION = 2  # Per-row HKDF of the vault master key
+AEAD_KEY_VERSION = 3  # As version 2, sealed by AES-GCM to the site and column
+CURRENT_KEY_VERSION = AEAD_KEY_VERSION
+ROW_KEY_INFO = b"pw_butler row key"
+AEAD_KEY_INFO = b"pw_butler row aead key"
+INDEX_KEY_INFO = b"pw_butler blind index"
+VERIFIER_INFO = b"pw_butler verifier"
+
+# Tokens of key version 3 are raw bytes: format | nonce | ciphertext | tag, about
+# 29 bytes over the secret where a Fernet token takes over 100 characters
+TOKEN_FORMAT = b"\x01"
+NONCE_SIZE = 12
+
+# Password stretching functions a vault master key can come from
+PBKDF2_KDF = "pbkdf2-sha256"
+SCRYPT_KDF = "scrypt"
+ARGON2_KDF = "argon2id"
+PBKDF2_ITERATIONS = 480000  # Used by vaults predating KDF choice, and as a floor
+CALIBRATION_TARGET = 0.25  # Seconds one stretch should take on this machine
+
+
+@trace.traced("kdf")
 def derive_key(salt: bytes, pw: bytes) -> bytes:
     """Derive encryption key using a password and salt"""
+    trace.count("kdf")
     kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=480000)
     return base64.urlsafe_b64encode(kdf.derive(pw))
 
 
+def legacy_kdf(salt: bytes) -> dict:
+    """KDF of the master key of vaults predating KDF choice"""
+    return {
+        "name": PBKDF2_KDF,
+        "salt": base64.b64encode(salt).decode(),
+        "iterations": PBKDF2_ITERATIONS,
+    }
+
+
+@trace.traced("kdf")
+def stretch(kdf: dict, pw: bytes) -> bytes:
+    """Stretch a password into a raw 32 byte key with the KDF described by kdf"""
+    trace.count("kdf")
+    salt = base64.b64decode(kdf["salt"])
+    if kdf["name"] == PBKDF2_KDF:
+        return PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            iterations=kdf["iterations"],
+        ).derive(pw)
+    if kdf["name"] == SCRYPT_KDF:
+        return Scrypt(salt=salt, length=32, n=kdf["n"], r=kdf["r"], p=kdf["p"]).derive(
+            pw
+        )
+    if kdf["name"] == ARGON2_KDF:
+        from cryptography.hazmat.primitives.kdf.argon2 import Argon2id  # >= 44.0
+
+        return Argon2id(
+            salt=salt,
+            length=32,
+            iterations=kdf["iterations"],
+            lanes=kdf["lanes"],
+            memory_cost=kdf["memory_cost"],
+        ).derive(pw)
+    raise ValueError(f"Unknown KDF {kdf['name']}!")
+
+
+def calibrate_kdf(name: str = SCRYPT_KDF, target: float = CALIBRATION_TARGET) -> dict:
+    """Pick KDF parameters taking about target seconds per stretch here"""
+    kdf: dict = {"name": name, "salt": base64.b64encode(os.urandom(16)).decode()}
+    if name == PBKDF2_KDF:
+        kdf["iterations"] = probe = 50000
+        scale = target / _time_stretch(kdf)
+        kdf["iterations"] = max(PBKDF2_ITERATIONS, int(probe * scale))
+    elif name == SCRYPT_KDF:
+        kdf |= {"n": 2**14, "r": 8, "p": 1}  # 16 MiB
+        while kdf["n"] < 2**17 and _time_stretch(kdf) < target / 2:
+            kdf["n"] *= 2
+    elif name == ARGON2_KDF:
+        kdf |= {"iterations": 1, "lanes": 4, "memory_cost": 64 * 1024}  # 64 MiB
+        scale = target / _time_stretch(kdf)
+        kdf["iterations"] = min(10, max(2, int(scale)))
+    else:
+        raise ValueError(f"Unknown KDF {name}!")
+    return kdf
+
+
+def _time_stretch(kdf: dict) -> float:
+    start = time.perf_counter()
+    stretch(kdf, b"calibration")
+    return time.perf_counter() - start
+
+
+def derive_verifier(master_key: bytes) -> bytes:
+    """Value proving knowledge of the master key without revealing it"""
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=VERIFIER_INFO)
+    return hkdf.derive(master_key)
+
+
+def derive_row_key(master_key: bytes, salt: bytes) -> bytes:
+    """Cheaply derive a per-row encryption key from the vault master key"""
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=ROW_KEY_INFO)
+    return base64.urlsafe_b64encode(hkdf.derive(master_key))
+
+
+def derive_aead_key(master_key: bytes, salt: bytes) -> bytes:
+    """Per-row AES-GCM key, kept apart from the Fernet key of the same salt"""
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=AEAD_KEY_INFO)
+    return hkdf.derive(master_key)
+
+
+def token_aad(site: str, column: str) -> bytes:
+    """Associated data binding a token to its site and column, so that tokens
+    can't be swapped between rows or between username and password
+    """
+    return TOKEN_FORMAT + column.encode() + b"\0" + site.encode()
+
+
+def derive_index_key(master_key: bytes) -> bytes:
+    """Derive the blind index key from the vault master key"""
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=INDEX_KEY_INFO)
+    return hkdf.derive(master_key)
+
+
+def blind_index(index_key: bytes, site: str, username: str) -> bytes:
+    """Deterministic keyed digest identifying a (site, username) pair"""
+    raw_site = site.encode()
+    msg = len(raw_site).to_bytes(4, "big") + raw_site + username.encode()
+    return hmac.digest(index_key, msg, "sha256")
+
+
+class KeyCache:
+    """In-memory LRU cache of keys derived from (salt, root password)
+    :param maxsize: maximum number of keys to hold
+    """
+
+    def __init__(self, maxsize: int = 128):
+        if maxsize < 1:
+            raise ValueError("Cache size must be positive!")
+        self.maxsize = maxsize
+        self._keys: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def lookup(self, salt: bytes, pw: bytes) -> bytes | None:
+        """Return a cached key, or None on a miss"""
+        cache_key = (bytes(salt), pw)
+        with self._lock:
+            key = self._keys.get(cache_key)
+            if key is None:
+                return None
+            self._keys.move_to_end(cache_key)
+            return bytes(key)
+
+    def store(self, salt: bytes, pw: bytes, key: bytes) -> None:
+        """Cache a key derived elsewhere"""
+        with self._lock:
+            self._keys[(bytes(salt), pw)] = bytearray(key)
+            if len(self._keys) > self.maxsize:
+                _, evicted = self._keys.popitem(last=False)
+                evicted[:] = bytes(len(evicted))
+
+    def get(self, salt: bytes, pw: bytes) -> bytes:
+        """Return the key for salt and password, deriving it on a miss"""
+        key = self.lookup(salt, pw)
+        if key is None:
+            key = derive_key(bytes(salt), pw)
+            self.store(salt, pw, key)
+        return key
+
+    def clear(self) -> None:
+        """Overwrite and drop all cached keys"""
+        with self._lock:
+            for key in self._keys.values():
+                key[:] = bytes(len(key))
+            self._keys.clear()
+
+
+def _get_key(root_pw: bytes, salt: bytes, cache: KeyCache | None) -> bytes:
+    if cache is None:
+        return derive_key(salt, root_pw)
+    return cache.get(salt, root_pw)
+
+
 def hash_pw(pw: bytes) -> tuple:
     """Convenience function to hash a password"""
     salt = os.urandom(16)
     return salt, derive_key(salt, pw)
 
 
-def encrypt_wrapper(root_pw: bytes, secret: bytes) -> tuple:
+def encrypt_wrapper(
+    root_pw: bytes, secret: bytes, cache: KeyCache | None = None
+) -> tuple:
     """Symmetrically encrypt a secret and return the token and salt"""
     salt = os.urandom(16)
-    token = encrypt_with_salt(root_pw, salt, secret)
+    token = encrypt_with_salt(root_pw, salt, secret, cache)
     return token, salt
 
 
-def encrypt_with_salt(root_pw: bytes, salt: bytes, secret: bytes) -> bytes:
+def encrypt_with_salt(
+    root_pw: bytes, salt: bytes, secret: bytes, cache: KeyCache | None = None
+) -> bytes:
     """Symmetrically encrypt a secret with root password and salt"""
-    key = derive_key(salt, root_pw)
+    key = _get_key(root_pw, salt, cache)
     f = Fernet(key)
     return f.encrypt(secret)
 
 
-def decrypt_with_salt(root_pw: bytes, salt: bytes, token: bytes) -> bytes:
+def decrypt_with_salt(
+    root_pw: bytes, salt: bytes, token: bytes, cache: KeyCache | None = None
+) -> bytes:
     """Decrypt a token"""
-    key = derive_key(salt, root_pw)
+    key = _get_key(root_pw, salt, cache)
     f = Fernet(key)
     return f.decrypt(token)
+
+
+def encrypt_with_key(key: bytes, secret: bytes) -> bytes:
+    """Symmetrically encrypt a secret with an already derived key"""
+    trace.count("encrypt")
+    return Fernet(key).encrypt(secret)
+
+
+def decrypt_with_key(key: bytes, token: bytes) -> bytes:
+    """Decrypt a token with an already derived key"""
+    trace.count("decrypt")
+    return Fernet(key).decrypt(token)
+
+
+def seal(key: bytes, secret: bytes, aad: bytes) -> bytes:
+    """Encrypt a secret into a token of key version 3"""
+    trace.count("encrypt")
+    nonce = os.urandom(NONCE_SIZE)
+    return TOKEN_FORMAT + nonce + AESGCM(key).encrypt(nonce, secret, aad)
+
+
+def unseal(key: bytes, token: bytes, aad: bytes) -> bytes:
+    """Decrypt a token of key version 3"""
+    trace.count("decrypt")
+    if token[:1] != TOKEN_FORMAT:
+        raise ValueError("Unknown token format!")
+    nonce_end = len(TOKEN_FORMAT) + NONCE_SIZE
+    nonce, ciphertext = token[1:nonce_end], token[nonce_end:]
+    return AESGCM(key).decrypt(nonce, ciphertext, aad)
+
+
+def decrypt_token(key: bytes, version: int, token: bytes, aad: bytes) -> bytes:
+    """Decrypt a token of any key version with the row key of that version
+    :param aad: see token_aad, not bound to tokens older than version 3
+    """
+    if version == AEAD_KEY_VERSION:
+        return unseal(key, bytes(token), aad)
+    return decrypt_with_key(key, bytes(token))
@@ -7,7 +7,15 @@ import pytest
 from sqlalchemy import insert
 from sqlalchemy.orm import Session
 
-from butler.database import PW_KEY, SALT_KEY, SITE_KEY, UNAME_KEY, Database, config_db
+from butler.database import (
+    PW_KEY,
+    SALT_KEY,
+    SITE_KEY,
+    UNAME_KEY,
+    UNINDEXED_NAME,
+    Database,
+    config_db,
+)
 from butler.util import encrypt_with_salt
 
 ROOT_PW = b"root_password"
@@ -32,10 +40,17 @@ def get_db_config(docker_ip, docker_services):
             raise RuntimeError("Failed to config db.")
 
 
+@pytest.fixture
+def get_sqlite_config():
+    with TemporaryDirectory() as _dir:
+        config_db(password="", config_dir=_dir, backend="sqlite")
+        yield _dir
+
+
 @pytest.fixture(scope="session")
 def obtain_db(get_db_config):
     db = Database(config_dir=get_db_config)
-    db.reflect()
+    db.prepare()
     yield db
     db.close()
 
@@ -56,8 +71,8 @@ def random_data(site=None):
     uname_token = encrypt_with_salt(ROOT_PW, salt, username.encode())
     return {
         SALT_KEY: salt,
-        UNAME_KEY: uname_token.decode(),
-        PW_KEY: pw_token.decode(),
+        UNAME_KEY: uname_token,
+        PW_KEY: pw_token,
         SITE_KEY: site,
         UNAME_RAW_KEY: username,
         PW_RAW_KEY: pw,
@@ -80,6 +95,7 @@ def populate_db(obtain_db, prepare_data):
     with obtain_db.Session() as sess:
         with sess.begin():
             sess.execute(stmt)
+            obtain_db.set_meta(sess, UNINDEXED_NAME, b"1")  # As migrations flag it
     return obtain_db
 
 
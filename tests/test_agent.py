@@ -0,0 +1,68 @@
+import os
+import stat
+import threading
+import time
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from butler.agent import AgentError, AgentServer, connect_agent
+from butler.app import Butler
+from butler.database import EntryNotFoundError
+
+from .conftest import PW_RAW_KEY, ROOT_PW, SITE_NAME, UNAME_RAW_KEY
+
+
+@pytest.fixture
+def run_agent(populate_db, get_db_config):
+    with TemporaryDirectory() as _dir, Butler(ROOT_PW, db_dir=get_db_config) as app:
+        server = AgentServer(app, os.path.join(_dir, "agent.sock"), idle_timeout=5)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        yield server
+        server._stopped = True
+        thread.join()
+
+
+def test_retrieve(run_agent, prepare_data):
+    client = connect_agent(run_agent.socket_path)
+    assert client.retrieve_all() == [SITE_NAME]
+    assert client.search_sites(SITE_NAME[:3]) == [SITE_NAME]
+    assert client.retrieve_uname(SITE_NAME) == [prepare_data[UNAME_RAW_KEY]]
+    pw = client.retrieve_pword(SITE_NAME, prepare_data[UNAME_RAW_KEY])
+    assert pw == prepare_data[PW_RAW_KEY]
+    pair = (SITE_NAME, prepare_data[UNAME_RAW_KEY])
+    assert client.retrieve_many([pair]) == {pair: prepare_data[PW_RAW_KEY]}
+
+
+def test_errors(run_agent):
+    client = connect_agent(run_agent.socket_path)
+    with pytest.raises(AgentError, match="Unknown"):
+        client.call("migrate")
+    with pytest.raises(AgentError, match="Unknown"):
+        client.call("_get_master_key")
+    with pytest.raises(EntryNotFoundError):
+        client.update(SITE_NAME, "nobody", "pw")
+
+
+def test_socket_permissions(run_agent):
+    mode = stat.S_IMODE(os.stat(run_agent.socket_path).st_mode)
+    assert mode == 0o600
+
+
+def test_stop(run_agent):
+    connect_agent(run_agent.socket_path).stop()
+    for _ in range(50):
+        if not os.path.exists(run_agent.socket_path):
+            break
+        time.sleep(0.1)
+    assert connect_agent(run_agent.socket_path) is None
+
+
+def test_idle_timeout(populate_db, get_db_config):
+    with TemporaryDirectory() as _dir, Butler(ROOT_PW, db_dir=get_db_config) as app:
+        path = os.path.join(_dir, "agent.sock")
+        server = AgentServer(app, path, idle_timeout=0)
+        server.serve()
+        assert not os.path.exists(path)
+        assert connect_agent(path) is None
@@ -0,0 +1,107 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from butler.aio import AsyncButler
+from butler.database import REKEY_NAME
+
+from .conftest import PW_RAW_KEY, ROOT_PW, SITE_NAME, UNAME_RAW_KEY, random_raw
+
+
+@pytest.fixture
+def run_butler(populate_db, get_db_config):
+    """Run a coroutine function against an entered AsyncButler"""
+
+    def run(func, executor=None):
+        async def main():
+            async with AsyncButler(ROOT_PW, get_db_config, executor=executor) as app:
+                return await func(app)
+
+        return asyncio.run(main())
+
+    return run
+
+
+def test_retrieve(run_butler, prepare_data):
+    async def retrieve(app):
+        return await asyncio.gather(
+            app.retrieve_all(),
+            app.retrieve_uname(SITE_NAME),
+            app.retrieve_pword(SITE_NAME, prepare_data[UNAME_RAW_KEY]),
+        )
+
+    sites, unames, pw = run_butler(retrieve)
+    assert sites == [SITE_NAME]
+    assert unames == [prepare_data[UNAME_RAW_KEY]]
+    assert pw == prepare_data[PW_RAW_KEY]
+
+
+def test_add_remove(run_butler):
+    entries = [random_raw() for _ in range(3)]
+
+    async def add_remove(app):
+        await asyncio.gather(*(app.add(*entry) for entry in entries))
+        pws = await asyncio.gather(
+            *(app.retrieve_pword(site, uname) for site, uname, _ in entries)
+        )
+        with pytest.raises(ValueError, match="exists"):
+            await app.add(*entries[0])
+        await asyncio.gather(*(app.remove(site, uname) for site, uname, _ in entries))
+        remaining = await asyncio.gather(
+            *(app.retrieve_uname(site) for site, _, _ in entries)
+        )
+        return pws, remaining
+
+    with ThreadPoolExecutor() as executor:
+        pws, remaining = run_butler(add_remove, executor)
+    assert pws == [pw for _, _, pw in entries]
+    assert remaining == [[], [], []]
+
+
+def test_add_during_rekey(run_butler, populate_db):
+    site, uname, pw = random_raw()
+
+    async def add(app):
+        await app.retrieve_uname(site)  # Keys derived before the rekey started
+        with populate_db.Session() as sess:
+            populate_db.set_meta(sess, REKEY_NAME, b"{}")
+            sess.commit()
+        with pytest.raises(RuntimeError, match="unfinished"):
+            await app.add(site, uname, pw)
+
+    try:
+        run_butler(add)
+    finally:
+        with populate_db.Session() as sess:
+            populate_db.delete_meta(sess, REKEY_NAME)
+            sess.commit()
+    assert run_butler(lambda app: app.retrieve_uname(site)) == []
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    def __init__(self):
+        super().__init__()
+        self.submitted = 0
+
+    def submit(self, fn, /, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(fn, *args, **kwargs)
+
+
+def test_crypto_inline(run_butler):
+    entries = [random_raw() for _ in range(3)]
+
+    async def add_retrieve(app):
+        assert app._database.replicas is not None  # Set up like a Database
+        for entry in entries:
+            await app.add(*entry)
+        pws = await asyncio.gather(
+            *(app.retrieve_pword(site, uname) for site, uname, _ in entries)
+        )
+        await asyncio.gather(*(app.remove(site, uname) for site, uname, _ in entries))
+        return pws
+
+    with CountingExecutor() as executor:
+        assert run_butler(add_retrieve, executor) == [pw for _, _, pw in entries]
+    assert executor.submitted == 1  # Only stretching the root password
@@ -1,11 +1,48 @@
+import json
+import os
+import tracemalloc
+from types import SimpleNamespace
+
 import pytest
-from sqlalchemy import select
+from cryptography.exceptions import InvalidTag
+from sqlalchemy import event, select
+
+from butler import app as app_module
+from butler import util
+from butler.app import Butler, encrypt_entry
+from butler.authentication import initialize, unlock
+from butler.backup import BackupError, read_backup, write_backup
+from butler.database import (
+    LOOKUP_KEY,
+    PW_KEY,
+    REKEY_NAME,
+    SALT_KEY,
+    SITE_KEY,
+    UNAME_KEY,
+    UNINDEXED_NAME,
+    VERSION_KEY,
+    EntryExistsError,
+    EntryNotFoundError,
+)
+from butler.util import (
+    AEAD_KEY_VERSION,
+    HKDF_KEY_VERSION,
+    decrypt_with_salt,
+    derive_row_key,
+    encrypt_with_key,
+)
 
-from butler.app import Butler
-from butler.database import PW_KEY, SALT_KEY, UNAME_KEY
-from butler.util import decrypt_with_salt
+from .conftest import (
+    PW_RAW_KEY,
+    ROOT_PW,
+    SITE_NAME,
+    UNAME_RAW_KEY,
+    get_db_data,
+    random_data,
+    random_raw,
+)
 
-from .conftest import ROOT_PW, SITE_NAME, UNAME_RAW_KEY, random_raw
+FAST_KDF = {"name": util.SCRYPT_KDF, "salt": "c2FsdA==", "n": 2**10, "r": 8, "p": 1}
 
 
 @pytest.fixture(scope="module")
@@ -21,15 +58,15 @@ def test_retrieve_all(get_butler, prepare_data):
 
 def test_retrieve_uname(get_butler, prepare_data):
     unames = get_butler.retrieve_uname(SITE_NAME)
-    uname_token = prepare_data[UNAME_KEY].encode()
+    uname_token = prepare_data[UNAME_KEY]
     uname = decrypt_with_salt(ROOT_PW, prepare_data[SALT_KEY], uname_token)
     assert unames == [uname.decode()]
 
 
 def test_retrieve_pword(get_butler, prepare_data):
-    pword_token = prepare_data[PW_KEY].encode()
+    pword_token = prepare_data[PW_KEY]
     pw = decrypt_with_salt(ROOT_PW, prepare_data[SALT_KEY], pword_token).decode()
-    uname_token = prepare_data[UNAME_KEY].encode()
+    uname_token = prepare_data[UNAME_KEY]
     uname = decrypt_with_salt(ROOT_PW, prepare_data[SALT_KEY], uname_token).decode()
     pw_retrieve = get_butler.retrieve_pword(SITE_NAME, uname)
     assert pw_retrieve == pw
@@ -42,6 +79,63 @@ def test_add(get_butler, get_session, populate_db):
     stmt = select(table).where(table.c.app_site == site)
     rows = get_session.execute(stmt).all()
     assert len(rows) == 1
+    row = rows[0]
+    assert getattr(row, VERSION_KEY) == AEAD_KEY_VERSION
+    assert get_butler._decrypt_row(row) == (uname, pw)
+    assert getattr(row, LOOKUP_KEY) == get_butler._lookup(site, uname)
+
+
+def test_read_token_formats(get_butler, get_session, populate_db):
+    site, uname, pw = random_raw()
+    salt = os.urandom(16)
+    key = derive_row_key(get_butler._get_master_key(), salt)
+    entry = {  # Fernet tokens of key version 2, as stored before AEAD tokens
+        SITE_KEY: site,
+        SALT_KEY: salt,
+        UNAME_KEY: encrypt_with_key(key, uname.encode()),
+        PW_KEY: encrypt_with_key(key, pw.encode()),
+        VERSION_KEY: HKDF_KEY_VERSION,
+        LOOKUP_KEY: get_butler._lookup(site, uname),
+    }
+    populate_db.add(get_session, entry)
+    other = random_raw()
+    get_butler.add(*other, get_session)
+    assert get_butler.retrieve_many(
+        [(site, uname), other[:2]], session=get_session
+    ) == {
+        (site, uname): pw,
+        other[:2]: other[2],
+    }
+
+
+def test_token_bound_to_site(get_butler, get_session, populate_db):
+    site, uname, pw = random_raw()
+    get_butler.add(site, uname, pw, get_session)
+    table = populate_db._cred_table
+    row = get_session.execute(select(table).where(table.c.app_site == site)).one()
+    moved = SimpleNamespace(**{**row._mapping, SITE_KEY: site + "x"})
+    with pytest.raises(InvalidTag):
+        get_butler._decrypt_row(moved)
+
+
+def test_add_duplicate(get_butler, get_session):
+    site, uname, pw = random_raw()
+    get_butler.add(site, uname, pw, get_session)
+    with pytest.raises(EntryExistsError, match="exists"):
+        get_butler.add(site, uname, pw, get_session)
+
+
+def test_update(get_butler, get_session, prepare_data, populate_db):
+    uname = prepare_data[UNAME_RAW_KEY]
+    table = populate_db._cred_table
+    stmt = select(table).where(table.c.app_site == SITE_NAME)
+    for pw in ("rotated", "rotated again"):  # Unindexed row, then indexed
+        get_butler.update(SITE_NAME, uname, pw, get_session)
+        row = get_session.execute(stmt).one()
+        assert get_butler._decrypt_row(row) == (uname, pw)
+        assert getattr(row, LOOKUP_KEY) == get_butler._lookup(SITE_NAME, uname)
+    with pytest.raises(EntryNotFoundError):
+        get_butler.update(SITE_NAME, "nobody", "pw", get_session)
 
 
 def test_remove(get_butler, get_session, prepare_data, populate_db):
@@ -50,3 +144,319 @@ def test_remove(get_butler, get_session, prepare_data, populate_db):
     stmt = select(table).where(table.c.app_site == SITE_NAME)
     rows = get_session.execute(stmt).all()
     assert len(rows) == 0
+
+
+def test_migrate(get_db_config, get_session, prepare_data, populate_db):
+    # Not the shared Butler, which would take the rolled back migration as done
+    with Butler(ROOT_PW, db_dir=get_db_config) as app:
+        assert app.migrate(get_session) == 1
+        table = populate_db._cred_table
+        stmt = select(table).where(table.c.app_site == SITE_NAME)
+        row = get_session.execute(stmt).one()
+        assert getattr(row, VERSION_KEY) == AEAD_KEY_VERSION
+        assert app._decrypt_row(row) == (
+            prepare_data[UNAME_RAW_KEY],
+            prepare_data[PW_RAW_KEY],
+        )
+        lookup = app._lookup(SITE_NAME, prepare_data[UNAME_RAW_KEY])
+        assert getattr(row, LOOKUP_KEY) == lookup
+        assert populate_db.get_meta(get_session, UNINDEXED_NAME) is None
+
+
+def test_one_derivation_per_salt(get_db_config, prepare_data, monkeypatch):
+    calls = []
+    derive = util.derive_key
+
+    def counting(salt, pw):
+        calls.append(salt)
+        return derive(salt, pw)
+
+    monkeypatch.setattr(util, "derive_key", counting)
+    with Butler(ROOT_PW, db_dir=get_db_config) as app:
+        uname = app.retrieve_uname(SITE_NAME)[0]
+        app.retrieve_pword(SITE_NAME, uname)
+        app.retrieve_uname(SITE_NAME)
+    assert len(calls) == len(set(calls))
+    assert prepare_data[SALT_KEY] in calls
+    assert len(app._keys) == 0
+
+
+def test_add_many(get_butler, get_session, populate_db):
+    entries = [random_raw() for _ in range(3)]
+    entries.append(entries[0])
+    added = get_butler.add_many(entries, workers=2, batch_size=2, session=get_session)
+    assert added == 3
+    table = populate_db._cred_table
+    for site, uname, pw in entries:
+        stmt = select(table).where(table.c.app_site == site)
+        row = get_session.execute(stmt).one()
+        assert get_butler._decrypt_row(row)[1] == pw
+    # Everything exists already
+    assert get_butler.add_many(entries, workers=1, session=get_session) == 0
+
+
+def test_add_many_resume(get_butler, get_session, tmp_path):
+    entries = [random_raw() for _ in range(4)]
+    checkpoint = tmp_path / "import.progress"
+    checkpoint.write_text(json.dumps({"done": 2}))
+    added = get_butler.add_many(entries, checkpoint=checkpoint, session=get_session)
+    assert added == 2
+    assert not checkpoint.exists()
+    for i, (site, _, _) in enumerate(entries):
+        found = get_butler._database.get_uname(get_session, site)
+        assert len(found) == (1 if i >= 2 else 0)  # Only those after the checkpoint
+
+
+def test_export_restore(get_butler, get_session, prepare_data, tmp_path):
+    entries = [random_raw() for _ in range(3)]
+    get_butler.add_many(entries, workers=1, session=get_session)
+    path = tmp_path / "vault.backup"
+    assert get_butler.export(path, session=get_session) == 4
+    exported = list(read_backup(open(path, "rb"), ROOT_PW))
+    assert set(entries) < set(exported)
+    legacy = (SITE_NAME, prepare_data[UNAME_RAW_KEY], prepare_data[PW_RAW_KEY])
+    assert legacy in exported
+    assert get_butler.restore(path, workers=1, session=get_session) == 0
+    assert get_butler.retrieve_uname(SITE_NAME) == [prepare_data[UNAME_RAW_KEY]]
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    with pytest.raises(FileExistsError):
+        get_butler.export(path, session=get_session)
+
+
+def test_restore_other_password(get_butler, get_session, tmp_path):
+    path = tmp_path / "old.backup"
+    entry = random_raw()
+    with open(path, "wb") as f:  # Written before a root password change
+        write_backup(f, b"old pw", [entry])
+    with pytest.raises(BackupError, match="Wrong password"):
+        get_butler.restore(path, session=get_session)
+    assert get_butler.restore(path, b"old pw", workers=1, session=get_session) == 1
+    found = get_butler.retrieve_many([entry[:2]], session=get_session)
+    assert found == {entry[:2]: entry[2]}
+
+
+def test_export_memory(get_butler, get_session):
+    get_butler.add_many(
+        (random_raw() for _ in range(3000)), workers=1, session=get_session
+    )
+    tracemalloc.start()
+    everything = list(get_butler.export_iter(session=get_session))
+    _, full_peak = tracemalloc.get_traced_memory()
+    del everything
+    tracemalloc.reset_peak()
+    # Free lists of the interpreter keep some of the freed memory traced
+    before, _ = tracemalloc.get_traced_memory()
+    with open(os.devnull, "wb") as f:
+        write_backup(f, ROOT_PW, get_butler.export_iter(100, get_session), 100)
+    _, stream_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert stream_peak - before < full_peak / 3
+
+
+def test_retrieve_many(get_butler, get_session, prepare_data):
+    entries = [random_raw() for _ in range(3)]
+    get_butler.add_many(entries, workers=1, session=get_session)
+    legacy = (SITE_NAME, prepare_data[UNAME_RAW_KEY])
+    pairs = [(site, uname) for site, uname, _ in entries] + [legacy, ("no", "one")]
+    found = get_butler.retrieve_many(pairs, session=get_session)
+    expected = {(site, uname): pw for site, uname, pw in entries}
+    expected[legacy] = prepare_data[PW_RAW_KEY]
+    assert found == expected
+
+
+def test_sqlite_butler(get_sqlite_config):
+    site, uname, pw = random_raw()
+    with Butler(ROOT_PW, db_dir=get_sqlite_config) as app:
+        app.add(site, uname, pw)
+        assert app.retrieve_all() == [site]
+        assert app.retrieve_uname(site) == [uname]
+        assert app.retrieve_pword(site, uname) == pw
+        app.remove(site, uname)
+        assert app.retrieve_uname(site) == []
+
+
+def test_search_sites(get_sqlite_config):
+    with Butler(ROOT_PW, db_dir=get_sqlite_config) as app:
+        app.add_many([(site, "user", "pw") for site in ("github.com", "gitlab.com")])
+        assert app.search_sites("githb") == ["github.com"]
+        app.add("GitHub", "user", "pw")
+        assert app.search_sites("github") == ["GitHub", "github.com"]
+        app.remove("GitHub", "user")
+        app.add("bank", "user", "pw")  # Reuses the id of the removed entry
+        assert app.search_sites("git") == ["github.com", "gitlab.com"]
+        with Butler(ROOT_PW, db_dir=get_sqlite_config) as other:  # Same count and id
+            other.remove("bank", "user")
+            other.add("gitea.io", "user", "pw")
+        assert app.search_sites("git") == ["gitea.io", "github.com", "gitlab.com"]
+
+
+def test_root_key(get_sqlite_config, tmp_path, monkeypatch):
+    root = initialize(ROOT_PW, tmp_path / "auth.json", FAST_KDF)
+    calls = []
+    monkeypatch.setattr(app_module, "stretch", lambda *args: calls.append(args))
+    site, uname, pw = random_raw()
+    with Butler(ROOT_PW, db_dir=get_sqlite_config, root_key=root) as app:
+        app.add(site, uname, pw)
+        assert app.retrieve_pword(site, uname) == pw
+        assert app.vault_root_key() == root
+    assert calls == []  # Unlocking already stretched the password
+
+
+def test_root_key_older_vault(get_butler, get_db_config, tmp_path):
+    root = initialize(ROOT_PW, tmp_path / "auth.json", util.calibrate_kdf())
+    with Butler(ROOT_PW, db_dir=get_db_config, root_key=root) as app:
+        vault_key = app.vault_root_key()
+    assert vault_key.kdf != root.kdf
+    assert vault_key.master_key == get_butler._get_master_key()
+
+
+def vault_with_legacy_row(config_dir) -> tuple:
+    """Entries added by Butler, plus one row in the legacy key format"""
+    entries = [(f"site{i}", "user", f"pw{i}") for i in range(7)]
+    legacy = random_data()
+    with Butler(ROOT_PW, db_dir=config_dir) as app:
+        app.add_many(entries, workers=1)
+        with app.session_factory() as sess:
+            app._database.add(sess, get_db_data(legacy))
+            app._database.set_meta(sess, UNINDEXED_NAME, b"1")
+            sess.commit()
+    return entries + [(legacy[SITE_KEY], legacy[UNAME_RAW_KEY], legacy[PW_RAW_KEY])]
+
+
+def test_legacy_duplicates(get_sqlite_config, tmp_path):
+    site, uname, pw = vault_with_legacy_row(get_sqlite_config)[-1]
+    with Butler(ROOT_PW, db_dir=get_sqlite_config) as app:
+        with pytest.raises(EntryExistsError, match="exists"):
+            app.add(site, uname, "other")
+        assert app.retrieve_uname(site) == [uname]
+        with app.session_factory() as sess:  # As older versions could store it
+            entry = encrypt_entry(
+                app._get_master_key(), app._get_index_key(), site, uname, "other"
+            )
+            app._database.add(sess, entry)
+        with pytest.raises(EntryExistsError, match="twice"):
+            app.migrate()
+        with pytest.raises(EntryExistsError, match="twice"):
+            app.rekey(b"new pw", FAST_KDF, tmp_path / "auth.json", workers=1)
+        assert app.retrieve_pword(site, uname) == "other"  # Still usable
+        app.remove(site, uname)
+        assert app.migrate() == 1
+        assert app.retrieve_pword(site, uname) == pw
+
+
+class Statements(list):
+    """Statements sent through an engine while in the context"""
+
+    def __init__(self, engine):
+        super().__init__()
+        self._engine = engine
+
+    def _record(self, conn, cursor, statement, *args):
+        self.append(statement)
+
+    def __enter__(self):
+        event.listen(self._engine, "before_cursor_execute", self._record)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        event.remove(self._engine, "before_cursor_execute", self._record)
+
+
+def test_unindexed_scan(get_sqlite_config):
+    entries = vault_with_legacy_row(get_sqlite_config)
+    with Butler(ROOT_PW, db_dir=get_sqlite_config) as app:
+        app.add("new", "user", "pw")  # Derives the keys
+        with Statements(app._database.engine) as statements:
+            app.add("newer", "user", "pw")
+        assert any("lookup IS NULL" in stmt for stmt in statements)
+        assert app.migrate() == 1
+        with app.session_factory() as sess:
+            assert app._database.get_meta(sess, UNINDEXED_NAME) is None
+    with Butler(ROOT_PW, db_dir=get_sqlite_config) as app:
+        app.retrieve_pword(*entries[0][:2])
+        with Statements(app._database.engine) as statements:
+            app.add("newest", "user", "pw")
+            app.add_many([("many", "user", "pw")], workers=1)
+            with pytest.raises(EntryExistsError):
+                app.add(*entries[-1])
+        assert not any("lookup IS NULL" in stmt for stmt in statements)
+
+
+def test_one_statement_per_write(get_sqlite_config):
+    with Butler(ROOT_PW, db_dir=get_sqlite_config) as app:
+        app.add("times", "me", "pw")  # Derives the keys
+        for write, args in [
+            (app.add, ("news", "me", "pw")),
+            (app.update, ("news", "me", "new pw")),
+            (app.remove, ("news", "me")),
+        ]:
+            with Statements(app._database.engine) as statements:
+                write(*args)
+            assert len(statements) == 1, statements
+
+
+def test_rekey(get_sqlite_config, tmp_path):
+    entries = vault_with_legacy_row(get_sqlite_config)
+    auth_file = tmp_path / "auth.json"
+    with Butler(ROOT_PW, db_dir=get_sqlite_config) as app:
+        assert app.rekey(b"new pw", FAST_KDF, auth_file, workers=2, batch_size=3) == 8
+        assert app.retrieve_pword(*entries[-1][:2]) == entries[-1][2]
+    assert unlock(b"new pw", auth_file).kdf == FAST_KDF
+    with Butler(b"new pw", db_dir=get_sqlite_config) as app:
+        assert app.retrieve_many([entry[:2] for entry in entries]) == {
+            entry[:2]: entry[2] for entry in entries
+        }
+        assert app.migrate() == 0  # All in the current key format
+
+
+def test_writes_follow_rekey(get_sqlite_config, tmp_path):
+    entries = vault_with_legacy_row(get_sqlite_config)
+    with Butler(ROOT_PW, db_dir=get_sqlite_config) as stale:
+        assert stale.retrieve_pword(*entries[0][:2]) == entries[0][2]
+        with stale.session_factory() as sess:
+            stale._database.set_meta(sess, REKEY_NAME, b"{}")
+            sess.commit()
+        with pytest.raises(RuntimeError, match="unfinished"):
+            stale.add("new", "user", "pw")
+        with pytest.raises(RuntimeError, match="unfinished"):
+            stale.remove(*entries[0][:2])
+        with stale.session_factory() as sess:
+            stale._database.delete_meta(sess, REKEY_NAME)
+            sess.commit()
+        with Butler(ROOT_PW, db_dir=get_sqlite_config) as app:
+            app.rekey(b"new pw", FAST_KDF, tmp_path / "auth.json", workers=1)
+            app.add("new", "user", "pw")
+        with pytest.raises(RuntimeError, match="changed"):
+            stale.update("new", "user", "under the old key")
+    with Butler(b"new pw", db_dir=get_sqlite_config) as app:
+        assert app.retrieve_pword("new", "user") == "pw"
+
+
+def test_rekey_resume(get_sqlite_config, tmp_path, monkeypatch):
+    entries = vault_with_legacy_row(get_sqlite_config)
+    auth_file = tmp_path / "auth.json"
+    batches = []
+
+    def crash(sess, rows):
+        if batches:
+            raise KeyboardInterrupt
+        batches.append(rows)
+        update_many(sess, rows)
+
+    with Butler(ROOT_PW, db_dir=get_sqlite_config) as app:
+        update_many = app._database.update_tokens_many
+        monkeypatch.setattr(app._database, "update_tokens_many", crash)
+        with pytest.raises(KeyboardInterrupt):
+            app.rekey(b"new pw", FAST_KDF, auth_file, workers=1, batch_size=3)
+    assert not auth_file.exists()
+    with Butler(ROOT_PW, db_dir=get_sqlite_config) as app:
+        with pytest.raises(RuntimeError, match="unfinished"):
+            app.retrieve_pword(*entries[0][:2])
+    with Butler(ROOT_PW, db_dir=get_sqlite_config) as app:
+        with pytest.raises(ValueError, match="another root password"):
+            app.rekey(b"other pw", FAST_KDF, auth_file, workers=1)
+    with Butler(ROOT_PW, db_dir=get_sqlite_config) as app:
+        assert app.rekey(b"new pw", auth_file=auth_file, workers=1) == 5
+    with Butler(b"new pw", db_dir=get_sqlite_config) as app:
+        assert app.retrieve_pword(*entries[-1][:2]) == entries[-1][2]
+        assert app.retrieve_pword(*entries[0][:2]) == entries[0][2]
@@ -1,6 +1,15 @@
+import base64
+import json
+import os
+import pickle
 import tempfile
 
-from butler.authentication import initialize, verify_password
+import pytest
+
+from butler.authentication import initialize, unlock, verify_password
+from butler.util import SCRYPT_KDF, hash_pw, stretch
+
+FAST_KDF = {"name": SCRYPT_KDF, "salt": "c2FsdA==", "n": 2**10, "r": 8, "p": 1}
 
 
 def test_auth(monkeypatch):
@@ -9,3 +18,46 @@ def test_auth(monkeypatch):
     with tempfile.NamedTemporaryFile() as auth_file:
         initialize(pw, auth_file.name)
         assert verify_password(pw, auth_file.name)
+
+
+def test_unlock(tmp_path):
+    auth_file = tmp_path / "auth.json"
+    root = initialize(b"password", auth_file, FAST_KDF)
+    with open(auth_file) as f:
+        content = json.load(f)
+    assert content["kdf"] == FAST_KDF
+    assert os.stat(auth_file).st_mode & 0o077 == 0
+    unlocked = unlock(b"password", auth_file)
+    assert unlocked == root
+    assert unlocked.master_key == stretch(FAST_KDF, b"password")
+    assert unlock(b"wrong", auth_file) is None
+
+
+def test_legacy_auth(tmp_path):
+    legacy_file, auth_file = tmp_path / "auth.bin", tmp_path / "auth.json"
+    salt, pw_hash = hash_pw(b"password")
+    with open(legacy_file, "wb") as f:
+        pickle.dump((salt, pw_hash), f)
+    assert unlock(b"wrong", auth_file, legacy_file) is None
+    root = unlock(b"password", auth_file, legacy_file)
+    assert root.kdf["name"] == SCRYPT_KDF
+    assert root.master_key != base64.urlsafe_b64decode(pw_hash)
+    assert base64.b64encode(root.master_key).decode() not in auth_file.read_text()
+    assert not legacy_file.exists()
+    assert unlock(b"password", auth_file) == root
+
+
+def test_verify_legacy_sibling(tmp_path):
+    with open(tmp_path / "auth.bin", "wb") as f:
+        pickle.dump(hash_pw(b"password"), f)
+    auth_file = tmp_path / "auth.json"
+    assert verify_password(b"password", auth_file)  # Not the one in the home dir
+    assert auth_file.exists() and not (tmp_path / "auth.bin").exists()
+
+
+def test_legacy_auth_objects(tmp_path):
+    legacy_file = tmp_path / "auth.bin"
+    with open(legacy_file, "wb") as f:
+        pickle.dump((os.system, "true"), f)
+    with pytest.raises(pickle.UnpicklingError):
+        unlock(b"password", tmp_path / "auth.json", legacy_file)
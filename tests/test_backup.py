@@ -0,0 +1,34 @@
+import io
+
+import pytest
+
+from butler.backup import BackupError, read_backup, write_backup
+
+ROOT_PW = b"root_password"
+ENTRIES = [("site", "user", "pw"), ("other", "me", "secret")] * 3
+
+
+@pytest.fixture
+def backup():
+    f = io.BytesIO()
+    write_backup(f, ROOT_PW, ENTRIES, chunk_size=4)
+    return f.getvalue()
+
+
+def test_roundtrip(backup):
+    assert list(read_backup(io.BytesIO(backup), ROOT_PW)) == ENTRIES
+
+
+def test_wrong_password(backup):
+    with pytest.raises(BackupError, match="password"):
+        list(read_backup(io.BytesIO(backup), b"wrong"))
+
+
+def test_truncated(backup):
+    with pytest.raises(BackupError, match="truncated"):
+        list(read_backup(io.BytesIO(backup[:-10]), ROOT_PW))
+
+
+def test_not_backup():
+    with pytest.raises(BackupError, match="Not"):
+        list(read_backup(io.BytesIO(b"hello"), ROOT_PW))
@@ -0,0 +1,30 @@
+import json
+
+from butler.benchmarks import format_table, report, storage
+from butler.benchmarks.runner import measure, percentile
+
+
+def test_percentile():
+    timings = [float(i) for i in range(1, 101)]
+    assert percentile(timings, 50) == 50
+    assert percentile(timings, 99) == 99
+    assert percentile([3.0], 99) == 3
+
+
+def test_measure():
+    calls = []
+    result = measure("noop", "none", calls.append, 10)
+    assert calls == list(range(10))
+    assert result.n == 10
+    assert 0 <= result.p50_ms <= result.p99_ms
+
+
+def test_storage_memory():
+    with storage.memory_config() as config_dir:
+        results = storage.run(config_dir, storage.MEMORY_BACKEND, quick=True)
+    names = {r.name for r in results}
+    assert {"add", "lookup_pword_100_per_site", "list_sites"} <= names
+    assert all(r.backend == storage.MEMORY_BACKEND for r in results)
+    content = json.loads(json.dumps(report(results)))
+    assert content["results"][0]["name"] == results[0].name
+    assert "list_sites" in format_table(results)
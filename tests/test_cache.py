@@ -0,0 +1,92 @@
+import time
+
+import pytest
+
+from butler import trace
+from butler.app import Butler
+from butler.cache import CredentialCache
+
+from .conftest import ROOT_PW, random_raw
+
+
+def test_cache():
+    cache = CredentialCache(maxsize=2)
+    cache.put(("a", 1), ["pw1"], cache.generation)
+    cache.put(("a", 2), ["pw2"], cache.generation)
+    assert cache.get(("a", 1)) == ["pw1"]
+    cache.put(("b",), ["me", "you"], cache.generation)  # Evicts ("a", 2)
+    assert cache.get(("a", 2)) is None
+    assert cache.get(("b",)) == ["me", "you"]
+    held = cache._entries[("a", 1)][1][0]
+    cache.invalidate("a")
+    assert cache.get(("a", 1)) is None and len(cache) == 1
+    assert held == bytearray(3)  # Wiped
+
+
+def test_stale_put():
+    cache = CredentialCache()
+    generation = cache.generation
+    cache.invalidate("a")  # Changed while reading
+    cache.put(("a",), ["old"], generation)
+    assert cache.get(("a",)) is None
+
+
+def test_expiry():
+    cache = CredentialCache(ttl=-1)
+    cache.put(("a",), ["pw"], cache.generation)
+    assert cache.get(("a",)) is None
+    with pytest.raises(ValueError):
+        CredentialCache(maxsize=0)
+
+
+def hits() -> int:
+    return trace.snapshot()["counters"].get("cache.hits", 0)
+
+
+def test_embedded_cache(get_sqlite_config):
+    site, uname, pw = random_raw()
+    trace.enable()
+    try:
+        with Butler(ROOT_PW, db_dir=get_sqlite_config, cache_ttl=60) as app:
+            app.add(site, uname, pw)
+            assert app.retrieve_pword(site, uname) == pw
+            assert app.retrieve_pword(site, uname) == pw
+            assert app.retrieve_uname(site) == [uname]
+            assert hits() == 1
+            with Butler(ROOT_PW, db_dir=get_sqlite_config) as other:
+                other.update(site, uname, "new pw")
+            assert app.retrieve_pword(site, uname) == "new pw"
+            app.remove(site, uname)
+            assert app.retrieve_uname(site) == []
+    finally:
+        trace.reset()
+
+
+def wait_for(check, timeout=5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_notified_cache(populate_db, get_db_config):
+    site, uname, pw = random_raw()
+    trace.enable()
+    try:
+        with Butler(ROOT_PW, db_dir=get_db_config, cache_ttl=60) as app, Butler(
+            ROOT_PW, db_dir=get_db_config
+        ) as other:
+            assert wait_for(app._listener.listening.is_set)
+            other.add(site, uname, pw)
+            assert app.retrieve_pword(site, uname) == pw
+            assert app.retrieve_pword(site, uname) == pw
+            assert hits() == 1
+            other.update(site, uname, "new pw")
+            assert wait_for(lambda: app.retrieve_pword(site, uname) == "new pw")
+            other.remove(site, uname)
+            assert wait_for(lambda: app.retrieve_uname(site) == [])
+        assert app._listener is None
+    finally:
+        trace.reset()
@@ -1,8 +1,25 @@
-import pandas as pd
+import pytest
 from pytest import raises
-from sqlalchemy import select
-
-from butler.database import PW_KEY, SALT_KEY, SITE_KEY, UNAME_KEY
+from sqlalchemy import insert, select, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from butler import migrations
+from butler.database import (
+    LOOKUP_KEY,
+    PW_KEY,
+    SALT_KEY,
+    SITE_KEY,
+    UNAME_KEY,
+    UNINDEXED_NAME,
+    VERSION_KEY,
+    Database,
+    EntryExistsError,
+    EntryNotFoundError,
+    UsernameToken,
+    retry_connect,
+    to_dataframe,
+)
+from butler.util import LEGACY_KEY_VERSION
 
 from .conftest import SITE_NAME, get_db_data, random_data
 
@@ -17,15 +34,42 @@ def test_get_all_sites(prepare_data, populate_db, get_session):
     assert sites == [prepare_data[SITE_KEY]]
 
 
+def test_get_all_sites_distinct(prepare_data, populate_db, get_session):
+    for site in ("b_site", "a_site", "b_site"):
+        populate_db.add(get_session, get_db_data(random_data(site)))
+    sites = populate_db.get_all_sites(get_session)
+    assert sites == sorted({prepare_data[SITE_KEY], "a_site", "b_site"})
+
+
+def test_search_sites(populate_db, get_session):
+    for site in ("github.com", "GitHub", "my-github", "git_hub", "gitXhub"):
+        populate_db.add(get_session, get_db_data(random_data(site)))
+    found = populate_db.search_sites(get_session, "github")
+    assert found[:3] == ["GitHub", "github.com", "my-github"]
+    assert populate_db.search_sites(get_session, "git_", limit=5) == ["git_hub"]
+
+
 def test_get_uname(prepare_data, populate_db, get_session):
+    expected = [
+        UsernameToken(
+            prepare_data[UNAME_KEY], prepare_data[SALT_KEY], LEGACY_KEY_VERSION
+        )
+    ]
+    uname = populate_db.get_uname(get_session, prepare_data[SITE_KEY])
+    assert expected == uname
+
+
+def test_to_dataframe(prepare_data, populate_db, get_session):
+    pd = pytest.importorskip("pandas")
     expected = pd.DataFrame.from_dict(
         {
             UNAME_KEY: [prepare_data[UNAME_KEY]],
             SALT_KEY: [prepare_data[SALT_KEY]],
+            VERSION_KEY: [LEGACY_KEY_VERSION],
         }
     )
     uname = populate_db.get_uname(get_session, prepare_data[SITE_KEY])
-    assert expected.equals(uname)
+    assert expected.equals(to_dataframe(uname))
 
 
 def test_get_pw(prepare_data, populate_db, get_session):
@@ -36,9 +80,16 @@ def test_get_pw(prepare_data, populate_db, get_session):
     assert expected_token == getattr(result, PW_KEY)
 
 
+def test_init_meta(populate_db, get_session):
+    assert populate_db.init_meta(get_session, "test_meta", b"first") == b"first"
+    assert populate_db.init_meta(get_session, "test_meta", b"second") == b"first"
+
+
 def test_add_duplicate(prepare_data, populate_db, get_session):
-    with raises(ValueError, match="exists"):
+    with raises(EntryExistsError, match="exists"):
         populate_db.add(get_session, get_db_data(prepare_data))
+    populate_db.add_many(get_session, [get_db_data(prepare_data)])  # Skipped
+    assert len(populate_db.get_uname(get_session, prepare_data[SITE_KEY])) == 1
 
 
 def test_add(populate_db, get_session):
@@ -57,3 +108,135 @@ def test_remove(populate_db, get_session, prepare_data):
     )
     res = get_session.execute(query).all()
     assert len(res) == 0, "Entry still exists!"
+
+
+def test_get_by_lookup(populate_db, get_session):
+    data = get_db_data(random_data())
+    data[LOOKUP_KEY] = b"lookup digest"
+    populate_db.add(get_session, data)
+    row = populate_db.get_by_lookup(get_session, b"lookup digest")
+    assert getattr(row, PW_KEY) == data[PW_KEY]
+    assert populate_db.get_by_lookup(get_session, b"missing") is None
+
+
+def test_remove_by_lookup(populate_db, get_session):
+    data = get_db_data(random_data())
+    data[LOOKUP_KEY] = b"lookup digest"
+    populate_db.add(get_session, data)
+    populate_db.remove_by_lookup(get_session, b"lookup digest")
+    assert populate_db.get_by_lookup(get_session, b"lookup digest") is None
+    with raises(EntryNotFoundError, match="exist"):
+        populate_db.remove_by_lookup(get_session, b"lookup digest")
+
+
+def test_update(prepare_data, populate_db, get_session):
+    data = get_db_data(random_data(prepare_data[SITE_KEY]))
+    data[LOOKUP_KEY] = b"lookup digest"
+    populate_db.update(get_session, data, prepare_data[UNAME_KEY])
+    row = populate_db.get_by_lookup(get_session, b"lookup digest")
+    assert getattr(row, PW_KEY) == data[PW_KEY]
+    data[PW_KEY] = b"new token"
+    populate_db.update(get_session, data)
+    row = populate_db.get_by_lookup(get_session, b"lookup digest")
+    assert getattr(row, PW_KEY) == b"new token"
+    with raises(EntryNotFoundError):
+        populate_db.update(get_session, data, prepare_data[UNAME_KEY])
+
+
+def test_sqlite_backend(get_sqlite_config):
+    db = Database(config_dir=get_sqlite_config)
+    assert db.embedded
+    db.prepare()
+    assert not db.needs_upgrade()
+    data = get_db_data(random_data())
+    data[LOOKUP_KEY] = b"lookup digest"
+    with db.Session() as sess:
+        assert sess.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert db.init_meta(sess, "test_meta", b"first") == b"first"
+        assert db.init_meta(sess, "test_meta", b"second") == b"first"
+        db.add(sess, data)
+        with raises(ValueError, match="exists"):
+            db.add(sess, data)
+        assert db.get_all_sites(sess) == [data[SITE_KEY]]
+        row = db.get_by_lookup(sess, b"lookup digest")
+        assert getattr(row, PW_KEY) == data[PW_KEY]
+        db.remove_by_lookup(sess, b"lookup digest")
+        assert db.get_all_sites(sess) == []
+    db.close()
+
+
+def test_change_counter(get_sqlite_config):
+    db = Database(config_dir=get_sqlite_config)
+    db.prepare()
+    data = get_db_data(random_data())
+    data[LOOKUP_KEY] = b"lookup digest"
+    with db.Session() as sess:
+        start = db.get_changes(sess)
+        db.add(sess, data)
+        db.update(sess, data)
+        db.remove_by_lookup(sess, b"lookup digest")
+        assert db.get_changes(sess) == start + 3
+    db.close()
+
+
+def test_schema_version(obtain_db):
+    with obtain_db.engine.connect() as conn:
+        assert migrations.get_version(conn) == migrations.SCHEMA_VERSION
+
+
+def test_sqlite_upgrade(get_sqlite_config):
+    db = Database(config_dir=get_sqlite_config)
+    db.prepare()
+    with db.engine.begin() as conn:  # As created before schema versions
+        conn.execute(text("DROP INDEX credential_site_username_idx"))
+        conn.execute(text("DELETE FROM vault"))
+    assert db.needs_upgrade()
+    db.upgrade()
+    assert not db.needs_upgrade()
+    data = get_db_data(random_data())
+    with db.Session() as sess:
+        db.add(sess, data)
+        with raises(IntegrityError):
+            sess.execute(insert(db._cred_table).values(**data))
+    db.close()
+
+
+def test_sqlite_binary_tokens(get_sqlite_config):
+    db = Database(config_dir=get_sqlite_config)
+    db.prepare()
+    data = get_db_data(random_data())
+    with db.engine.begin() as conn:  # Tokens as text, like schema version 7 had
+        conn.execute(
+            text(
+                "INSERT INTO credential (app_site, salt, username, password) "
+                "VALUES (:site, :salt, :uname, :pw)"
+            ),
+            {
+                "site": data[SITE_KEY],
+                "salt": data[SALT_KEY],
+                "uname": data[UNAME_KEY].decode(),
+                "pw": data[PW_KEY].decode(),
+            },
+        )
+        migrations.set_version(conn, 7)
+    db.upgrade()
+    with db.Session() as sess:
+        token = db.get_pw(sess, data[SITE_KEY], data[UNAME_KEY])
+        assert db.get_meta(sess, UNINDEXED_NAME) is not None  # Not indexed yet
+    assert token.password == data[PW_KEY]
+    db.close()
+
+
+def test_retry_connect():
+    attempts = []
+
+    def probe(ready_after: int):
+        attempts.append(1)
+        if len(attempts) < ready_after:
+            raise OperationalError("SELECT 1", {}, Exception("not ready"))
+        return 4
+
+    assert retry_connect(lambda: probe(3), 5) == 4
+    assert len(attempts) == 3
+    with raises(OperationalError):
+        retry_connect(lambda: probe(100), 0.2)
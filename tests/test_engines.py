@@ -0,0 +1,56 @@
+import os
+from configparser import ConfigParser
+from pathlib import Path
+
+from sqlalchemy import text
+
+from butler.config import INI_NAME, INI_SECTION, POOL_SIZE_KEY, SQLITE_FILE
+from butler.database import Database
+from butler.engines import dispose_engines, get_engine
+
+
+def test_shared_engine(get_sqlite_config):
+    first = Database(config_dir=get_sqlite_config)
+    first.close()
+    second = Database(config_dir=get_sqlite_config)
+    assert first.engine is second.engine
+    dispose_engines()
+    assert get_engine(get_sqlite_config) is not second.engine
+    dispose_engines()
+
+
+def test_pool_metrics(get_sqlite_config):
+    db = Database(config_dir=get_sqlite_config)
+    for _ in range(3):
+        with db.Session() as sess:
+            sess.execute(text("SELECT 1"))
+    metrics = db.pool_metrics()
+    assert metrics["checkouts"] == 3
+    assert metrics["connects"] == 1  # Reused from the pool
+    assert metrics["idle"] == 1
+    assert metrics["wait_max"] >= 0
+    dispose_engines()
+
+
+def test_pool_config(get_sqlite_config):
+    config = ConfigParser()
+    path = Path(get_sqlite_config) / INI_NAME
+    config.read(path)
+    config[INI_SECTION][POOL_SIZE_KEY] = "2"
+    with open(path, "w") as f:
+        config.write(f)
+    assert get_engine(get_sqlite_config).pool.size() == 2
+    dispose_engines()
+
+
+def test_sqlite_private(get_sqlite_config):
+    db = Database(config_dir=get_sqlite_config)
+    db.prepare()
+    with db.Session() as sess:
+        sess.execute(text("SELECT 1"))
+        files = [f for f in os.listdir(get_sqlite_config) if f.startswith(SQLITE_FILE)]
+        assert {SQLITE_FILE, SQLITE_FILE + "-wal", SQLITE_FILE + "-shm"} <= set(files)
+        for name in files:
+            assert os.stat(Path(get_sqlite_config) / name).st_mode & 0o777 == 0o600
+    assert os.stat(get_sqlite_config).st_mode & 0o777 == 0o700
+    dispose_engines()
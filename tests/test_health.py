@@ -0,0 +1,43 @@
+import socket
+from configparser import ConfigParser
+
+from butler import health
+from butler.config import DB_PORT_KEY, HOST_KEY
+
+
+def make_config(port: int):
+    parser = ConfigParser()
+    parser["db"] = {HOST_KEY: "127.0.0.1", DB_PORT_KEY: str(port)}
+    return parser["db"]
+
+
+def test_probe():
+    with socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        port = server.getsockname()[1]
+        assert health.probe("127.0.0.1", port)
+    assert not health.probe("127.0.0.1", port)
+
+
+def test_cached_health(tmp_path, monkeypatch):
+    state_file = tmp_path / "health.json"
+    answers = [True]
+    monkeypatch.setattr(health, "probe", lambda *_: answers[0])
+    config = make_config(5432)
+    assert health.service_healthy(config, state_file)
+    answers[0] = False
+    assert health.service_healthy(config, state_file)  # Cached
+    assert not health.service_healthy(make_config(5433), state_file)  # Other target
+    assert not state_file.exists()
+
+
+def test_cache_expires(tmp_path, monkeypatch):
+    state_file = tmp_path / "health.json"
+    answers = [True]
+    monkeypatch.setattr(health, "probe", lambda *_: answers[0])
+    config = make_config(5432)
+    assert health.service_healthy(config, state_file)
+    answers[0] = False
+    assert not health.service_healthy(config, state_file, ttl=0)
+    health.forget(state_file)  # Nothing to forget
@@ -0,0 +1,100 @@
+import shutil
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from butler import database
+from butler.app import Butler
+from butler.config import SQLITE_FILE, config_db, get_replicas
+from butler.database import SITE_KEY, Database
+from butler.engines import dispose_engines
+
+from .conftest import ROOT_PW, get_db_data, random_data
+
+
+@pytest.fixture
+def replicated():
+    """Embedded primary with two copies standing in for replicas, each holding
+    one site the others lack
+    """
+    with TemporaryDirectory() as _dir:
+        config_db(password="", config_dir=_dir, backend="sqlite")
+        primary = Path(_dir) / SQLITE_FILE
+        db = Database(config_dir=_dir)
+        db.prepare()
+        db.close()
+        dispose_engines()
+        replicas = []
+        for name in ("a", "b"):
+            replica = Path(_dir) / f"{name}.db"
+            shutil.copy(primary, replica)
+            replicas.append(str(replica))
+        config_db(password="", config_dir=_dir, backend="sqlite", replicas=replicas)
+        db = Database(config_dir=_dir)
+        for name, engine in zip(("a", "b"), db.replicas.engines):
+            with engine.connect() as conn:
+                db.add(conn, get_db_data(random_data(name)))
+        yield _dir
+        dispose_engines()
+
+
+def sites_read(db: Database) -> list:
+    with db.Session() as sess:
+        return db.get_all_sites(sess)
+
+
+def test_config(replicated):
+    assert [Path(p).name for p in get_replicas(replicated)] == ["a.db", "b.db"]
+
+
+def test_reads_take_turns(replicated):
+    db = Database(config_dir=replicated)
+    seen = [sites_read(db) for _ in range(4)]
+    assert sorted(seen) == [["a"], ["a"], ["b"], ["b"]]
+    assert seen[0] != seen[1]
+
+
+def test_read_your_writes(replicated):
+    db = Database(config_dir=replicated)
+    data = get_db_data(random_data("primary"))
+    with db.Session() as sess:
+        assert db.get_all_sites(sess) in (["a"], ["b"])
+        db.add(sess, data)
+        assert db.get_all_sites(sess) == [data[SITE_KEY]]
+    with db.engine.connect() as conn:
+        assert db.get_all_sites(conn) == ["primary"]
+
+
+def test_replica_down(replicated, tmp_path):
+    db = Database(config_dir=replicated)
+    db.replicas.mark_down(db.replicas.engines[0])
+    assert [sites_read(db) for _ in range(3)] == [["b"]] * 3
+    db.replicas.mark_down(db.replicas.engines[1])
+    assert sites_read(db) == []  # The primary
+
+
+def test_unreachable_replica(replicated):
+    missing = Path(replicated) / "missing" / "a.db"
+    replicas = [str(missing), str(Path(replicated) / "b.db")]
+    config_db(password="", config_dir=replicated, backend="sqlite", replicas=replicas)
+    db = Database(config_dir=replicated)
+    assert [sites_read(db) for _ in range(3)] == [["b"]] * 3
+
+
+def test_cache_reads_primary(replicated):
+    with Butler(ROOT_PW, db_dir=replicated, cache_ttl=60) as app:
+        assert app.retrieve_uname("site") == []
+        with Butler(ROOT_PW, db_dir=replicated) as other:
+            other.add("site", "me", "pw")  # Never reaches the replicas
+        assert app.retrieve_uname("site") == ["me"]
+        assert app.retrieve_pword("site", "me") == "pw"
+
+
+def test_butler_reads_own_writes(replicated, monkeypatch):
+    with Butler(ROOT_PW, db_dir=replicated) as app:
+        app.add("site", "me", "pw")  # Never reaches the replicas
+        assert app.retrieve_pword("site", "me") == "pw"
+        assert app.retrieve_uname("site") == ["me"]
+        monkeypatch.setattr(database, "READ_OWN_WRITES", 0.0)
+        assert app.retrieve_uname("site") == []  # Back to the replicas
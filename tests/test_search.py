@@ -0,0 +1,39 @@
+from butler.search import SiteIndex, escape_like, similarity, trigrams
+
+SITES = ["GitHub", "github.com", "gitlab.com", "my-github", "gist", "bank", "Google"]
+
+
+def test_trigrams():
+    # As pg_trgm's show_trgm('word')
+    assert trigrams("Word") == {"  w", " wo", "wor", "ord", "rd "}
+    assert trigrams("a.b") == {"  a", " a ", "  b", " b "}
+    assert trigrams("..") == set()
+    assert similarity("word", "word") == 1
+    assert similarity("word", "") == 0
+
+
+def test_escape_like():
+    assert escape_like(r"50%_off\\") == r"50\%\_off\\\\"
+
+
+def test_ranking():
+    index = SiteIndex(SITES + ["github"])
+    assert len(index) == len(SITES) + 1
+    # Exact, then prefixes and substrings, shortest first
+    assert index.search("github") == [
+        "GitHub",
+        "github",
+        "github.com",
+        "my-github",
+    ]
+    assert index.search("GIT", limit=3) == ["GitHub", "github", "github.com"]
+    assert index.search("hub.") == ["github.com"]
+
+
+def test_fuzzy():
+    index = SiteIndex(SITES)
+    # Similarity 0.4 and 0.31, github.com is below the threshold with 0.29
+    assert index.search("githbu") == ["GitHub", "my-github"]
+    assert index.search("zzz") == []
+    assert index.search("") == sorted(SITES, key=lambda s: (len(s), s.casefold()))
+    assert index.search("bank", limit=0) == []
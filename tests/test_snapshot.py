@@ -0,0 +1,122 @@
+import os
+from configparser import ConfigParser
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from butler.app import Butler, encrypt_entry
+from butler.authentication import RootKey
+from butler.config import INI_NAME, INI_SECTION, SNAPSHOT_KEY
+from butler.snapshot import (
+    Snapshot,
+    SnapshotButler,
+    database_changes,
+    snapshot_path,
+    write_snapshot,
+)
+from butler.util import HKDF_KEY_VERSION, derive_row_key, encrypt_with_key
+
+from .conftest import ROOT_PW
+
+MASTER_KEY = bytes(range(32))
+KDF = {"name": "test"}
+
+
+def enable_snapshot(config_dir) -> None:
+    ini = Path(config_dir) / INI_NAME
+    parser = ConfigParser()
+    parser.read(ini)
+    parser[INI_SECTION][SNAPSHOT_KEY] = "true"
+    with open(ini, "w") as f:
+        parser.write(f)
+
+
+def make_row(site, uname, pw):
+    return SimpleNamespace(**encrypt_entry(MASTER_KEY, bytes(32), site, uname, pw))
+
+
+def make_fernet_row(site, uname, pw):
+    salt = os.urandom(16)
+    key = derive_row_key(MASTER_KEY, salt)
+    return SimpleNamespace(
+        app_site=site,
+        salt=salt,
+        key_version=HKDF_KEY_VERSION,
+        username=encrypt_with_key(key, uname.encode()),
+        password=encrypt_with_key(key, pw.encode()),
+    )
+
+
+@pytest.fixture
+def snapshot_file(tmp_path):
+    path = tmp_path / "snapshot.bin"
+    rows = [make_fernet_row("times", "me", "pw1"), make_row("times", "you", "pw2")]
+    rows += [make_row(f"site{i}", "user", f"pw{i}") for i in range(50)]
+    assert write_snapshot(path, MASTER_KEY, KDF, 7, rows) == 52
+    return path
+
+
+def test_roundtrip(snapshot_file):
+    root = RootKey(ROOT_PW, KDF, MASTER_KEY)
+    with Snapshot(snapshot_file) as snap:
+        assert snap.changes == 7 and snap.kdf == KDF
+        with SnapshotButler(snap, root) as app:
+            assert sorted(app.retrieve_uname("times")) == ["me", "you"]
+            assert app.retrieve_pword("times", "you") == "pw2"
+            assert app.retrieve_pword("site42", "user") == "pw42"
+            assert app.retrieve_pword("times", "them") == ""
+            assert app.retrieve_uname("absent") == []
+            assert len(app.retrieve_all()) == 51
+            assert app.search_sites("site4")[:2] == ["site4", "site40"]
+            assert app.retrieve_many([("times", "me"), ("absent", "me")]) == {
+                ("times", "me"): "pw1"
+            }
+
+
+def test_wrong_key(snapshot_file):
+    with Snapshot(snapshot_file) as snap:
+        with pytest.raises(RuntimeError, match="Unlock"):
+            snap.rows("times")
+        with pytest.raises(ValueError, match="corrupt"):
+            snap.unlock(bytes(32))
+
+
+def test_tampered(snapshot_file):
+    data = bytearray(snapshot_file.read_bytes())
+    data[data.index(b'"changes": 7') + 11] = ord("8")
+    snapshot_file.write_bytes(data)
+    with Snapshot(snapshot_file) as snap:
+        assert snap.changes == 8
+        with pytest.raises(ValueError, match="corrupt"):
+            snap.unlock(MASTER_KEY)
+
+
+def test_not_a_snapshot(tmp_path):
+    path = tmp_path / "snapshot.bin"
+    path.write_bytes(b"something else entirely")
+    with pytest.raises(ValueError, match="not a snapshot"):
+        Snapshot(path)
+
+
+def test_butler_refreshes(get_sqlite_config):
+    enable_snapshot(get_sqlite_config)
+    path = snapshot_path(get_sqlite_config)
+    with Butler(ROOT_PW, db_dir=get_sqlite_config) as app:
+        app.add("times", "me", "pw")
+        root = app.vault_root_key()
+        with Snapshot(path) as snap:
+            assert snap.changes == database_changes(get_sqlite_config)
+        app.add_many([("news", "me", "pw2"), ("times", "you", "pw3")])
+        app.remove("times", "me")
+    with Snapshot(path) as snap:
+        assert snap.changes == database_changes(get_sqlite_config)
+        with SnapshotButler(snap, root) as reader:
+            assert reader.retrieve_all() == ["news", "times"]
+            assert reader.retrieve_uname("times") == ["you"]
+            assert reader.retrieve_pword("news", "me") == "pw2"
+
+
+def test_database_changes_unreachable(get_sqlite_config):
+    assert not (Path(get_sqlite_config) / "butler.db").exists()
+    assert database_changes(get_sqlite_config) is None
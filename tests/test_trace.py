@@ -0,0 +1,49 @@
+import pytest
+
+from butler import trace
+from butler.app import Butler
+
+from .conftest import ROOT_PW, random_raw
+
+
+@pytest.fixture
+def tracing():
+    trace.enable()
+    yield
+    trace.reset()
+
+
+def test_disabled():
+    with trace.span("outer"):
+        trace.count("ops")
+    assert trace.snapshot() == {"spans": {}, "counters": {}}
+
+
+def test_spans(tracing):
+    for _ in range(2):
+        with trace.span("outer"):
+            with trace.span("inner"):
+                trace.count("ops", 3)
+    trace.record("outer", 0.5)
+    spans = trace.snapshot()["spans"]
+    assert spans["outer"]["calls"] == 3
+    assert spans["outer > inner"]["calls"] == 2
+    assert spans["outer"]["ms"] >= 500
+    assert trace.snapshot()["counters"] == {"ops": 6}
+    lines = trace.format_report().splitlines()
+    assert lines[1].startswith("outer") and lines[2].startswith("  inner")
+
+
+def test_butler_profile(tracing, get_sqlite_config):
+    site, uname, pw = random_raw()
+    with Butler(ROOT_PW, db_dir=get_sqlite_config) as app:
+        app.add(site, uname, pw)
+        app.retrieve_uname(site)
+        app.retrieve_pword(site, uname)
+    result = trace.snapshot()
+    assert result["counters"]["kdf"] == 1
+    assert result["counters"]["decrypt"] == 2
+    assert result["counters"]["db.queries"] > 0
+    assert "retrieve_pword > db.query" in result["spans"]
+    report = trace.format_report()
+    assert all(secret not in report for secret in (site, uname, pw))
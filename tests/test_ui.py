@@ -0,0 +1,115 @@
+import functools
+import json
+import subprocess
+import sys
+
+import pytest
+
+from butler import agent, app, authentication, config, snapshot, ui
+from butler.app import Butler
+from butler.config import read_config
+from butler.snapshot import Snapshot, database_changes, snapshot_path, write_snapshot
+from butler.ui import env_name, read_entries, with_reader
+
+from .conftest import ROOT_PW
+from .test_snapshot import enable_snapshot
+
+# Generous budgets on the cumulative import time (in seconds) of a cold start
+HELP_BUDGET = 0.5
+STATUS_BUDGET = 1.5
+
+DB_MODULES = {"sqlalchemy", "psycopg", "cryptography", "pandas"}
+
+
+def cold_start(*args) -> tuple:
+    """Run the CLI in a fresh interpreter, return import time and imported packages"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "from butler.ui import cli; cli()"]
+        + list(args),
+        capture_output=True,
+        text=True,
+    )
+    total = 0
+    packages = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue  # Header line
+        packages.add(name.strip().split(".")[0])
+        if not name[1:].startswith(" "):  # Top level imports only
+            total += int(cumulative)
+    return total / 1e6, packages
+
+
+@pytest.mark.parametrize(
+    "args,budget,excluded",
+    [
+        (["--help"], HELP_BUDGET, DB_MODULES | {"python_on_whales", "pyperclip"}),
+        (
+            ["get", "--help"],
+            HELP_BUDGET,
+            DB_MODULES | {"python_on_whales", "pyperclip"},
+        ),
+        (["status"], STATUS_BUDGET, DB_MODULES | {"pyperclip"}),
+    ],
+)
+def test_cold_start(args, budget, excluded):
+    seconds, packages = cold_start(*args)
+    assert not packages & excluded
+    assert seconds < budget, f"Cold start took {seconds:.3f}s"
+
+
+def test_read_entries(tmp_path):
+    expected = [("site", "user", "pass, word"), ("other", "me", "pw")]
+    csv_file = tmp_path / "entries.csv"
+    csv_file.write_text('site,username,password\nsite,user,"pass, word"\nother,me,pw\n')
+    assert read_entries(str(csv_file), "csv") == expected
+    json_file = tmp_path / "entries.json"
+    json_file.write_text(
+        json.dumps(
+            [dict(zip(["site", "username", "password"], entry)) for entry in expected]
+        )
+    )
+    assert read_entries(str(json_file), "json") == expected
+
+
+def test_env_name():
+    assert env_name("github.com", "me@mail.org") == "BUTLER_GITHUB_COM_ME_MAIL_ORG"
+
+
+def test_reader_foreign_snapshot(get_sqlite_config, monkeypatch):
+    config_dir = get_sqlite_config
+    enable_snapshot(config_dir)
+    with Butler(ROOT_PW, db_dir=config_dir) as butler_app:
+        butler_app.add("times", "me", "pw")
+        root = butler_app.vault_root_key()
+    # Left behind by an earlier vault, with a matching change counter
+    path = snapshot_path(config_dir)
+    write_snapshot(path, bytes(32), root.kdf, database_changes(config_dir), [])
+    # The CLI reads the default config dir, point it at the test one
+    for module, function in [
+        (config, read_config),
+        (snapshot, snapshot_path),
+        (snapshot, database_changes),
+    ]:
+        monkeypatch.setattr(
+            module,
+            function.__name__,
+            lambda _dir=config_dir, function=function: function(_dir),
+        )
+    monkeypatch.setattr(agent, "connect_agent", lambda: None)
+    monkeypatch.setattr(ui, "getpass", lambda prompt: ROOT_PW.decode())
+    monkeypatch.setattr(authentication, "unlock", lambda password: root)
+    monkeypatch.setattr(app, "Butler", functools.partial(Butler, db_dir=config_dir))
+    readers = []
+
+    @with_reader
+    def get(reader, site):
+        readers.append((type(reader), reader.retrieve_uname(site)))
+
+    get("times")
+    assert readers == [(Butler, ["me"])]
+    with Snapshot(path) as snap:
+        snap.unlock(root.master_key)  # Refreshed for this vault
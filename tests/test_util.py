@@ -1,8 +1,23 @@
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from butler import util
 from butler.util import (
+    AEAD_KEY_VERSION,
+    HKDF_KEY_VERSION,
+    KeyCache,
+    blind_index,
+    decrypt_token,
+    decrypt_with_key,
+    decrypt_with_salt,
+    derive_aead_key,
     derive_key,
+    derive_row_key,
+    encrypt_with_key,
     encrypt_with_salt,
-    decrypt_with_salt,
     encrypt_wrapper,
+    seal,
+    token_aad,
 )
 
 salt = b"\x95\xfdi\x83\x1e\xb8\x04T"
@@ -10,6 +25,18 @@ pw = b"lol"
 secret = b"secret"
 
 
+@pytest.fixture
+def count_derivations(monkeypatch):
+    calls = []
+
+    def counting(salt, pw):
+        calls.append(salt)
+        return derive_key(salt, pw)
+
+    monkeypatch.setattr(util, "derive_key", counting)
+    return calls
+
+
 def test_derive_key():
     expected = b"Xvj8lEOELtCcXGUvS0kTGN9jcnt5Z80X2aOzyhdK8r8="
     assert expected == derive_key(salt, pw)
@@ -25,3 +52,63 @@ def test_encrypt_wrapper():
     token, my_salt = encrypt_wrapper(pw, secret)
     new_secret = decrypt_with_salt(pw, my_salt, token)
     assert new_secret == secret
+
+
+def test_key_cache_hit(count_derivations):
+    cache = KeyCache()
+    token = encrypt_with_salt(pw, salt, secret, cache)
+    assert decrypt_with_salt(pw, salt, token, cache) == secret
+    assert count_derivations == [salt]
+
+
+def test_key_cache_eviction(count_derivations):
+    cache = KeyCache(maxsize=1)
+    cache.get(salt, pw)
+    cache.get(b"other salt", pw)
+    assert len(cache) == 1
+    cache.get(salt, pw)
+    assert count_derivations == [salt, b"other salt", salt]
+
+
+def test_key_cache_clear():
+    cache = KeyCache()
+    cache.get(salt, pw)
+    stored = next(iter(cache._keys.values()))
+    cache.clear()
+    assert len(cache) == 0
+    assert stored == bytes(len(stored))
+
+
+def test_derive_row_key():
+    master = b"m" * 32
+    key = derive_row_key(master, salt)
+    assert key == derive_row_key(master, salt)
+    assert key != derive_row_key(master, b"other salt")
+    assert decrypt_with_key(key, encrypt_with_key(key, secret)) == secret
+
+
+def test_seal():
+    master = b"m" * 32
+    key = derive_aead_key(master, salt)
+    assert key != derive_aead_key(master, b"other salt")
+    aad = token_aad("site", "password")
+    token = seal(key, secret, aad)
+    assert len(token) == 1 + 12 + len(secret) + 16
+    assert decrypt_token(key, AEAD_KEY_VERSION, token, aad) == secret
+    for other in (token_aad("other", "password"), token_aad("site", "username")):
+        with pytest.raises(InvalidTag):
+            decrypt_token(key, AEAD_KEY_VERSION, token, other)
+
+
+def test_decrypt_token_fernet():
+    key = derive_row_key(b"m" * 32, salt)
+    token = encrypt_with_key(key, secret)
+    assert decrypt_token(key, HKDF_KEY_VERSION, token, b"ignored") == secret
+
+
+def test_blind_index():
+    key = b"k" * 32
+    digest = blind_index(key, "site", "user")
+    assert digest == blind_index(key, "site", "user")
+    assert digest != blind_index(key, "sit", "euser")
+    assert digest != blind_index(b"j" * 32, "site", "user")